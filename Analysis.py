@@ -0,0 +1,234 @@
+__author__ = 'Federico'
+
+import glob
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from EventLog import EVENT_CODES, encode_event, encode_tag
+
+"""
+Summaries across days and cages of the DataCollector text logs.
+
+The logs are expected where HeadFix puts them:
+    <root>/<MMDD>/<cage>/TextFiles/headFix_<cage>_<MMDD>.txt
+Every file is parsed in its own task of a process pool. What has been read
+of each file (its byte offset) and the summary so far are kept in a cache
+file, so a rerun only parses the lines written since the last one.
+
+The summary of a file has one entry per mouse with the counts in
+SUMMARY_FIELDS and the time of its first and last event.
+"""
+
+# summary field -> event counted
+SUMMARY_FIELDS = (
+    ('entries', 'entry'),
+    ('headfixes', 'check+'),
+    ('completed', 'complete'),
+    ('aborted', 'abort'),
+    ('rewards', 'reward'),
+    ('lights', 'light-'),
+    ('stimuli', 'stimulus-'),
+)
+
+CACHE_NAME = ".headfix_analysis.json"
+
+
+def find_logs(root):
+    return sorted(glob.glob(os.path.join(root, "*", "*", "TextFiles", "headFix_*.txt")))
+
+
+# (day, cage) from <root>/<MMDD>/<cage>/TextFiles/<file>
+def day_and_cage(log_path):
+    cage_dir = os.path.dirname(os.path.dirname(log_path))
+    return os.path.basename(os.path.dirname(cage_dir)), os.path.basename(cage_dir)
+
+
+"""
+Parses complete lines of a text log into (tags, epochs, event codes) arrays.
+Both column orders are accepted (tag, epoch, event, datetime and
+tag, epoch, datetime, event): the datetime is the column with a ':' in it.
+Lines without exactly four columns are skipped.
+"""
+def parse_lines(text):
+    lines = text.split('\n')
+    if lines and lines[-1] == '':
+        lines.pop()
+    if text.count('\t') != 3 * len(lines) or '\r' in text:
+        lines = [line.rstrip('\r') for line in lines if line.count('\t') == 3]
+    n_lines = len(lines)
+    # one split for the whole file, every fourth field is the same column
+    fields = '\t'.join(lines).split('\t')
+    events = [fourth if ':' in third else third for third, fourth in zip(fields[2::4], fields[3::4])]
+    # only a handful of different event names, so each is encoded once
+    codes_of = {}
+    codes = np.fromiter((codes_of[event] if event in codes_of else codes_of.setdefault(event, encode_event(event)[0])
+                         for event in events), dtype=np.uint16, count=n_lines)
+    try:
+        tags = np.fromiter(map(int, fields[0::4]), dtype=np.uint64, count=n_lines)
+    except ValueError:
+        tags = np.fromiter(map(encode_tag, fields[0::4]), dtype=np.uint64, count=n_lines)
+    try:
+        epochs = np.array(fields[1::4], dtype=np.float64)
+    except ValueError:
+        epochs = np.array([float_or_nan(epoch) for epoch in fields[1::4]], dtype=np.float64)
+    return tags, epochs, codes
+
+
+def float_or_nan(field):
+    try:
+        return float(field)
+    except ValueError:
+        return float('nan')
+
+
+# Counts per mouse of the parsed events, in the summary format.
+def summarize_events(tags, epochs, codes):
+    summary = {}
+    mouse_tags, mouse_of_event = np.unique(tags, return_inverse=True)
+    n_codes = max(EVENT_CODES.values()) + 1
+    # events of each mouse by code, in one pass
+    counts = np.bincount(mouse_of_event * n_codes + codes,
+                         minlength=len(mouse_tags) * n_codes).reshape(len(mouse_tags), n_codes)
+    first = np.full(len(mouse_tags), np.inf)
+    np.fmin.at(first, mouse_of_event, epochs)
+    last = np.full(len(mouse_tags), -np.inf)
+    np.fmax.at(last, mouse_of_event, epochs)
+    for m, tag in enumerate(mouse_tags):
+        if tag == 0:
+            # session start and end
+            continue
+        mouse = {}
+        for field, event in SUMMARY_FIELDS:
+            mouse[field] = int(counts[m, EVENT_CODES[event]])
+        mouse['first'] = float(first[m])
+        mouse['last'] = float(last[m])
+        summary[str(tag)] = mouse
+    return summary
+
+
+def merge_summaries(summary, new):
+    for tag, counts in new.items():
+        if tag not in summary:
+            summary[tag] = counts
+            continue
+        mouse = summary[tag]
+        for field, event in SUMMARY_FIELDS:
+            mouse[field] += counts[field]
+        mouse['first'] = min(mouse['first'], counts['first'])
+        mouse['last'] = max(mouse['last'], counts['last'])
+    return summary
+
+
+"""
+Pool task: parses log_path from byte offset on, up to its last complete line.
+Returns (log_path, new offset, summary so far merged with the new lines).
+"""
+def parse_log(task):
+    log_path, offset, summary = task
+    with open(log_path, 'rb') as log_file:
+        log_file.seek(offset)
+        data = log_file.read()
+    # a line still being written is left for next time
+    end = data.rfind(b'\n') + 1
+    if end:
+        tags, epochs, codes = parse_lines(data[:end].decode('utf-8', 'replace'))
+        summary = merge_summaries(summary, summarize_events(tags, epochs, codes))
+    return log_path, offset + end, summary
+
+
+class LogAnalysis:
+    """
+    Summaries of every log under root, kept up to date incrementally.
+    update() parses what is new and saves the cache, summaries() gives
+    one row per mouse per day per cage.
+    """
+    def __init__(self, root, cache_path=None, processes=None):
+        self.root = root
+        if cache_path is None:
+            cache_path = os.path.join(root, CACHE_NAME)
+        self.cache_path = cache_path
+        self.processes = processes
+        # log path -> {'offset', 'size', 'mtime', 'summary'}
+        self.files = {}
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path) as cache_file:
+                    self.files = json.load(cache_file)
+            except ValueError:
+                self.files = {}
+
+    # Returns the number of files that had to be parsed.
+    def update(self):
+        tasks = []
+        stats = {}
+        for log_path in find_logs(self.root):
+            stat = os.stat(log_path)
+            stats[log_path] = stat
+            cached = self.files.get(log_path)
+            if cached is not None and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+                continue
+            if cached is None or stat.st_size < cached['offset']:
+                # new file, or rewritten from scratch
+                tasks.append((log_path, 0, {}))
+            else:
+                tasks.append((log_path, cached['offset'], cached['summary']))
+        for log_path in list(self.files):
+            if log_path not in stats:
+                del self.files[log_path]
+
+        if len(tasks) > 1 and self.processes != 1:
+            pool = multiprocessing.Pool(self.processes)
+            try:
+                results = pool.imap_unordered(parse_log, tasks, chunksize=max(1, len(tasks) // 64))
+                self.store_results(results, stats)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            self.store_results(map(parse_log, tasks), stats)
+        if tasks:
+            self.save()
+        return len(tasks)
+
+    def store_results(self, results, stats):
+        for log_path, offset, summary in results:
+            stat = stats[log_path]
+            self.files[log_path] = {'offset': offset, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                                    'summary': summary}
+
+    def save(self):
+        temp_path = self.cache_path + ".tmp"
+        with open(temp_path, 'w') as cache_file:
+            cache_file.write(json.dumps(self.files))
+        os.replace(temp_path, self.cache_path)
+
+    """
+    One dict per mouse per log: day, cage, tag, the SUMMARY_FIELDS counts,
+    first, last and headfix_rate (head fixes per entry), sorted by day, cage and tag.
+    """
+    def summaries(self):
+        rows = []
+        for log_path, cached in self.files.items():
+            day, cage = day_and_cage(log_path)
+            for tag, counts in cached['summary'].items():
+                row = dict(counts)
+                row['day'] = day
+                row['cage'] = cage
+                row['tag'] = tag
+                row['headfix_rate'] = counts['headfixes'] / float(counts['entries']) if counts['entries'] else 0.0
+                rows.append(row)
+        return sorted(rows, key=lambda row: (row['day'], row['cage'], row['tag']))
+
+
+if __name__ == "__main__":
+    import sys
+    # Usage: python Analysis.py /media/Cage1
+    analysis = LogAnalysis(sys.argv[1])
+    print ("Parsed " + str(analysis.update()) + " new or changed files")
+    print ("day\tcage\ttag\tentries\theadfixes\theadfix rate\trewards")
+    for row in analysis.summaries():
+        print (row['day'] + "\t" + row['cage'] + "\t" + row['tag'] + "\t" + str(row['entries']) + "\t" +
+               str(row['headfixes']) + "\t" + "%.2f" % row['headfix_rate'] + "\t" + str(row['rewards']))
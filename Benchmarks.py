@@ -0,0 +1,1523 @@
+__author__ = 'Federico'
+
+import os
+import random
+import threading
+from time import sleep, monotonic, process_time, time
+
+from GPIOBackend import SimulatedGPIO
+from SensorInput import EdgeInput
+
+
+# Simple statistics on a list of numbers, printed in one line.
+def summarize(name, values, unit="ms", scale=1e3):
+    values = sorted(values)
+    n = len(values)
+    mean = sum(values) / n
+    line = (name + ": n=" + str(n) +
+            " mean=" + "%.3f" % (mean * scale) +
+            " median=" + "%.3f" % (values[n // 2] * scale) +
+            " p99=" + "%.3f" % (values[min(n - 1, int(n * 0.99))] * scale) +
+            " max=" + "%.3f" % (values[-1] * scale) + " " + unit)
+    print (line)
+    return mean
+
+
+"""
+Contact-to-piston latency: a thread touches the contact pin at a random moment,
+the task side fires the pistons as soon as it notices. Compares the old 10 ms
+GPIO.input polling loop with the EdgeInput wait.
+"""
+def bench_contact_to_piston_latency(n_trials=100, cpu_rest_time=0.01):
+    contact_pin = 6
+    range_pin = 22
+    pistons_pin = 17
+
+    def polling_wait(gpio, sensors):
+        while not gpio.input(contact_pin):
+            sleep(cpu_rest_time)
+
+    def edge_wait(gpio, sensors):
+        sensors.wait_for([(contact_pin, 1), (range_pin, 0)])
+
+    results = {}
+    for name, wait in (("polling", polling_wait), ("edge", edge_wait)):
+        latencies = []
+        for trial in range(n_trials):
+            gpio = SimulatedGPIO()
+            gpio.setup(contact_pin, gpio.IN)
+            gpio.setup(range_pin, gpio.IN)
+            gpio.setup(pistons_pin, gpio.OUT)
+            gpio.set_input(range_pin, 1)
+            sensors = EdgeInput(gpio, [contact_pin, range_pin], debounce_time=0.005)
+            touch = []
+
+            def mouse():
+                sleep(random.uniform(0.0, 0.02))
+                touch.append(monotonic())
+                gpio.set_input(contact_pin, 1)
+
+            thread = threading.Thread(target=mouse)
+            thread.start()
+            wait(gpio, sensors)
+            gpio.output(pistons_pin, True)
+            thread.join()
+            sensors.close()
+            latencies.append(gpio.outputs_for(pistons_pin)[-1][0] - touch[0])
+        results[name] = summarize("contact->piston " + name, latencies)
+    return results
+
+
+"""
+CPU used while the chamber is empty, as a percentage of one core.
+"""
+def bench_idle_cpu(duration=2.0, cpu_rest_time=0.01):
+    contact_pin = 6
+    range_pin = 22
+    results = {}
+
+    gpio = SimulatedGPIO()
+    gpio.setup(contact_pin, gpio.IN)
+    gpio.setup(range_pin, gpio.IN)
+
+    cpu_start = process_time()
+    t_end = monotonic() + duration
+    while monotonic() < t_end:
+        if gpio.input(contact_pin):
+            break
+        sleep(cpu_rest_time)
+    results["polling"] = (process_time() - cpu_start) / duration * 100
+
+    sensors = EdgeInput(gpio, [contact_pin, range_pin])
+    cpu_start = process_time()
+    sensors.wait_for([(contact_pin, 1)], duration)
+    results["edge"] = (process_time() - cpu_start) / duration * 100
+    sensors.close()
+
+    for name in ("polling", "edge"):
+        print ("idle cpu " + name + ": " + "%.3f" % results[name] + " % of a core")
+    return results
+
+
+"""
+DataCollector events/sec and how long the caller is blocked per event,
+for the old open/print/close path and the background writer.
+"""
+def bench_data_collector(n_events=20000, data_file_path="bench_data_collector.txt"):
+    from Modules import DataCollector
+    results = {}
+    modes = (("synchronous", dict(background=False, echo=False)),
+             ("synchronous+print", dict(background=False, echo=True)),
+             ("background", dict(background=True, echo=False)))
+    for name, options in modes:
+        if os.path.exists(data_file_path):
+            os.remove(data_file_path)
+        collector = DataCollector(data_file_path, **options)
+        blocked = []
+        t_start = monotonic()
+        for i in range(n_events):
+            t_call = monotonic()
+            collector.save_mouse_Reward_given("0123456789", i)
+            blocked.append(monotonic() - t_call)
+        collector.flush()
+        total = monotonic() - t_start
+        collector.close()
+        results[name] = n_events / total
+        summarize("save_helper blocked " + name, blocked, unit="us", scale=1e6)
+        print ("events/sec " + name + ": " + "%.0f" % results[name])
+    os.remove(data_file_path)
+    return results
+
+
+"""
+Filtering a big event log: per-line parsing of the text file against the
+memory-mapped binary records.
+"""
+def bench_event_log(n_events=500000, text_path="bench_events.txt", binary_path="bench_events.bin"):
+    import EventLog
+    events = ['entry', 'check+', 'reward0', 'reward1', 'reward2', 'stimulus-0', 'complete', 'exit']
+    t_event = 1436126551.92
+    with open(text_path, "w") as text_file:
+        for i in range(n_events):
+            t_event += 0.5
+            text_file.write(str(random.randint(1, 2000)) + "\t" + str(t_event) + "\t" +
+                            "2015-07-05 13:02:31.924216\t" + events[i % len(events)] + "\n")
+
+    t_start = monotonic()
+    n_text = 0
+    with open(text_path) as text_file:
+        for line in text_file:
+            tag, epoch, event = EventLog.parse_text_line(line)
+            if tag == "42" and event.startswith("reward"):
+                n_text += 1
+    t_text = monotonic() - t_start
+
+    t_start = monotonic()
+    EventLog.convert_text_log(text_path, binary_path)
+    t_convert = monotonic() - t_start
+
+    t_start = monotonic()
+    records = EventLog.read_events(binary_path)
+    n_binary = int(EventLog.select(records, tag=42, event='reward').sum())
+    t_binary = monotonic() - t_start
+    del records
+
+    print ("event log filter text: " + "%.3f" % t_text + " s, binary: " + "%.4f" % t_binary +
+           " s (" + "%.0f" % (t_text / t_binary) + "x), one-off conversion: " + "%.3f" % t_convert + " s")
+    if n_text != n_binary:
+        print ("Mismatch! text found " + str(n_text) + ", binary found " + str(n_binary))
+    os.remove(text_path)
+    os.remove(binary_path)
+    return {"text": n_events / t_text, "binary": n_events / t_binary}
+
+
+"""
+Tag parsing: frames/sec through the streaming framer on a clean and on a
+noisy line, and how many good frames are lost per corrupted byte.
+The old readTag, which assumes every 16 bytes start with STX, is run on the
+same noisy stream for comparison.
+"""
+def bench_tag_framer(n_frames=20000, chunk_size=64):
+    import RFIDFramer
+    rng = random.Random(1)
+    tags = ["%010X" % rng.randrange(16 ** 10) for i in range(n_frames)]
+    clean = b"".join([RFIDFramer.make_frame(tag) for tag in tags])
+    noisy = RFIDFramer.add_noise(clean, drop_rate=1e-3, flip_rate=1e-3, junk_rate=1e-3, rng=rng)
+    expected = set(int(tag, 16) for tag in tags)
+    results = {}
+
+    for name, stream in (("clean", clean), ("noisy", noisy)):
+        framer = RFIDFramer.TagFramer(dedupe_window=0.0)
+        found = []
+        t_start = monotonic()
+        for i in range(0, len(stream), chunk_size):
+            found += framer.feed(stream[i:i + chunk_size], 0.0)
+        elapsed = monotonic() - t_start
+        n_good = len(set(tag for tag, read_time in found) & expected)
+        results[name] = len(found) / elapsed
+        print ("tag framer " + name + ": " + "%.0f" % results[name] + " frames/sec, " +
+               str(n_good) + "/" + str(n_frames) + " tags recovered, " +
+               str(len(found) - n_good) + " bad tags accepted, " + str(framer.checksum_errors) +
+               " checksum errors")
+
+    # Old readTag: read 1 + 10 + 2 + 3 bytes and trust the alignment.
+    n_good = 0
+    position = 0
+    while len(noisy) - position >= 16:
+        tag = noisy[position + 1:position + 11]
+        position += 16
+        try:
+            if int(tag, 16) in expected:
+                n_good += 1
+        except ValueError:
+            pass
+    print ("old readTag noisy: " + str(n_good) + "/" + str(n_frames) + " tags recovered")
+    return results
+
+
+"""
+setup_mouse + save_current_stats per trial with a colony of n_mice tags and
+n_entries entries: the old list scan and full rewrite against the registry.
+"""
+def bench_mouse_registry(n_mice=2000, n_entries=20000, stats_path="bench_quickStats.txt"):
+    from Modules import Mouse, MouseRegistry
+    rng = random.Random(1)
+    tags = [rng.randrange(16 ** 10) for i in range(n_mice)]
+    visits = [rng.choice(tags) for i in range(n_entries)]
+    results = {}
+
+    # Old path
+    mice = []
+    per_trial = []
+    for tag in visits:
+        t_start = monotonic()
+        current = None
+        for mouse in mice:
+            if mouse.tag == tag:
+                current = mouse
+                break
+        if current is None:
+            current = Mouse(tag)
+            mice.append(current)
+        current.entries += 1
+        with open(stats_path, "w") as file:
+            file.write("Mouse_ID\tentries\tent_rew\thfixes\thf_rew\n")
+            for mouse in mice:
+                file.write(str(mouse.tag) + "\t" + str(mouse.entries) + "\t" + str(mouse.entrance_rewards) + "\t" +
+                           str(mouse.headfixes) + "\t" + str(mouse.headfixed_rewards) + "\n")
+        per_trial.append(monotonic() - t_start)
+    results["list"] = summarize("setup_mouse+stats list", per_trial)
+
+    # Registry
+    mice = MouseRegistry(stats_path)
+    per_trial = []
+    for tag in visits:
+        t_start = monotonic()
+        current = mice.get(tag)
+        if current is None:
+            current = mice.add(tag)
+        current.entries += 1
+        mice.mark_changed(current)
+        mice.save_stats()
+        per_trial.append(monotonic() - t_start)
+    t_start = monotonic()
+    mice.close()
+    results["registry"] = summarize("setup_mouse+stats registry", per_trial)
+    print ("registry final write: " + "%.3f" % ((monotonic() - t_start) * 1e3) + " ms")
+    os.remove(stats_path)
+    return results
+
+
+"""
+Stimulus timing on the simulated GPIO: n_trains light trains played back to
+back with the old sleep(on)/sleep(off) loop and with the deadline player.
+jitter is the spread of the rising edges around their ideal times,
+drift is how late the last rising edge is.
+"""
+def bench_stimulus_timing(n_trains=4, frequency=50, on_time=0.005, length=0.5):
+    import StimulusScheduler
+    led_pin = 20
+    period = 1.0 / frequency
+    results = {}
+
+    def old_train(gpio, player):
+        for train in range(n_trains):
+            for i in range(int(frequency * length)):
+                gpio.output(led_pin, True)
+                sleep(on_time)
+                gpio.output(led_pin, False)
+                sleep(period - on_time)
+
+    def deadline_train(gpio, player):
+        waveform = StimulusScheduler.pulse_train(led_pin, on_time, frequency, length)
+        start_time = player.clock()
+        for train in range(n_trains):
+            player.play(waveform, start_time + train * length)
+
+    for name, play in (("sleep", old_train), ("deadline", deadline_train)):
+        gpio = SimulatedGPIO()
+        gpio.setup(led_pin, gpio.OUT)
+        player = StimulusScheduler.WaveformPlayer(gpio)
+        play(gpio, player)
+        rising = [t for (t, level) in gpio.outputs_for(led_pin) if level]
+        errors = [t - (rising[0] + k * period) for k, t in enumerate(rising)]
+        steps = [errors[k + 1] - errors[k] for k in range(len(errors) - 1)]
+        jitter = summarize("stimulus edge-to-edge error " + name, [abs(step) for step in steps], unit="us", scale=1e6)
+        print ("stimulus drift " + name + ": " + "%.3f" % (errors[-1] * 1e3) + " ms after " + str(len(rising)) + " flashes")
+        results[name] = {"jitter": jitter, "drift": errors[-1]}
+    return results
+
+
+"""
+Video compression on one core: sustained frames/sec of the encoder alone
+(what the compressor process does per frame) and the compression ratio
+against the .raw file, for a few option sets.
+"""
+def bench_video_compression(n_frames=150, noise=2.0):
+    import VideoCompression
+    source = VideoCompression.SyntheticFrameSource(noise=noise)
+    frames = [source.next_frame() for i in range(n_frames)]
+    option_sets = (
+        ("rgb zlib", VideoCompression.CompressionOptions(channel=None, delta=False)),
+        ("green zlib", VideoCompression.CompressionOptions(channel=1, delta=False)),
+        ("green delta zlib", VideoCompression.CompressionOptions(channel=1, delta=True)),
+        ("green delta lz4", VideoCompression.CompressionOptions(channel=1, delta=True, codec="lz4")),
+        ("green delta 2x2 bin", VideoCompression.CompressionOptions(channel=1, delta=True, binning=2)),
+        ("green delta drop 1 bit", VideoCompression.CompressionOptions(channel=1, delta=True, quantize_bits=1)),
+    )
+    results = {}
+    for name, options in option_sets:
+        encoder = VideoCompression.FrameEncoder((256, 256), options)
+        compressed = 0
+        t_start = monotonic()
+        for i, frame in enumerate(frames):
+            data, shape = encoder.encode(frame, i % options.frames_per_chunk == 0)
+            compressed += len(data)
+        elapsed = monotonic() - t_start
+        fps = n_frames / elapsed
+        ratio = n_frames * len(frames[0]) / float(compressed)
+        print ("video " + name + " (" + options.codec + "): " + "%.0f" % fps + " fps, ratio " + "%.1f" % ratio +
+               ", " + "%.2f" % (compressed / elapsed / 1e6) + " MB/s out at " + "%.2f" % (30 * compressed / n_frames / 1e6) + " MB/s for 30 fps")
+        results[name] = {"fps": fps, "ratio": ratio}
+    return results
+
+
+"""
+Time to first frame of a head fix recording with a simulated camera whose
+pipeline takes startup_time to produce frames: start_recording after the
+pistons fire (the old path) against the pre-trigger ring buffer. Negative
+means the recording starts before the trigger.
+"""
+def bench_video_start(n_trials=5, startup_time=0.3, pre_seconds=1.0, video_path="bench_video.raw"):
+    import VideoRingBuffer
+    results = {}
+
+    first_frame = []
+    call_time = []
+    for trial in range(n_trials):
+        camera = VideoRingBuffer.SimulatedCamera(startup_time=startup_time)
+        trigger = time()
+        camera.start_recording(video_path)
+        camera.start_preview()
+        call_time.append(time() - trigger)
+        while camera.first_frame_time is None:
+            sleep(0.001)
+        first_frame.append(camera.first_frame_time - trigger)
+        camera.stop_recording()
+    summarize("start_recording call, old path", call_time)
+    results["old"] = summarize("time to first frame, old path", first_frame)
+
+    camera = VideoRingBuffer.SimulatedCamera(startup_time=startup_time)
+    output = VideoRingBuffer.PretriggerOutput((256, 256), 30, pre_seconds)
+    camera.start_recording(output)
+    sleep(startup_time + pre_seconds + 0.1)
+    first_frame = []
+    call_time = []
+    for trial in range(n_trials):
+        trigger = time()
+        output.begin_capture(VideoRingBuffer.RawFileSink(video_path), "bench_video_timestamps.txt")
+        call_time.append(time() - trigger)
+        sleep(0.2)
+        output.end_capture()
+        output.close()
+        with open("bench_video_timestamps.txt") as timestamps_file:
+            first_frame.append(float(timestamps_file.readline().split("\t")[1]) - trigger)
+    camera.stop_recording()
+    summarize("begin_capture call, ring buffer", call_time)
+    results["ring"] = summarize("time to first frame, ring buffer", first_frame)
+    os.remove(video_path)
+    os.remove("bench_video_timestamps.txt")
+    return results
+
+
+"""
+Getting the frame of random reward events from a session of .raw videos:
+reading the whole video with numpy.fromfile (what the analysis scripts do)
+against the memory-mapped SessionIndex, plus the time to build the index
+and to load it from its cache.
+"""
+def bench_raw_video(n_videos=4, frames_per_video=120, n_lookups=200, video_dir="bench_videos"):
+    import shutil
+    import numpy as np
+    import RawVideo
+    if os.path.exists(video_dir):
+        shutil.rmtree(video_dir)
+    os.makedirs(video_dir)
+    frame = np.zeros((256, 256, 3), dtype=np.uint8)
+    log_path = os.path.join(video_dir, "session.txt")
+    with open(log_path, "w") as log_file:
+        for v in range(n_videos):
+            start = 1000.0 + 100 * v
+            with open(os.path.join(video_dir, "M123_" + repr(start) + ".raw"), "wb") as video_file:
+                for i in range(frames_per_video):
+                    frame[0, 0, 0] = i
+                    video_file.write(frame.tobytes())
+            for r in range(frames_per_video // 10):
+                log_file.write("123\t" + repr(start + r / 3.0) + "\treward" + str(r) + "\t2015-01-01 00:00:00\n")
+
+    t_start = monotonic()
+    index = RawVideo.SessionIndex(log_path, video_dir)
+    build_time = monotonic() - t_start
+    t_start = monotonic()
+    index = RawVideo.SessionIndex(log_path, video_dir)
+    cached_time = monotonic() - t_start
+    print ("raw video index: built in " + "%.1f" % (build_time * 1e3) + " ms, from the cache in " +
+           "%.1f" % (cached_time * 1e3) + " ms")
+
+    rng = random.Random(0)
+    events = index.indexed()
+    lookups = [int(rng.choice(events)) for i in range(n_lookups)]
+    old = []
+    for i in lookups[:20]:
+        video, n = index.locate(i)
+        t_start = monotonic()
+        frames = np.fromfile(video.file_path, dtype=np.uint8).reshape(-1, 256, 256, 3)
+        value = frames[n].sum()
+        old.append(monotonic() - t_start)
+    new = []
+    for i in lookups:
+        t_start = monotonic()
+        value = index.frame(i).sum()
+        new.append(monotonic() - t_start)
+    results = {"old": summarize("event frame, read whole video", old),
+               "memmap": summarize("event frame, memmap index", new)}
+    shutil.rmtree(video_dir)
+    return results
+
+
+# A year of text logs for n_cages cages under root, laid out like HeadFix does.
+def write_synthetic_logs(root, n_days=365, n_cages=6, mice_per_cage=8, entries_per_mouse=10, seed=0):
+    rng = random.Random(seed)
+    for d in range(n_days):
+        day = "%02d%02d" % (1 + d // 31 % 12, 1 + d % 31)
+        for c in range(n_cages):
+            cage = "cage" + str(c)
+            directory = os.path.join(root, day, cage, "TextFiles")
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            t = 1.4e9 + d * 86400.0
+            lines = ["0000000000\t" + repr(t) + "\t2015-01-01 00:00:00\tSeshStart\n"]
+            for e in range(mice_per_cage * entries_per_mouse):
+                tag = str(200000 + c * 100 + rng.randrange(mice_per_cage))
+                t += rng.uniform(10, 600)
+                lines.append(tag + "\t" + repr(t) + "\t2015-01-01 00:00:00\tentry\n")
+                if rng.random() < 0.5:
+                    lines.append(tag + "\t" + repr(t + 2) + "\t2015-01-01 00:00:00\tcheck+\n")
+                    for r in range(3):
+                        lines.append(tag + "\t" + repr(t + 3 + 10 * r) + "\t2015-01-01 00:00:00\treward" + str(r) + "\n")
+                    lines.append(tag + "\t" + repr(t + 40) + "\t2015-01-01 00:00:00\tcomplete\n")
+                lines.append(tag + "\t" + repr(t + 45) + "\t2015-01-01 00:00:00\texit\n")
+            with open(os.path.join(directory, "headFix_" + cage + "_" + day + ".txt"), "w") as log_file:
+                log_file.write("".join(lines))
+
+
+"""
+Cross-day summaries over a synthetic year of logs: parsing every line of
+every file in one process each time (what the analysis scripts do) against
+Analysis.LogAnalysis cold, rerun with nothing new and rerun after the
+day's files got a few more lines.
+"""
+def bench_analysis(n_days=365, n_cages=6, root="bench_media"):
+    import shutil
+    import Analysis
+    import EventLog
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    write_synthetic_logs(root, n_days, n_cages)
+    logs = Analysis.find_logs(root)
+    n_lines = 0
+
+    t_start = monotonic()
+    counts = {}
+    for log_path in logs:
+        with open(log_path) as log_file:
+            for line in log_file:
+                tag, epoch, event = EventLog.parse_text_line(line)
+                key = (log_path, tag)
+                if key not in counts:
+                    counts[key] = {'entries': 0, 'headfixes': 0, 'rewards': 0}
+                if event == 'entry':
+                    counts[key]['entries'] += 1
+                elif event == 'check+':
+                    counts[key]['headfixes'] += 1
+                elif event.startswith('reward'):
+                    counts[key]['rewards'] += 1
+                n_lines += 1
+    old = monotonic() - t_start
+
+    analysis = Analysis.LogAnalysis(root)
+    t_start = monotonic()
+    analysis.update()
+    cold = monotonic() - t_start
+    t_start = monotonic()
+    analysis.update()
+    warm = monotonic() - t_start
+    for log_path in logs[-n_cages:]:
+        with open(log_path, "a") as log_file:
+            log_file.write("200001\t1.5e9\t2015-01-01 00:00:00\tentry\n")
+    t_start = monotonic()
+    n_parsed = analysis.update()
+    appended = monotonic() - t_start
+    print ("analysis of " + str(len(logs)) + " files, " + str(n_lines) + " lines: " +
+           "line by line " + "%.2f" % old + " s, process pool cold " + "%.2f" % cold + " s, " +
+           "rerun " + "%.3f" % warm + " s, rerun after appending to " + str(n_parsed) + " files " + "%.3f" % appended + " s")
+    shutil.rmtree(root)
+    return {"old": old, "cold": cold, "warm": warm, "appended": appended}
+
+
+"""
+Events per second from n_rigs simulated rigs, each in its own thread,
+through EventStream to one EventAggregator on localhost (TCP and Unix
+socket), counted until every event is in the store, plus how long
+write() keeps the caller.
+"""
+def bench_event_stream(n_rigs=8, n_events=20000, store_path="bench_aggregate.bin"):
+    import EventStream
+    results = {}
+    for transport, address in (("tcp", ("127.0.0.1", 0)), ("unix", "bench_aggregator.sock")):
+        for path in (store_path, store_path + ".rigs"):
+            if os.path.exists(path):
+                os.remove(path)
+        aggregator = EventStream.EventAggregator(address, store_path, flush_interval=0.05)
+        write_times = []
+
+        def rig(r):
+            stream = EventStream.EventStream(aggregator.address, "rig" + str(r), "bench_rig" + str(r) + ".spool")
+            for i in range(n_events):
+                t_start = monotonic()
+                stream.write([(str(r), 1.4e9 + i * 0.01, None, "entry")])
+                if i % 100 == 0:
+                    write_times.append(monotonic() - t_start)
+            stream.flush()
+            stream.close()
+
+        t_start = monotonic()
+        threads = [threading.Thread(target=rig, args=(r,)) for r in range(n_rigs)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        aggregator.close()
+        elapsed = monotonic() - t_start
+        stored = len(EventStream.read_store(store_path))
+        print ("event stream " + transport + ": " + str(stored) + " of " + str(n_rigs * n_events) + " events stored, " +
+               "%.0f" % (stored / elapsed) + " events/s")
+        summarize("event stream " + transport + " write()", write_times, unit="us", scale=1e6)
+        results[transport] = stored / elapsed
+        for path in (store_path, store_path + ".rigs"):
+            os.remove(path)
+    return results
+
+
+"""
+Rig startup with simulated devices whose auto exposure takes settle_time
+to settle: the RFID reader, the camera with its fixed 2 s wait and the GPIO
+lines one after another (the old path) against HeadFix.Task, which sets
+them up at the same time and waits for the exposure readings to settle.
+"""
+def bench_startup(n_runs=3, settle_time=0.5, data_root="bench_media/"):
+    import shutil
+    import HeadFix
+    import Modules
+    from RFIDFramer import SimulatedSerial
+    from VideoRingBuffer import SimulatedCamera
+    config = {"cage_id": "B1", "data_root_path": data_root, "confirm_paths": False, "pretrigger_video_seconds": None}
+    old = []
+    new = []
+    for run in range(n_runs):
+        t_start = monotonic()
+        reader = Modules.TagReader(None, serial_port=SimulatedSerial())
+        camera = SimulatedCamera(settle_time=settle_time)
+        sleep(2.0)
+        gpio = SimulatedGPIO()
+        for pin in (17, 27, 19, 20, 21, 16, 12):
+            gpio.setup(pin, gpio.OUT)
+        old.append(monotonic() - t_start)
+        reader.close()
+
+        t_start = monotonic()
+        task = HeadFix.Task(SimulatedGPIO(), config, SimulatedSerial(), SimulatedCamera(settle_time=settle_time))
+        new.append(monotonic() - t_start)
+        task.quit()
+        del task
+    shutil.rmtree(data_root)
+    return {"old": summarize("startup, one after another with fixed wait", old, unit="s", scale=1),
+            "new": summarize("startup, parallel with readiness check", new, unit="s", scale=1)}
+
+
+"""
+Cost of the instrumentation: recording a value in a histogram (also with
+the monotonic() call around it), incrementing a counter and writing the
+whole exposition, against Metrics.OVERHEAD_BUDGET per recorded value.
+"""
+def bench_metrics(n=200000):
+    import Metrics
+    metrics = Metrics.Metrics()
+    histogram = metrics.histogram("bench_seconds")
+    counter = metrics.counter("bench_total")
+    results = {}
+
+    t_start = monotonic()
+    for i in range(n):
+        pass
+    loop = monotonic() - t_start
+
+    t_start = monotonic()
+    for i in range(n):
+        histogram.observe(0.00123)
+    results["observe"] = (monotonic() - t_start - loop) / n
+
+    t_start = monotonic()
+    for i in range(n):
+        histogram.observe_since(monotonic())
+    results["observe_since"] = (monotonic() - t_start - loop) / n
+
+    t_start = monotonic()
+    for i in range(n):
+        counter.inc()
+    results["inc"] = (monotonic() - t_start - loop) / n
+
+    for name in ("contact_to_piston", "range_to_exit", "valve_open", "valve_error", "camera_start", "trial"):
+        metrics.histogram(name + "_seconds").observe(0.001)
+    t_start = monotonic()
+    for i in range(100):
+        metrics.exposition()
+    results["exposition"] = (monotonic() - t_start) / 100
+
+    for name in ("observe", "observe_since", "inc"):
+        print ("metrics " + name + ": " + "%.3f" % (results[name] * 1e6) + " us, budget " +
+               "%.1f" % (Metrics.OVERHEAD_BUDGET * 1e6) + " us, " +
+               ("within" if results[name] < Metrics.OVERHEAD_BUDGET else "OVER") + " budget")
+    print ("metrics exposition of " + str(len(metrics.histograms)) + " histograms: " +
+           "%.3f" % (results["exposition"] * 1e3) + " ms")
+    return results
+
+
+"""
+Whole sessions of the task in virtual time (Simulator.py): simulated hours
+per real second, with the data and quickStats files checked at the end.
+"""
+def bench_simulator(hours=24.0, n_mice=20, data_root="bench_media"):
+    import shutil
+    import Simulator
+    simulation = Simulator.Simulation(data_root_path=data_root, start_time=1436126000.0)
+    visits = Simulator.generate_visits(simulation.task, simulation.clock(), hours * 3600, n_mice)
+    simulation.add_visits(visits)
+    simulation.run()
+    problems = simulation.check()
+    shutil.rmtree(data_root)
+    speedup = simulation.virtual_seconds() / simulation.real_seconds
+    print ("simulator: " + str(len(visits)) + " visits, " + "%.1f" % (simulation.virtual_seconds() / 3600) +
+           " h in " + "%.2f" % simulation.real_seconds + " s (" + "%.0f" % speedup + "x real time), " +
+           str(len(problems)) + " problems")
+    return {"speedup": speedup, "visits_per_second": len(visits) / simulation.real_seconds,
+            "problems": len(problems)}
+
+
+"""
+Time to get the mice back after a restart, by journal size: replaying a
+journal of n_records with no snapshot, opening it again once compacted
+(snapshot only), and the old way of rebuilding the counts, parsing a day's
+text log of as many events.
+"""
+def bench_journal_recovery(sizes=(1000, 10000, 100000, 1000000), n_mice=50, path="bench_journal.bin"):
+    import Journal
+    from EventLog import parse_text_line
+    rng = random.Random(0)
+    tags = [rng.randrange(16 ** 10) for i in range(n_mice)]
+    events = ('entry', 'check+', 'reward0', 'exit')
+    results = {}
+    for n_records in sizes:
+        counts = dict((tag, [0, 0, 0, 0]) for tag in tags)
+        records = []
+        lines = []
+        for i in range(n_records):
+            tag = rng.choice(tags)
+            field = rng.randrange(4)
+            counts[tag][field] += 1
+            records.append(Journal.pack_record(tag, counts[tag]))
+            lines.append(str(tag) + "\t" + str(1436126000.0 + i) + "\t2015-07-05 13:00:00.000000\t" + events[field] + "\n")
+        with open(path, "wb") as journal_file:
+            journal_file.write(Journal.HEADER.pack(Journal.JOURNAL_MAGIC, Journal.RECORD.size) + b"".join(records))
+        with open(path + ".txt", "w") as log_file:
+            log_file.write("".join(lines))
+
+        t_start = monotonic()
+        journal = Journal.MouseJournal(path, snapshot_interval=n_records + 1)
+        replay = monotonic() - t_start
+        journal.close()
+        t_start = monotonic()
+        journal = Journal.MouseJournal(path)
+        snapshot = monotonic() - t_start
+        journal.close()
+
+        t_start = monotonic()
+        parsed = {}
+        with open(path + ".txt") as log_file:
+            for line in log_file:
+                tag, epoch, event = parse_text_line(line)
+                mouse = parsed.setdefault(tag, [0, 0, 0, 0])
+                mouse[events.index(event)] += 1
+        text = monotonic() - t_start
+        for p in (path, path + ".snapshot", path + ".txt"):
+            os.remove(p)
+        print ("journal recovery, " + str(n_records) + " records: replay " + "%.2f" % (replay * 1e3) +
+               " ms, snapshot " + "%.2f" % (snapshot * 1e3) + " ms, parsing the text log " +
+               "%.2f" % (text * 1e3) + " ms")
+        results[n_records] = {"replay": replay, "snapshot": snapshot, "text": text}
+    return results
+
+
+"""
+Several chambers on one host (Chambers.py) with simulated devices, each
+with a mouse coming in and taking the head fix n_visits times, at random
+moments so the chambers do not take turns. Per chamber count: contact to
+pistons out latency and the error of the reward valve open time, from the
+simulated GPIO output log, as the number of chambers grows.
+"""
+def bench_chambers(chamber_counts=(1, 2, 4, 8), n_visits=6, data_root="bench_media"):
+    import shutil
+    import Chambers
+    from RFIDFramer import SimulatedSerial, make_frame
+    from VideoRingBuffer import SimulatedCamera
+    shared = {"pretrigger_video_seconds": None, "metrics_interval": None, "reward_time": 0.05,
+              "number_of_headfix_rewards": 2, "inter_reward_interval": 0.15, "piezo_duration": 0.05,
+              "entrance_reward_delay_time": 0.1, "skedaddle_time": 0.2, "tag_dedupe_window": 0.1}
+    results = {}
+    for n_chambers in chamber_counts:
+        gpio = SimulatedGPIO()
+        serial_ports = [SimulatedSerial() for i in range(n_chambers)]
+        cameras = [SimulatedCamera(startup_time=0.0, settle_time=0.0) for i in range(n_chambers)]
+        configs = [dict(Chambers.simulated_pins(i), cage_id="B" + str(i)) for i in range(n_chambers)]
+        controller = Chambers.ChamberController(configs, shared, data_root, gpio, serial_ports, cameras)
+        controller.start()
+        contact_times = [[] for i in range(n_chambers)]
+
+        def visits(i):
+            rng = random.Random(i)
+            task = controller.chambers[i]
+            for visit in range(n_visits):
+                sleep(rng.uniform(0.05, 0.2))
+                gpio.set_input(task.range_pin, 1)
+                serial_ports[i].send(make_frame("%010X" % (1000 + i)))
+                sleep(rng.uniform(0.02, 0.05))
+                contact_times[i].append(monotonic())
+                gpio.set_input(task.contact_pin, 1)
+                sleep(0.35)
+                gpio.set_input(task.contact_pin, 0)
+                sleep(0.1)
+                gpio.set_input(task.range_pin, 0)
+        threads = [threading.Thread(target=visits, args=(i,)) for i in range(n_chambers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        sleep(0.2)
+        controller.quit()
+
+        latencies = []
+        valve_errors = []
+        for i, task in enumerate(controller.chambers):
+            pistons_out = [t for (t, level) in gpio.outputs_for(task.pistons_pin) if level]
+            for contact_time in contact_times[i]:
+                after = [t for t in pistons_out if t >= contact_time]
+                if after:
+                    latencies.append(after[0] - contact_time)
+            edges = gpio.outputs_for(task.reward_pin)
+            for (t_on, level_on), (t_off, level_off) in zip(edges, edges[1:]):
+                if level_on and not level_off:
+                    valve_errors.append(abs(t_off - t_on - shared["reward_time"]))
+        shutil.rmtree(data_root)
+        results[n_chambers] = {
+            "contact_to_piston": summarize(str(n_chambers) + " chambers, contact to pistons", latencies),
+            "valve_error": summarize(str(n_chambers) + " chambers, reward valve error", valve_errors)}
+    return results
+
+
+
+"""
+Live motion energy (MotionEnergy.py) on synthetic brain camera frames, still
+and with the image jumping like a struggling mouse: time to analyse one
+frame by subsampling step, against the 33 ms a frame has at 30 fps, and a
+MotionMonitor following a 30 fps simulated camera: frames analysed and
+lost, and how long after the mouse starts struggling SustainedMotion
+fires for a release_time of 0.5 s.
+"""
+def bench_motion_energy(n_frames=300, steps=(1, 2, 4), seconds=4.0):
+    import MotionEnergy
+    from VideoCompression import SyntheticFrameSource
+    from VideoRingBuffer import PretriggerOutput, SimulatedCamera
+    budget = 1.0 / 30
+    source = SyntheticFrameSource(noise=2.0)
+    frames = [source.next_frame() for i in range(n_frames // 2)]
+    source.jitter = 8
+    frames += [source.next_frame() for i in range(n_frames - n_frames // 2)]
+    results = {}
+    mean_times = {}
+    for step in steps:
+        analyzer = MotionEnergy.MotionAnalyzer((256, 256), step=step)
+        times = []
+        energies = []
+        for frame in frames:
+            t_start = monotonic()
+            energy, fraction = analyzer.analyze(frame)
+            times.append(monotonic() - t_start)
+            energies.append(energy)
+        half = n_frames // 2
+        print ("motion energy, step " + str(step) + ": still " + "%.2f" % (sum(energies[1:half]) / (half - 1)) +
+               ", struggling " + "%.2f" % (sum(energies[half + 1:]) / (n_frames - half - 1)) + " grey levels")
+        results[step] = summarize("motion energy, step " + str(step) + " (budget " + "%.1f" % (budget * 1e3) + " ms)",
+                                  times)
+        mean_times[step] = sum(times) / len(times)
+
+    source.jitter = 0
+    camera = SimulatedCamera(startup_time=0.0, frame_source=source.next_frame, settle_time=0.0)
+    output = PretriggerOutput((256, 256), 30, 2.0)
+    camera.start_recording(output)
+    monitor = MotionEnergy.MotionMonitor(output.ring)
+    fired = []
+    release = MotionEnergy.SustainedMotion(monitor.threshold, 0.5, fired.append)
+    monitor.add_listener(release)
+    release.arm()
+    sleep(seconds / 2)
+    struggle_start = time()
+    source.jitter = 8
+    sleep(seconds / 2)
+    camera.stop_recording()
+    monitor.close()
+    print ("motion monitor: " + str(monitor.frames_analyzed) + " frames analysed, " + str(monitor.frames_lost) +
+           " lost, the analysis (step 2) takes " + "%.1f" % (100 * mean_times.get(2, 0.0) * 30) + "% of a core at 30 fps")
+    release_latency = fired[0] - struggle_start if fired else None
+    print ("motion release after 0.5 s of struggling fired after: " +
+           ("%.3f" % release_latency + " s" if fired else "never"))
+    results["frames_lost"] = monitor.frames_lost
+    results["release_latency"] = release_latency
+    return results
+
+
+
+"""
+Stimulus-locked dF/F averages (FrameAveraging.py) of a synthetic session,
+n_videos head fixes with a stimulus every 2 s: the way the scripts do it,
+a Python loop over the frames of every window, against the engine on one
+process and on a pool, then a rerun (everything cached) and a rerun with a
+new window.
+"""
+def bench_frame_averaging(n_videos=4, frames_per_video=300, video_dir="bench_videos"):
+    import shutil
+    import numpy as np
+    import FrameAveraging
+    from RawVideo import SessionIndex
+    from VideoCompression import SyntheticFrameSource
+    if os.path.exists(video_dir):
+        shutil.rmtree(video_dir)
+    os.makedirs(video_dir)
+    log_path = os.path.join(video_dir, "session.txt")
+    source = SyntheticFrameSource(noise=2.0)
+    with open(log_path, "w") as log_file:
+        for v in range(n_videos):
+            start = 1000.0 + 100 * v
+            event_frames = list(range(45, frames_per_video - 30, 60))
+            with open(os.path.join(video_dir, "M123_" + repr(start) + ".raw"), "wb") as video_file:
+                for i in range(frames_per_video):
+                    frame = np.frombuffer(source.next_frame(), dtype=np.uint8).reshape(256, 256, 3).copy()
+                    if any(0 < i - n <= 15 for n in event_frames):
+                        frame[96:160, 96:160, 1] += 10
+                    video_file.write(frame.tobytes())
+            for n, event_frame in enumerate(event_frames):
+                log_file.write("123\t" + repr(start + event_frame / 30.0 + 0.001) + "\tstimulus-" + str(n) +
+                               "\t2015-01-01 00:00:00\n")
+    options = FrameAveraging.AveragingOptions(before=30, after=30, binning=2)
+    results = {}
+
+    # one frame at a time, like the analysis scripts
+    t_start = monotonic()
+    index = SessionIndex(log_path, video_dir)
+    total = None
+    n_events = 0
+    for i in index.indexed():
+        video, n = index.locate(i)
+        if n < options.before or n + options.after >= len(video):
+            continue
+        f0 = np.zeros((256, 256))
+        for k in range(n - options.baseline, n):
+            f0 += video[k][:, :, 1]
+        f0 = np.maximum(f0 / options.baseline, 1.0)
+        window = []
+        for k in range(n - options.before, n + options.after + 1):
+            window.append(video[k][:, :, 1] / f0 - 1.0)
+        total = np.array(window) if total is None else total + np.array(window)
+        n_events += 1
+    results["loop"] = monotonic() - t_start
+
+    for name, processes in (("one process", 1), ("pool", None)):
+        shutil.rmtree(os.path.join(video_dir, "frame_averages"), ignore_errors=True)
+        t_start = monotonic()
+        averages = FrameAveraging.FrameAverages(log_path, video_dir, options, processes=processes)
+        averages.update()
+        results[name] = monotonic() - t_start
+    t_start = monotonic()
+    FrameAveraging.FrameAverages(log_path, video_dir, options).update()
+    results["cached"] = monotonic() - t_start
+    t_start = monotonic()
+    FrameAveraging.FrameAverages(log_path, video_dir, FrameAveraging.AveragingOptions(before=15, after=45)).update()
+    results["new window"] = monotonic() - t_start
+    response = averages.response_map(123, 'stimulus', 1, 16)
+    print ("frame averaging, " + str(n_events) + " events in " + str(n_videos) + " videos: " +
+           ", ".join(name + " " + "%.2f" % results[name] + " s" for name in
+                     ("loop", "one process", "pool", "cached", "new window")) +
+           "; response " + "%.3f" % response[48:80, 48:80].mean() + " dF/F")
+    shutil.rmtree(video_dir)
+    return results
+
+
+# A control loop ticking every period seconds, saving a reward event every tick and a mouse change every
+# 20, like a head fix sped up. Returns how late each tick woke up, in seconds.
+def control_loop(collector, mice, duration, period=0.005):
+    mouse = mice.add(1234)
+    lateness = []
+    start = monotonic()
+    for i in range(int(duration / period)):
+        deadline = start + i * period
+        delay = deadline - monotonic()
+        if delay > 0:
+            sleep(delay)
+        lateness.append(monotonic() - deadline)
+        collector.save_mouse_Reward_given(mouse.tag, i)
+        if i % 20 == 0:
+            mouse.headfixed_rewards += 1
+            mice.mark_changed(mouse)
+    return lateness
+
+
+# The control loop in a real-time control process, its files written by the IOWorker at the other end.
+def realtime_control_loop(events, counts, connection, duration, results):
+    import RealtimeProcess
+    from Modules import DataCollector
+    event_ring = RealtimeProcess.SPSCRing(name=events)
+    counts_ring = RealtimeProcess.SPSCRing(name=counts)
+    collector = DataCollector(None, echo=False, writer=RealtimeProcess.RingWriter(event_ring, connection))
+    mice = RealtimeProcess.RingMouseRegistry()
+    mice.restore(RealtimeProcess.RingJournal(counts_ring, {}))
+    results.put(control_loop(collector, mice, duration))
+    collector.close()
+    connection.send(("close", None))
+    connection.recv()
+    event_ring.close()
+    counts_ring.close()
+
+
+"""
+Control loop timing with a disk that stalls (a slow USB stick under
+/media/Cage1): every data file flush and every 10th journal write take
+stall seconds. The loop saves its events and mouse changes the normal way
+(background writer, journal written by the registry's thread) and in real-time mode
+(RealtimeProcess.py, the files written by another process), against the
+normal way with a disk that never stalls.
+"""
+def bench_realtime_process(duration=3.0, stall=0.2, data_root="bench_media"):
+    import multiprocessing
+    import shutil
+    import RealtimeProcess
+    from Journal import MouseJournal
+    from Modules import DataCollector, MouseRegistry
+
+    class StallingCollector(DataCollector):
+        def flush_events(self, fsync):
+            sleep(self.stall)
+            DataCollector.flush_events(self, fsync)
+
+    class StallingJournal(MouseJournal):
+        def write(self, mouse):
+            self.n_writes = getattr(self, "n_writes", 0) + 1
+            if self.n_writes % 10 == 0:
+                sleep(self.stall)
+            MouseJournal.write(self, mouse)
+
+    if os.path.exists(data_root):
+        shutil.rmtree(data_root)
+    os.makedirs(data_root)
+    for name, stall_time, realtime in (("normal, no stalls", 0.0, False), ("normal, stalling disk", stall, False),
+                                       ("real-time process, stalling disk", stall, True)):
+        data_path = os.path.join(data_root, "headFix_" + str(len(os.listdir(data_root))) + ".txt")
+        collector = StallingCollector(data_path, background=not realtime, echo=False, flush_interval=0.1)
+        collector.stall = stall_time
+        journal = StallingJournal(data_path[:-len(".txt")] + "_journal.bin")
+        journal.stall = stall_time
+        mice = MouseRegistry(data_path[:-len(".txt")] + "_stats.txt", journal)
+        if not realtime:
+            lateness = control_loop(collector, mice, duration)
+            collector.close()
+            mice.close()
+        else:
+            event_ring = RealtimeProcess.SPSCRing(RealtimeProcess.EVENT_RECORD.size, 4096)
+            counts_ring = RealtimeProcess.SPSCRing(RealtimeProcess.COUNTS_RECORD.size, 1024)
+            worker_end, control_end = multiprocessing.Pipe()
+            results = multiprocessing.Queue()
+            control = multiprocessing.Process(target=realtime_control_loop,
+                                              args=(event_ring.name, counts_ring.name, control_end, duration, results))
+            control.start()
+            worker = RealtimeProcess.IOWorker(event_ring, counts_ring, worker_end, collector, mice, flush_interval=0.1)
+            worker.run(control)
+            lateness = results.get()
+            control.join()
+            event_ring.close()
+            counts_ring.close()
+        with open(data_path) as data_file:
+            n_lines = len(data_file.readlines())
+        summarize(name + ", tick lateness (" + str(n_lines) + " events written)", lateness)
+    shutil.rmtree(data_root)
+
+
+# A client of the status server for duration seconds: polling /status every interval seconds or,
+# with follow, long-polling /events. Puts the number of answers and of events seen in results.
+def status_client(address, duration, interval, follow, results):
+    import StatusServer
+    answers = 0
+    events = 0
+    after = -1
+    end = monotonic() + duration
+    while monotonic() < end:
+        if follow:
+            answer = StatusServer.get_status(address, "/events?after=" + str(after) + "&wait=1")
+            events += len(answer["events"])
+            after = answer["next_seq"] - 1
+        else:
+            StatusServer.get_status(address)
+            sleep(interval)
+        answers += 1
+    results.put((answers, events, follow))
+
+
+"""
+Trial timing with clients on the status server (StatusServer.py): the
+control loop of bench_realtime_process, saving an event every 5 ms and
+publishing it on the status board, with no clients, then with clients in
+other processes polling /status every 10 ms and following the events by
+long polling.
+"""
+def bench_status_server(duration=3.0, client_counts=(0, 2, 8), data_path="bench_status.txt"):
+    import multiprocessing
+    import StatusServer
+    from Metrics import Metrics
+    from Modules import DataCollector, MouseRegistry
+    for n_clients in client_counts:
+        status_process = StatusServer.StatusProcess(("127.0.0.1", 0))
+        address = status_process.wait_ready()
+        mice = MouseRegistry()
+        mice.set_status(status_process.board)
+        metrics = Metrics()
+        collector = DataCollector(data_path, background=True, echo=False, metrics=metrics,
+                                  status=status_process.board)
+        results = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=status_client,
+                                           args=(address, duration + 1.0, 0.01, i % 2 == 1, results))
+                   for i in range(n_clients)]
+        for client in clients:
+            client.start()
+        sleep(0.5)
+        lateness = control_loop(collector, mice, duration)
+        reports = [results.get() for client in clients]
+        for client in clients:
+            client.join()
+        collector.close()
+        status_process.close()
+        save_time = metrics.histogram("save_event_seconds")
+        summarize(str(n_clients) + " clients, " + str(sum(answers for answers, events, follow in reports)) +
+                  " answers, tick lateness", lateness)
+        print ("    save event p99 " + "%.3f" % (save_time.quantile(0.99) * 1e3) + " ms, followers saw " +
+               str([events for answers, events, follow in reports if follow]) + " of " + str(len(lateness)) +
+               " events")
+    os.remove(data_path)
+
+
+# Follows a frame bus up to frame last_seq, touching every frame in place, sends (read, dropped) to results.
+def frame_bus_reader(name, consumer_id, last_seq, results):
+    import FrameBus
+    reader = FrameBus.FrameBusReader(name, consumer_id, poll_interval=0.0002)
+    seq = -1
+    while seq < last_seq:
+        entry = reader.next_frame(2.0)
+        if entry is None:
+            break
+        seq, timestamp, frame = entry
+        frame[::64].sum()
+        reader.still_valid(seq)
+        entry = frame = None
+    results.put((reader.frames_read, reader.frames_dropped))
+    reader.close()
+
+
+# The copying alternative: gets frames from a queue until None, sends (read, 0) to results.
+def frame_queue_reader(frames, results):
+    import numpy as np
+    n_frames = 0
+    while True:
+        frame = frames.get()
+        if frame is None:
+            break
+        np.frombuffer(frame, dtype=np.uint8)[::64].sum()
+        n_frames += 1
+    results.put((n_frames, 0))
+
+
+"""
+Fan-out of 256x256 rgb frames to 1 to 4 consumer processes, the producer
+going as fast as it can: frames/s and the time each frame holds up the
+producer (publishing on the shared-memory FrameBus against putting a copy
+in a multiprocessing.Queue for every consumer), and the frames the
+consumers got or dropped.
+"""
+def bench_frame_bus(consumer_counts=(1, 2, 3, 4), n_frames=1000):
+    import multiprocessing
+    import FrameBus
+    from VideoCompression import SyntheticFrameSource
+    source = SyntheticFrameSource(noise=2.0)
+    frames = [source.next_frame() for i in range(30)]
+    results = {}
+    for n_consumers in consumer_counts:
+        for method in ("frame bus", "queues"):
+            done = multiprocessing.Queue()
+            if method == "frame bus":
+                bus = FrameBus.FrameBus(len(frames[0]), capacity=30)
+                consumers = [multiprocessing.Process(target=frame_bus_reader, args=(bus.name, i, n_frames - 1, done))
+                             for i in range(n_consumers)]
+            else:
+                queues = [multiprocessing.Queue(30) for i in range(n_consumers)]
+                consumers = [multiprocessing.Process(target=frame_queue_reader, args=(queues[i], done))
+                             for i in range(n_consumers)]
+            for consumer in consumers:
+                consumer.start()
+            sleep(0.5)
+            stalls = []
+            t_start = monotonic()
+            for i in range(n_frames):
+                frame = frames[i % len(frames)]
+                start = monotonic()
+                if method == "frame bus":
+                    bus.publish(frame, start)
+                else:
+                    for frame_queue in queues:
+                        frame_queue.put(frame)
+                stalls.append(monotonic() - start)
+            elapsed = monotonic() - t_start
+            if method == "queues":
+                for frame_queue in queues:
+                    frame_queue.put(None)
+            reports = [done.get() for consumer in consumers]
+            for consumer in consumers:
+                consumer.join()
+            if method == "frame bus":
+                bus.close()
+            name = method + ", " + str(n_consumers) + " consumers"
+            print (name + ": " + "%.0f" % (n_frames / elapsed) + " frames/s, consumers read " +
+                   str([read for read, dropped in reports]) + ", dropped " + str([dropped for read, dropped in reports]))
+            results[(method, n_consumers)] = {"fps": n_frames / elapsed,
+                                              "stall": summarize(name + ", producer time per frame", stalls)}
+    return results
+
+
+"""
+Regression suite: the control and data paths on the simulated GPIO, RFID
+reader and camera, measured quickly enough to run after every change and
+compared with a baseline file (python Benchmarks.py --suite). Every
+measure is a metric: a value, its unit, whether lower or higher is better,
+noise, a difference too small to mean anything whatever the tolerance, and
+relative_noise, the same as a fraction of the baseline. Each part of the
+suite is run repeats times and the best value of each metric kept, so a
+busy moment on the machine is not taken for a regression, and the spread of
+the repeats counts as noise too. A metric that still looks worse is only
+flagged if it does again when its part of the suite is run a second time.
+"""
+
+# The baseline run_suite compares with, and writes the first time. It belongs to
+# the machine it was measured on, so it is kept next to this file and not committed.
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+
+def metric(value, unit, better="lower", noise=0.0, relative_noise=0.0):
+    return {"value": value, "unit": unit, "better": better, "noise": noise, "relative_noise": relative_noise}
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+# Frames/sec through the RFID framer, on a clean and on a noisy line.
+def suite_tag_parsing(n_frames=10000, chunk_size=64):
+    import RFIDFramer
+    rng = random.Random(1)
+    clean = b"".join([RFIDFramer.make_frame("%010X" % rng.randrange(16 ** 10)) for i in range(n_frames)])
+    noisy = RFIDFramer.add_noise(clean, drop_rate=1e-3, flip_rate=1e-3, junk_rate=1e-3, rng=rng)
+    metrics = {}
+    for name, stream in (("clean", clean), ("noisy", noisy)):
+        framer = RFIDFramer.TagFramer(dedupe_window=0.0)
+        n_found = 0
+        t_start = monotonic()
+        for i in range(0, len(stream), chunk_size):
+            n_found += len(framer.feed(stream[i:i + chunk_size], 0.0))
+        metrics["tag parsing " + name] = metric(n_found / (monotonic() - t_start), "frames/s", "higher",
+                                                relative_noise=0.2)
+    return metrics
+
+
+# DataCollector events/sec, and how long a save holds up the trial with the background writer.
+def suite_data_collector(n_events=10000, data_file_path="bench_suite_events.txt"):
+    from Modules import DataCollector
+    metrics = {}
+    for name, background in (("synchronous", False), ("background", True)):
+        collector = DataCollector(data_file_path, background=background, echo=False)
+        blocked = []
+        t_start = monotonic()
+        for i in range(n_events):
+            t_call = monotonic()
+            collector.save_mouse_Reward_given("0123456789", i)
+            blocked.append(monotonic() - t_call)
+        collector.flush()
+        metrics["data collector " + name] = metric(n_events / (monotonic() - t_start), "events/s", "higher",
+                                                   relative_noise=0.2)
+        collector.close()
+        os.remove(data_file_path)
+        if background:
+            metrics["data collector background save p99"] = metric(percentile(blocked, 0.99) * 1e6, "us", noise=5.0)
+    return metrics
+
+
+# Task.setup_mouse + Task.save_current_stats per trial, with colonies of each size.
+def suite_colony(sizes=(100, 1000, 10000), n_trials=2000, data_root="bench_suite_media/"):
+    import shutil
+    import HeadFix
+    from Modules import MouseRegistry
+    from RFIDFramer import SimulatedSerial
+    from VideoRingBuffer import SimulatedCamera
+    config = {"cage_id": "S1", "data_root_path": data_root, "confirm_paths": False, "pretrigger_video_seconds": None,
+              "metrics_interval": None, "resume_from_journal": False}
+    task = HeadFix.Task(SimulatedGPIO(), config, SimulatedSerial(), SimulatedCamera(startup_time=0.0, settle_time=0.0))
+    rng = random.Random(1)
+    metrics = {}
+    for size in sizes:
+        task.mice.close()
+        task.mice = MouseRegistry(task.stats_full_path)
+        tags = [rng.randrange(16 ** 10) for i in range(size)]
+        for tag in tags:
+            task.mice.add(tag)
+        task.mice.save_stats()
+        t_start = monotonic()
+        for i in range(n_trials):
+            task.setup_mouse(rng.choice(tags))
+            task.currentMouse.entries += 1
+            task.save_current_stats()
+        metrics["colony of " + str(size) + " per trial"] = metric((monotonic() - t_start) / n_trials * 1e6, "us",
+                                                                  noise=5.0)
+    task.quit()
+    shutil.rmtree(data_root)
+    return metrics
+
+
+# Spread of the LED train edges played by the waveform player, and how late the last one is. The
+# p99 of a hundred edges would only be the worst scheduling hiccup of the run.
+def suite_stimulus_timing(n_trains=4, frequency=50, on_time=0.005, length=0.5):
+    import StimulusScheduler
+    led_pin = 20
+    period = 1.0 / frequency
+    gpio = SimulatedGPIO()
+    gpio.setup(led_pin, gpio.OUT)
+    player = StimulusScheduler.WaveformPlayer(gpio)
+    waveform = StimulusScheduler.pulse_train(led_pin, on_time, frequency, length)
+    start_time = player.clock()
+    for train in range(n_trains):
+        player.play(waveform, start_time + train * length)
+    rising = [t for (t, level) in gpio.outputs_for(led_pin) if level]
+    errors = [t - (rising[0] + k * period) for k, t in enumerate(rising)]
+    steps = [abs(errors[k + 1] - errors[k]) for k in range(len(errors) - 1)]
+    return {"stimulus edge jitter median": metric(percentile(steps, 0.5) * 1e6, "us", noise=20.0),
+            "stimulus edge jitter p95": metric(percentile(steps, 0.95) * 1e6, "us", noise=500.0,
+                                               relative_noise=1.0),
+            "stimulus drift": metric(abs(errors[-1]) * 1e3, "ms", noise=0.1)}
+
+
+# A whole chamber on the simulated devices: n_visits visits of a mouse with a short head fix each.
+def suite_trial_latency(n_visits=6, data_root="bench_suite_media"):
+    import shutil
+    import Chambers
+    from RFIDFramer import SimulatedSerial, make_frame
+    from VideoRingBuffer import SimulatedCamera
+    config = {"pretrigger_video_seconds": None, "metrics_interval": None, "reward_time": 0.05,
+              "number_of_headfix_rewards": 2, "inter_reward_interval": 0.15, "piezo_duration": 0.05,
+              "entrance_reward_delay_time": 0.1, "skedaddle_time": 0.2, "tag_dedupe_window": 0.1,
+              "cage_id": "S1"}
+    config.update(Chambers.simulated_pins(0))
+    gpio = SimulatedGPIO()
+    serial_port = SimulatedSerial()
+    controller = Chambers.ChamberController([config], None, data_root, gpio, [serial_port],
+                                            [SimulatedCamera(startup_time=0.0, settle_time=0.0)],
+                                            resume_from_journal=False)
+    task = controller.chambers[0]
+    controller.start()
+    tag_times = []
+    contact_times = []
+    for visit in range(n_visits):
+        sleep(0.1)
+        gpio.set_input(task.range_pin, 1)
+        tag_times.append(time())
+        serial_port.send(make_frame("%010X" % 1000))
+        sleep(0.05)
+        contact_times.append(monotonic())
+        gpio.set_input(task.contact_pin, 1)
+        sleep(0.35)
+        gpio.set_input(task.contact_pin, 0)
+        sleep(0.1)
+        gpio.set_input(task.range_pin, 0)
+    sleep(0.2)
+    controller.quit()
+
+    pistons_out = [t for (t, level) in gpio.outputs_for(task.pistons_pin) if level]
+    piston_latencies = [min([t for t in pistons_out if t >= contact_time] or [float("inf")]) - contact_time
+                        for contact_time in contact_times]
+    with open(task.data_full_path) as data_file:
+        entries = [float(line.split("\t")[1]) for line in data_file if line.rstrip("\n").endswith("\tentry")]
+    entry_latencies = [min([t for t in entries if t >= tag_time] or [float("inf")]) - tag_time
+                       for tag_time in tag_times]
+    edges = gpio.outputs_for(task.reward_pin)
+    valve_errors = [abs(t_off - t_on - config["reward_time"])
+                    for (t_on, level_on), (t_off, level_off) in zip(edges, edges[1:]) if level_on and not level_off]
+    shutil.rmtree(data_root)
+    return {"trial contact to pistons max": metric(max(piston_latencies) * 1e3, "ms", noise=0.5),
+            "trial tag to entry saved max": metric(max(entry_latencies) * 1e3, "ms", noise=2.0),
+            "trial reward valve error median": metric(percentile(valve_errors, 0.5) * 1e3, "ms", noise=0.5)}
+
+
+SUITE = (suite_tag_parsing, suite_data_collector, suite_colony, suite_stimulus_timing, suite_trial_latency)
+
+
+def is_better(measured, best):
+    return (measured["value"] > best["value"]) == (measured["better"] == "higher")
+
+
+"""
+Runs parts of the suite, keeping the best of repeats runs of each metric,
+with the spread of the runs (worst - best) and the part that measured it.
+"""
+def measure_suite(repeats=3, parts=SUITE):
+    results = {}
+    for part in parts:
+        runs = {}
+        for run in range(repeats):
+            for name, measured in part().items():
+                runs.setdefault(name, []).append(measured)
+        for name, measured in runs.items():
+            best = measured[0]
+            for other in measured[1:]:
+                if is_better(other, best):
+                    best = other
+            values = [other["value"] for other in measured]
+            best["spread"] = max(values) - min(values)
+            best["part"] = part.__name__
+            results[name] = best
+    return results
+
+
+# The smallest change of a metric that means anything: its noise, its relative noise
+# of the baseline value and the spread of its repeats, now and in the baseline.
+def noise_of(measured, base):
+    return max(measured["noise"], measured.get("relative_noise", 0.0) * abs(base["value"]),
+               measured.get("spread", 0.0), base.get("spread", 0.0))
+
+
+"""
+Compares results with baseline (both metric dicts by name). A metric has
+regressed if it is worse than the baseline by more than tolerance (a
+fraction of the baseline) and by more than its noise. Prints a line per
+metric and returns the names of the regressed ones.
+"""
+def compare_results(results, baseline, tolerance=0.25):
+    regressions = []
+    for name in sorted(set(results) | set(baseline)):
+        if name not in baseline:
+            print ("%-42s %12s %12.3f %-9s new" % (name, "-", results[name]["value"], results[name]["unit"]))
+            continue
+        if name not in results:
+            print ("%-42s %12.3f %12s %-9s not measured" % (name, baseline[name]["value"], "-", baseline[name]["unit"]))
+            continue
+        old = baseline[name]["value"]
+        new = results[name]["value"]
+        worse = new - old if results[name]["better"] == "lower" else old - new
+        change = (new - old) / old * 100 if old else 0.0
+        verdict = ""
+        noise = noise_of(results[name], baseline[name])
+        if worse > tolerance * abs(old) and worse > noise:
+            verdict = "REGRESSION"
+            regressions.append(name)
+        elif -worse > tolerance * abs(old) and -worse > noise:
+            verdict = "better"
+        print ("%-42s %12.3f %12.3f %-9s %+7.1f%% %s" % (name, old, new, results[name]["unit"], change, verdict))
+    return regressions
+
+
+def read_baseline(baseline_path):
+    import json
+    with open(baseline_path) as baseline_file:
+        return json.load(baseline_file)
+
+
+# Written to a temporary name first, so a crash never leaves half a baseline.
+def write_baseline(baseline_path, results):
+    import json
+    import platform
+    baseline = {"created": time(), "machine": platform.node() + " " + platform.machine(),
+                "python": platform.python_version(), "metrics": results}
+    temp_path = baseline_path + ".tmp"
+    with open(temp_path, "w") as baseline_file:
+        json.dump(baseline, baseline_file, indent=1, sort_keys=True)
+    os.replace(temp_path, baseline_path)
+
+
+"""
+Runs the parts of the suite that measured the regressions again, at least
+3 times, keeps the better of the two runs of each metric (the larger
+spread) and returns the names of the metrics that are still regressions.
+"""
+def confirm_regressions(results, baseline, regressions, tolerance=0.25, repeats=3):
+    part_names = set([results[name]["part"] for name in regressions])
+    parts = [part for part in SUITE if part.__name__ in part_names]
+    print ("Running " + ", ".join(sorted(part_names)) + " again to confirm")
+    again = measure_suite(max(repeats, 3), parts)
+    confirmed = {}
+    for name in regressions:
+        measured = results[name]
+        if name in again:
+            if is_better(again[name], measured):
+                measured = dict(again[name])
+            else:
+                measured = dict(measured)
+            measured["spread"] = max(results[name]["spread"], again[name]["spread"])
+        confirmed[name] = measured
+    return compare_results(confirmed, dict([(name, baseline[name]) for name in regressions]), tolerance)
+
+
+"""
+Runs the suite and compares it with the baseline at baseline_path, which
+is written instead if there is none yet or update is set. Returns the
+names of the metrics that regressed, on the first run and on the
+confirming one.
+"""
+def run_suite(baseline_path=BASELINE_PATH, update=False, tolerance=0.25, repeats=3):
+    import platform
+    results = measure_suite(repeats)
+    if update or not os.path.exists(baseline_path):
+        compare_results(results, {})
+        write_baseline(baseline_path, results)
+        print ("Baseline written to " + baseline_path)
+        return []
+    baseline = read_baseline(baseline_path)
+    machine = platform.node() + " " + platform.machine()
+    if baseline["machine"] != machine:
+        print ("The baseline is from " + baseline["machine"] + ", not this machine (" + machine +
+               "), differences may not be regressions")
+    print ("%-42s %12s %12s" % ("metric", "baseline", "now"))
+    regressions = compare_results(results, baseline["metrics"], tolerance)
+    if regressions:
+        regressions = confirm_regressions(results, baseline["metrics"], regressions, tolerance, repeats)
+    if regressions:
+        print (str(len(regressions)) + " regressions: " + ", ".join(regressions))
+    else:
+        print ("No regressions")
+    return regressions
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description="Benchmarks of the task, or the regression suite")
+    parser.add_argument("--suite", action="store_true", help="run the regression suite instead of every benchmark")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file of the regression suite")
+    parser.add_argument("--update", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="fraction a metric may get worse by before it is flagged")
+    parser.add_argument("--repeats", type=int, default=3, help="runs of the suite, the best of each metric is kept")
+    args = parser.parse_args()
+    if args.suite:
+        sys.exit(1 if run_suite(args.baseline, args.update, args.tolerance, args.repeats) else 0)
+    bench_contact_to_piston_latency()
+    bench_idle_cpu()
+    bench_data_collector()
+    bench_event_log()
+    bench_tag_framer()
+    bench_mouse_registry()
+    bench_stimulus_timing()
+    bench_video_compression()
+    bench_video_start()
+    bench_raw_video()
+    bench_analysis()
+    bench_event_stream()
+    bench_startup()
+    bench_metrics()
+    bench_simulator()
+    bench_journal_recovery()
+    bench_chambers()
+    bench_motion_energy()
+    bench_frame_bus()
+    bench_frame_averaging()
+    bench_realtime_process()
+    bench_status_server()
@@ -0,0 +1,289 @@
+__author__ = 'Federico'
+
+import argparse
+import heapq
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import sleep, time
+
+from EventLog import encode_event, encode_tag
+from EventStream import AggregateStore
+from GPIOBackend import get_gpio_backend, SimulatedGPIO
+from HeadFix import Task, load_config
+from Journal import MouseJournal
+from Modules import MouseRegistry
+
+"""
+Several head fixing chambers run by one host.
+
+Every chamber is a HeadFix.Task with its own pins, RFID reader, camera and
+data files, running its loop in its own thread, so a chamber waiting on
+its sensors, its stimuli or its camera never holds up another one. Each has
+its own sensor edges, trial event loop and stimulus player, and only short
+locked steps are shared. The chambers share one MouseRegistry (a mouse can
+go to any of them), with its quickStats and journal files in the day
+folder, and their events are also merged, in time order, into one log:
+
+    <data root>/<MMDD>/quickStats_chambers_<MMDD>.txt
+    <data root>/<MMDD>/journal_chambers_<MMDD>.bin
+    <data root>/<MMDD>/headFix_chambers_<MMDD>.bin
+
+The merged log has the aggregated store format of EventStream.py (read it
+with EventStream.read_store, the chambers are in EventStream.rig_names).
+"""
+
+# Task settings naming a GPIO pin, no two chambers may have the same pin.
+PIN_SETTINGS = ("pistons_pin", "reward_pin", "range_pin", "contact_pin", "led_pin", "stimulus_left_led_pin",
+                "stimulus_center_led_pin", "stimulus_right_led_pin", "piezo_pin")
+
+
+"""
+Raises ValueError if a chamber has no cage_id, or if two chambers would
+use the same cage ID, pin or serial port (a setting left out of a config
+is the Task default, so two chambers leaving it out clash too).
+"""
+def check_chamber_configs(configs, check_serial_ports=True):
+    used = {}
+    for i, config in enumerate(configs):
+        if config.get("cage_id") is None:
+            raise ValueError("Chamber " + str(i) + " has no cage_id")
+        names = PIN_SETTINGS + ("cage_id", "serial_port") if check_serial_ports else PIN_SETTINGS + ("cage_id",)
+        for name in names:
+            if name in PIN_SETTINGS:
+                key = ("pin", config[name]) if name in config else ("pin", "default " + name)
+            else:
+                key = (name, config.get(name))
+            if key in used:
+                raise ValueError("Chambers " + str(used[key]) + " and " + str(i) + " both use " + name +
+                                 " " + str(config.get(name, "(default)")))
+            used[key] = i
+
+
+# Pins of chamber index on a SimulatedGPIO, well away from the real ones and each other.
+def simulated_pins(index):
+    return dict((name, 100 * (index + 1) + k) for k, name in enumerate(PIN_SETTINGS))
+
+
+class ChamberLog:
+    """The stream of one chamber's DataCollector into the MergedEventLog."""
+    def __init__(self, merged, rig):
+        self.merged = merged
+        self.rig = rig
+
+    def write(self, events):
+        self.merged.add(self.rig, events)
+
+    def flush(self):
+        self.merged.write_ready()
+
+    def close(self):
+        self.merged.close_chamber(self.rig)
+
+
+class MergedEventLog:
+    """
+    The events of every chamber in one store, in time order.
+
+    Events wait in a heap until no open chamber can still hand over an older
+    one. A chamber's events come in order, at most max_delay seconds after
+    they happened (its DataCollector flush_interval and then some), so
+    nothing older than its latest event, or than clock() - max_delay when
+    it is idle, can still come from it. Every flush_interval seconds the
+    events older than that for every chamber are written. Anything that
+    still comes too late is written straight away and counted in late_events.
+    """
+    def __init__(self, store_path, max_delay=2.0, flush_interval=0.5, clock=time):
+        self.store = AggregateStore(store_path)
+        self.max_delay = max_delay
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        # (epoch, rig, tag, code, argument) waiting to be written
+        self.pending = []
+        # rig -> latest epoch of the open chambers
+        self.latest = {}
+        self.written_until = float("-inf")
+        self.events_written = 0
+        self.late_events = 0
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="MergedEventLog")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def chamber_log(self, name):
+        with self.lock:
+            rig = self.store.rig_number(name)
+            self.latest[rig] = float("-inf")
+        return ChamberLog(self, rig)
+
+    # DataCollector (tag, time_event, datetime, event) tuples of chamber rig.
+    def add(self, rig, events):
+        with self.lock:
+            late = []
+            for tag, time_event, date_time, event in events:
+                code, argument = encode_event(event)
+                record = (time_event, rig, encode_tag(tag), code, argument)
+                if time_event < self.written_until:
+                    late.append(record)
+                else:
+                    heapq.heappush(self.pending, record)
+                if rig in self.latest:
+                    self.latest[rig] = max(self.latest[rig], time_event)
+            if late:
+                self.late_events += len(late)
+                late.sort()
+                self.store.write(late)
+                self.events_written += len(late)
+
+    def write_ready(self, everything=False):
+        with self.lock:
+            if everything or not self.latest:
+                watermark = float("inf")
+            else:
+                oldest_possible = self.clock() - self.max_delay
+                watermark = min([max(latest, oldest_possible) for latest in self.latest.values()])
+            ready = []
+            while self.pending and self.pending[0][0] <= watermark:
+                ready.append(heapq.heappop(self.pending))
+            if ready:
+                self.store.write(ready)
+                self.events_written += len(ready)
+                self.written_until = max(self.written_until, ready[-1][0])
+
+    # A chamber that is closed no longer holds the others back.
+    def close_chamber(self, rig):
+        with self.lock:
+            self.latest.pop(rig, None)
+        self.write_ready()
+
+    def run(self):
+        while self.running:
+            sleep(self.flush_interval)
+            self.write_ready()
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.write_ready(everything=True)
+        self.store.close()
+
+
+class ChamberController:
+    """
+    Runs one Task per config in chamber_configs, each in its own thread.
+    shared_config has the settings of every chamber (a chamber's own config
+    wins), every chamber needs its own cage_id, pins and serial port.
+    gpio is the GPIO backend of the host, serial_ports and cameras (one per
+    chamber) replace the real devices, i.e. with simulated ones. task_class
+    makes the chambers, HeadFix.Task by default.
+    switch_interval, if given, is how often (in seconds) Python switches
+    between threads, so a chamber busy with Python code holds the others up
+    for less than that (sys.setswitchinterval, 5 ms by default).
+    """
+    def __init__(self, chamber_configs, shared_config=None, data_root_path="/media/Cage1/", gpio=None,
+                 serial_ports=None, cameras=None, resume_from_journal=True, switch_interval=0.001,
+                 task_class=Task, clock=time):
+        configs = []
+        for config in chamber_configs:
+            # the Task adds the MMDD folder straight after the root path
+            settings = {"data_root_path": os.path.join(data_root_path, "")}
+            if shared_config is not None:
+                settings.update(shared_config)
+            settings.update(config)
+            # the files of the shared registry are the controller's
+            settings["resume_from_journal"] = False
+            settings["confirm_paths"] = False
+            if len(chamber_configs) > 1:
+                # pigpio plays one waveform at a time for the whole host
+                settings["hardware_timed_stimuli"] = False
+            configs.append(settings)
+        check_chamber_configs(configs, serial_ports is None)
+        n_chambers = len(configs)
+        if serial_ports is None:
+            serial_ports = [None] * n_chambers
+        if cameras is None:
+            cameras = [None] * n_chambers
+        if gpio is None:
+            gpio = get_gpio_backend(configs[0].get("gpio_backend", "rpi"))
+        self.gpio = gpio
+        self.switch_interval = switch_interval
+
+        date_now = datetime.fromtimestamp(clock()).strftime("%m%d")
+        self.day_path = os.path.join(data_root_path, date_now, "")
+        if not os.path.exists(self.day_path):
+            os.makedirs(self.day_path)
+        self.mice = MouseRegistry(self.day_path + "quickStats_chambers_" + date_now + ".txt")
+        if resume_from_journal:
+            resumed = self.mice.restore(MouseJournal(self.day_path + "journal_chambers_" + date_now + ".bin"))
+            if resumed:
+                print ("Resumed " + str(resumed) + " mice from the journal")
+        self.event_log = MergedEventLog(self.day_path + "headFix_chambers_" + date_now + ".bin", clock=clock)
+
+        # The chambers are set up at the same time, each sets up its own devices in parallel too.
+        with ThreadPoolExecutor(max_workers=n_chambers) as executor:
+            chambers = [executor.submit(task_class, gpio, config, serial_port, camera, self.mice,
+                                        self.event_log.chamber_log(config["cage_id"]))
+                        for config, serial_port, camera in zip(configs, serial_ports, cameras)]
+            self.chambers = [chamber.result() for chamber in chambers]
+        self.threads = []
+        # (cage_id, exception) of the chambers whose loop stopped with an error
+        self.errors = []
+
+    def start(self):
+        if self.switch_interval is not None:
+            sys.setswitchinterval(self.switch_interval)
+        for task in self.chambers:
+            thread = threading.Thread(target=self.run_chamber, args=(task,), name="Chamber-" + str(task.cage_id))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def run_chamber(self, task):
+        try:
+            task.start()
+        except Exception as e:
+            print ("Chamber " + str(task.cage_id) + " stopped: " + repr(e))
+            self.errors.append((task.cage_id, e))
+
+    # Stops every chamber and closes the shared files.
+    def quit(self):
+        for task in self.chambers:
+            task.quit()
+        self.mice.close()
+        self.event_log.close()
+
+
+# Usage: python Chambers.py chambers.json [--data-path /media/Host1/] [--simulated]
+# chambers.json: {"shared": {settings of every chamber}, "chambers": [{"cage_id": "C1", "range_pin": 22, ...}, ...]}
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Several head fixing chambers on one host")
+    parser.add_argument("config", help="JSON file with the shared settings and one config per chamber")
+    parser.add_argument("--data-path", default="/media/Cage1/", help="folder the MMDD folders go in")
+    parser.add_argument("--simulated", action="store_true", help="simulated GPIO, RFID readers and cameras")
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    chamber_configs = config["chambers"]
+    gpio = serial_ports = cameras = None
+    if args.simulated:
+        from RFIDFramer import SimulatedSerial
+        from VideoRingBuffer import SimulatedCamera
+        gpio = SimulatedGPIO()
+        serial_ports = [SimulatedSerial() for config in chamber_configs]
+        cameras = [SimulatedCamera() for config in chamber_configs]
+    controller = ChamberController(chamber_configs, config.get("shared"), args.data_path, gpio, serial_ports, cameras)
+    controller.start()
+    try:
+        while True:
+            sleep(1.0)
+    except KeyboardInterrupt:
+        controller.quit()
+        controller.gpio.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+__author__ = 'Federico'
+
+import os
+import struct
+
+"""
+Fixed-width binary version of the DataCollector event log.
+
+File layout:
+    header  16 bytes: magic "HFEVLOG1", uint32 record size, uint32 reserved
+    records 20 bytes each, little endian:
+        tag    uint64   mouse tag (0 for session events)
+        epoch  float64  time of the event, seconds since the epoch
+        event  uint16   event code, see EVENT_CODES
+        arg    int16    event argument: reward/stimulus number, LED side, -1 if none
+
+The records can be memory-mapped straight into a NumPy structured array
+with read_events(), so analysis never parses lines in Python.
+"""
+
+MAGIC = b"HFEVLOG1"
+HEADER = struct.Struct("<8sII")
+RECORD = struct.Struct("<QdHh")
+
+# Event names as written in the text files and their codes.
+EVENT_CODES = {
+    'unknown': 0,
+    'SeshStart': 1,
+    'SeshEnd': 2,
+    'entry': 3,
+    'exit': 4,
+    'check+': 5,
+    'complete': 6,
+    'reward': 7,
+    'stimulus-': 8,
+    'light-': 9,
+    'abort': 10,
+    'moving': 11,
+}
+EVENT_NAMES = dict((code, name) for name, code in EVENT_CODES.items())
+
+# Events followed by a number: reward0, stimulus-2...
+NUMBERED_EVENTS = ('reward', 'stimulus-')
+# Events followed by the LED side: light-L, light-C, light-R
+SIDE_EVENTS = ('light-',)
+
+
+def encode_event(event):
+    if event in EVENT_CODES:
+        return EVENT_CODES[event], -1
+    for prefix in NUMBERED_EVENTS:
+        if event.startswith(prefix) and event[len(prefix):].isdigit():
+            return EVENT_CODES[prefix], int(event[len(prefix):])
+    for prefix in SIDE_EVENTS:
+        if event.startswith(prefix) and len(event) == len(prefix) + 1:
+            return EVENT_CODES[prefix], ord(event[-1])
+    return EVENT_CODES['unknown'], -1
+
+
+def decode_event(code, arg):
+    name = EVENT_NAMES.get(int(code), 'unknown')
+    if name in NUMBERED_EVENTS:
+        return name + str(int(arg))
+    if name in SIDE_EVENTS:
+        return name + chr(int(arg))
+    return name
+
+
+def encode_tag(tag):
+    try:
+        return int(tag)
+    except ValueError:
+        return 0
+
+
+def record_dtype():
+    import numpy as np
+    return np.dtype([('tag', '<u8'), ('epoch', '<f8'), ('event', '<u2'), ('arg', '<i2')])
+
+
+class BinaryEventFile:
+    """
+    Appends DataCollector events, (tag, time_event, datetime, event) tuples, as binary records.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = open(file_path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(HEADER.pack(MAGIC, RECORD.size, 0))
+
+    def write(self, events):
+        records = [RECORD.pack(encode_tag(tag), time_event, *encode_event(event))
+                   for (tag, time_event, date_time, event) in events]
+        self.file.write(b''.join(records))
+
+    def flush(self, fsync=False):
+        self.file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+"""
+Memory-maps a binary event file as a NumPy structured array with fields
+tag, epoch, event and arg. Nothing is read until the fields are used.
+"""
+def read_events(file_path):
+    import numpy as np
+    with open(file_path, 'rb') as f:
+        magic, record_size, reserved = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or record_size != RECORD.size:
+        raise ValueError("Not a binary event log: " + file_path)
+    dtype = record_dtype()
+    n_records = (os.path.getsize(file_path) - HEADER.size) // dtype.itemsize
+    if n_records == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(file_path, dtype=dtype, mode='r', offset=HEADER.size, shape=(n_records,))
+
+
+"""
+Boolean mask of the records matching every given filter.
+event is an event name like 'entry', 'reward' or 'light-'.
+"""
+def select(records, tag=None, event=None, start=None, end=None):
+    import numpy as np
+    mask = np.ones(len(records), dtype=bool)
+    if tag is not None:
+        mask &= records['tag'] == encode_tag(tag)
+    if event is not None:
+        mask &= records['event'] == EVENT_CODES[event]
+    if start is not None:
+        mask &= records['epoch'] >= start
+    if end is not None:
+        mask &= records['epoch'] < end
+    return mask
+
+
+"""
+Splits one line of a text log into (tag, epoch, event).
+Both column orders that have been used are accepted:
+    tag     epoch   event       datetime
+    tag     epoch   datetime    event
+The datetime column is the one that looks like "YYYY-MM-DD HH:MM:SS".
+Returns None for a line that cannot be read, i.e. one cut short by a crash.
+"""
+def parse_text_line(line):
+    fields = line.rstrip('\r\n').split('\t')
+    if len(fields) < 4:
+        return None
+    if is_datetime(fields[2]):
+        event = fields[3]
+    else:
+        event = fields[2]
+    try:
+        epoch = float(fields[1])
+    except ValueError:
+        return None
+    if not event:
+        return None
+    return fields[0], epoch, event
+
+
+def is_datetime(field):
+    return len(field) >= 19 and field[4] == '-' and field[13] == ':'
+
+
+"""
+Converts a legacy text log into a binary event file, returns the number of
+records. Lines that cannot be read (a torn last line after a crash, a
+damaged epoch) are skipped and counted, and the count printed.
+"""
+def convert_text_log(text_path, binary_path):
+    n_records = 0
+    n_skipped = 0
+    if os.path.exists(binary_path):
+        os.remove(binary_path)
+    binary_file = BinaryEventFile(binary_path)
+    with open(text_path) as text_file:
+        batch = []
+        for line in text_file:
+            parsed = parse_text_line(line)
+            if parsed is None:
+                if line.strip():
+                    n_skipped += 1
+                continue
+            tag, epoch, event = parsed
+            batch.append((tag, epoch, None, event))
+            if len(batch) >= 4096:
+                binary_file.write(batch)
+                n_records += len(batch)
+                batch = []
+        binary_file.write(batch)
+        n_records += len(batch)
+    binary_file.close()
+    if n_skipped:
+        print ("Skipped " + str(n_skipped) + " malformed lines of " + text_path)
+    return n_records
+
+
+if __name__ == "__main__":
+    import sys
+    # Usage: python EventLog.py headFix_XX_MMDD.txt [headFix_XX_MMDD.bin]
+    text_path = sys.argv[1]
+    if len(sys.argv) > 2:
+        binary_path = sys.argv[2]
+    else:
+        binary_path = os.path.splitext(text_path)[0] + ".bin"
+    print ("Converted " + str(convert_text_log(text_path, binary_path)) + " events to " + binary_path)
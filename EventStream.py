@@ -0,0 +1,452 @@
+__author__ = 'Federico'
+
+import heapq
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+from time import monotonic, sleep, time
+
+from EventLog import encode_event, encode_tag
+from EventWriter import FlushRequest
+
+"""
+Streaming the events of several rigs to one aggregator.
+
+Each rig's DataCollector hands its events to an EventStream, which sends
+them in batches over TCP (address is (host, port)) or a Unix socket
+(address is a path) to an EventAggregator. Every batch is acknowledged,
+while the aggregator cannot be reached batches go to a spool file next to
+the data file and are sent again, in order, once it is back.
+
+Protocol, little endian:
+    rig -> aggregator, once per connection:
+        HELLO   magic "HFSTRM01", uint16 length of the rig name, the name in utf-8
+    rig -> aggregator, for every batch:
+        BATCH   uint64 session, uint32 number of events, then the events
+        EVENT   uint64 sequence number, uint64 tag, float64 epoch, uint16 event code, int16 argument
+    aggregator -> rig, after every batch:
+        ACK     uint64 sequence number of the next event it expects from that session
+Sequence numbers count the events of a session (one run of the rig) from 0,
+so an event that arrives twice (sent, then replayed from the spool because
+the acknowledgement was lost) is only stored once.
+"""
+
+MAGIC = b"HFSTRM01"
+HELLO = struct.Struct("<8sH")
+BATCH = struct.Struct("<QI")
+EVENT = struct.Struct("<QQdHh")
+ACK = struct.Struct("<Q")
+
+# Aggregated store: header like EventLog's, then tag, epoch, event, arg, rig records.
+STORE_MAGIC = b"HFAGGR01"
+STORE_HEADER = struct.Struct("<8sII")
+STORE_RECORD = struct.Struct("<QdHhI")
+
+
+def open_socket(address, timeout):
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+    sock = socket.create_connection(address, timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def receive_exactly(sock, n_bytes):
+    data = b""
+    while len(data) < n_bytes:
+        chunk = sock.recv(n_bytes - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data += chunk
+    return data
+
+
+class EventStream:
+    """
+    Sends DataCollector events to an EventAggregator from its own thread.
+
+    write(events) takes (tag, time_event, datetime, event) tuples, numbers
+    them and puts them in a bounded queue; if the queue is full it waits for
+    room (counted in stall_count), so the memory used stays bounded and no
+    event is dropped. The sender takes up to max_batch events at a time.
+    When the aggregator cannot be reached they are appended to spool_path
+    and the connection is retried every retry_interval seconds; once it is
+    back the spool is sent first, so the aggregator still sees every
+    session in order.
+    """
+    def __init__(self, address, rig_name, spool_path, queue_size=4096, max_batch=512,
+                 retry_interval=1.0, timeout=5.0):
+        self.address = address
+        self.rig_name = rig_name
+        self.spool_path = spool_path
+        self.max_batch = max_batch
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        # a new session every run, from the clock so it does not repeat across restarts
+        self.session = int(time() * 1e6)
+        self.next_seq = 0
+
+        self.queue = queue.Queue(queue_size)
+        self.stall_count = 0
+        self.events_sent = 0
+        self.events_spooled = 0
+        self.sock = None
+        self.last_attempt = None
+        # batches left in the spool from a previous run are sent too
+        self.spooled = os.path.exists(spool_path) and os.path.getsize(spool_path) > 0
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="EventStream")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, events):
+        for tag, time_event, date_time, event in events:
+            code, argument = encode_event(event)
+            record = EVENT.pack(self.next_seq, encode_tag(tag), time_event, code, argument)
+            self.next_seq += 1
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.stall_count += 1
+                self.queue.put(record)
+
+    # Blocks until every event written so far has been acknowledged or spooled.
+    def flush(self):
+        if not self.running:
+            return
+        request = FlushRequest(False)
+        self.queue.put(request)
+        request.done.wait()
+
+    def close(self):
+        if not self.running:
+            return
+        self.running = False
+        self.queue.put(None)
+        self.thread.join()
+
+    def connected(self):
+        return self.sock is not None
+
+    def run(self):
+        while True:
+            # Wake up now and then to retry the connection while there is a spool.
+            timeout = self.retry_interval if self.spooled else None
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = FlushRequest(False)
+            records = []
+            requests = []
+            stop = False
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, FlushRequest):
+                    requests.append(item)
+                else:
+                    records.append(item)
+                if len(records) >= self.max_batch:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if self.sock is None:
+                self.connect()
+            if self.sock is not None and self.spooled:
+                self.replay()
+            if records:
+                batch = BATCH.pack(self.session, len(records)) + b"".join(records)
+                if self.sock is None or self.spooled or not self.send(batch):
+                    self.spool(batch)
+                    self.events_spooled += len(records)
+                else:
+                    self.events_sent += len(records)
+            for request in requests:
+                request.done.set()
+            if stop:
+                self.disconnect()
+                return
+
+    def connect(self):
+        now = monotonic()
+        if self.last_attempt is not None and now - self.last_attempt < self.retry_interval:
+            return
+        self.last_attempt = now
+        try:
+            self.sock = open_socket(self.address, self.timeout)
+            name = self.rig_name.encode("utf-8")
+            self.sock.sendall(HELLO.pack(MAGIC, len(name)) + name)
+        except OSError:
+            self.disconnect()
+
+    def disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+    # Sends one batch and waits for its acknowledgement, returns False (and disconnects) if that failed.
+    def send(self, batch):
+        try:
+            self.sock.sendall(batch)
+            receive_exactly(self.sock, ACK.size)
+            return True
+        except OSError:
+            self.disconnect()
+            return False
+
+    def spool(self, batch):
+        with open(self.spool_path, "ab") as spool_file:
+            spool_file.write(batch)
+        self.spooled = True
+
+    # Sends the spool batch by batch, removes it once all of it is acknowledged.
+    def replay(self):
+        with open(self.spool_path, "rb") as spool_file:
+            while True:
+                header = spool_file.read(BATCH.size)
+                if len(header) < BATCH.size:
+                    break
+                session, n_events = BATCH.unpack(header)
+                body = spool_file.read(n_events * EVENT.size)
+                if len(body) < n_events * EVENT.size:
+                    # cut short by a crash while it was being written
+                    break
+                if not self.send(header + body):
+                    return
+                self.events_sent += n_events
+        os.remove(self.spool_path)
+        self.spooled = False
+
+
+class AggregateStore:
+    # Appends STORE_RECORDs to the aggregated file, rig names go to <path>.rigs, one per line.
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = open(file_path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(STORE_HEADER.pack(STORE_MAGIC, STORE_RECORD.size, 0))
+        self.rigs = []
+        if os.path.exists(file_path + ".rigs"):
+            with open(file_path + ".rigs") as rigs_file:
+                self.rigs = [line.rstrip("\n") for line in rigs_file]
+
+    def rig_number(self, rig_name):
+        if rig_name not in self.rigs:
+            self.rigs.append(rig_name)
+            with open(self.file_path + ".rigs", "a") as rigs_file:
+                rigs_file.write(rig_name + "\n")
+        return self.rigs.index(rig_name)
+
+    def write(self, events):
+        self.file.write(b"".join([STORE_RECORD.pack(tag, epoch, code, argument, rig)
+                                  for (epoch, rig, tag, code, argument) in events]))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class EventAggregator:
+    """
+    Receives the streams of many rigs and merges them into one store,
+    ordered by event time.
+
+    Events wait in a heap until every rig heard from in the last
+    rig_timeout seconds has sent something at least as recent, then they
+    are written out in time order every flush_interval seconds. Events
+    older than what has already been written (i.e. from a rig replaying a
+    long spool) are still stored, right away, and counted in late_events.
+    """
+    def __init__(self, address, store_path, rig_timeout=10.0, flush_interval=0.5):
+        self.address = address
+        self.store = AggregateStore(store_path)
+        self.rig_timeout = rig_timeout
+        self.flush_interval = flush_interval
+
+        self.lock = threading.Lock()
+        # (epoch, rig, tag, code, argument) waiting to be written
+        self.pending = []
+        # (rig, session) -> next sequence number expected
+        self.next_seq = {}
+        # rig -> [latest epoch, monotonic time last heard from]
+        self.rig_state = {}
+        self.written_until = float("-inf")
+        self.events_received = 0
+        self.events_written = 0
+        self.duplicates = 0
+        self.late_events = 0
+        self.connections = set()
+
+        aggregator = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                aggregator.handle_connection(self.request)
+
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.remove(address)
+            self.server = socketserver.ThreadingUnixStreamServer(address, Handler)
+        else:
+            socketserver.ThreadingTCPServer.allow_reuse_address = True
+            self.server = socketserver.ThreadingTCPServer(address, Handler)
+            # port 0 picks a free port
+            self.address = self.server.server_address
+        self.server.daemon_threads = True
+
+        self.running = True
+        self.server_thread = threading.Thread(target=self.server.serve_forever, name="EventAggregatorServer")
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.flush_thread = threading.Thread(target=self.run_flush, name="EventAggregatorFlush")
+        self.flush_thread.daemon = True
+        self.flush_thread.start()
+
+    def handle_connection(self, sock):
+        with self.lock:
+            self.connections.add(sock)
+        try:
+            magic, name_length = HELLO.unpack(receive_exactly(sock, HELLO.size))
+            if magic != MAGIC:
+                return
+            rig_name = receive_exactly(sock, name_length).decode("utf-8")
+            with self.lock:
+                rig = self.store.rig_number(rig_name)
+                # a rig that just connected holds the other rigs' events back until it sends its own
+                self.rig_state.setdefault(rig, [float("-inf"), 0.0])[1] = monotonic()
+            while self.running:
+                session, n_events = BATCH.unpack(receive_exactly(sock, BATCH.size))
+                body = receive_exactly(sock, n_events * EVENT.size)
+                next_seq = self.add_batch(rig, session, body)
+                sock.sendall(ACK.pack(next_seq))
+        except (OSError, struct.error):
+            return
+        finally:
+            with self.lock:
+                self.connections.discard(sock)
+
+    def add_batch(self, rig, session, body):
+        with self.lock:
+            if not self.running:
+                raise ConnectionError("Aggregator closed")
+            expected = self.next_seq.get((rig, session), 0)
+            state = self.rig_state.setdefault(rig, [float("-inf"), 0.0])
+            late = []
+            for seq, tag, epoch, code, argument in EVENT.iter_unpack(body):
+                if seq < expected:
+                    self.duplicates += 1
+                    continue
+                expected = seq + 1
+                self.events_received += 1
+                if epoch < self.written_until:
+                    self.late_events += 1
+                    late.append((epoch, rig, tag, code, argument))
+                else:
+                    heapq.heappush(self.pending, (epoch, rig, tag, code, argument))
+                state[0] = max(state[0], epoch)
+            state[1] = monotonic()
+            self.next_seq[(rig, session)] = expected
+            if late:
+                late.sort()
+                self.store.write(late)
+                self.events_written += len(late)
+            return expected
+
+    # Writes out, in order, every event no active rig can still send something older than.
+    def write_ready(self, everything=False):
+        with self.lock:
+            now = monotonic()
+            active = [latest for (latest, heard) in self.rig_state.values() if now - heard < self.rig_timeout]
+            if everything or not active:
+                watermark = float("inf")
+            else:
+                watermark = min(active)
+            ready = []
+            while self.pending and self.pending[0][0] <= watermark:
+                ready.append(heapq.heappop(self.pending))
+            if ready:
+                self.store.write(ready)
+                self.events_written += len(ready)
+                self.written_until = max(self.written_until, ready[-1][0])
+
+    def run_flush(self):
+        while self.running:
+            self.write_ready()
+            sleep(self.flush_interval)
+
+    def close(self):
+        with self.lock:
+            self.running = False
+            for sock in self.connections:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        self.server.shutdown()
+        self.server.server_close()
+        self.flush_thread.join()
+        self.write_ready(everything=True)
+        self.store.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+def store_dtype():
+    import numpy as np
+    return np.dtype([('tag', '<u8'), ('epoch', '<f8'), ('event', '<u2'), ('arg', '<i2'), ('rig', '<u4')])
+
+
+"""
+Memory-maps an aggregated store like EventLog.read_events, with an extra
+rig field (its position in rig_names(file_path)).
+"""
+def read_store(file_path):
+    import numpy as np
+    with open(file_path, 'rb') as f:
+        magic, record_size, reserved = STORE_HEADER.unpack(f.read(STORE_HEADER.size))
+    if magic != STORE_MAGIC or record_size != STORE_RECORD.size:
+        raise ValueError("Not an aggregated event store: " + file_path)
+    dtype = store_dtype()
+    n_records = (os.path.getsize(file_path) - STORE_HEADER.size) // dtype.itemsize
+    if n_records == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(file_path, dtype=dtype, mode='r', offset=STORE_HEADER.size, shape=(n_records,))
+
+
+def rig_names(file_path):
+    with open(file_path + ".rigs") as rigs_file:
+        return [line.rstrip("\n") for line in rigs_file]
+
+
+if __name__ == "__main__":
+    import sys
+    # Usage: python EventStream.py store.bin host port   or   python EventStream.py store.bin /path/to/socket
+    if len(sys.argv) > 3:
+        address = (sys.argv[2], int(sys.argv[3]))
+    else:
+        address = sys.argv[2]
+    aggregator = EventAggregator(address, sys.argv[1])
+    print ("Aggregating events on " + str(aggregator.address) + " into " + sys.argv[1])
+    try:
+        while True:
+            sleep(10.0)
+            print (str(aggregator.events_written) + " events stored, " + str(aggregator.late_events) + " late")
+    except KeyboardInterrupt:
+        aggregator.close()
@@ -0,0 +1,149 @@
+__author__ = 'Federico'
+
+import queue
+import threading
+from time import monotonic
+
+
+class FlushRequest:
+    # Put in the queue to ask the worker to flush everything before it.
+    def __init__(self, fsync):
+        self.fsync = fsync
+        self.done = threading.Event()
+
+
+class BackgroundWriter:
+    """
+    Moves event writing off the trial's timing-critical path.
+    put() only appends to a bounded queue, a worker thread takes whatever is
+    waiting, hands it to write_batch(events) in one go and calls flush(fsync)
+    according to the flush policy:
+        flush_interval - longest time written events may sit in the file buffer (0 = every batch)
+        fsync          - also fsync on every flush, not only on close
+    When the queue is full put() blocks until there is room, so no event is lost.
+    If writing fails with an OSError (i.e. the USB disk went away for a moment)
+    the failure is logged, counted in write_errors (and in metrics, a
+    Metrics.Metrics, if given) and the batch is kept and written again, with the
+    events that came after it, every retry_interval seconds until it works.
+    Until then flush() raises the error.
+    """
+    def __init__(self, write_batch, flush, queue_size=4096, max_batch=512, flush_interval=1.0, fsync=False,
+                 retry_interval=1.0, metrics=None):
+        self.write_batch = write_batch
+        self.flush_file = flush
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.retry_interval = retry_interval
+
+        self.queue = queue.Queue(queue_size)
+        # number of events handed to write_batch
+        self.events_written = 0
+        # number of times put() had to wait for room in the queue
+        self.stall_count = 0
+        # error of the worker's last write, None once a write works again, re-raised by flush()
+        self.error = None
+        # number of failed writes
+        self.write_errors = 0
+        self.error_counter = None
+        if metrics is not None:
+            self.error_counter = metrics.counter("event_write_errors_total", "Failed writes of the saved events")
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="BackgroundWriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.stall_count += 1
+            self.queue.put(event)
+
+    # Blocks until every event put so far is written and flushed.
+    def flush(self, fsync=False):
+        if not self.running:
+            return
+        request = FlushRequest(fsync)
+        self.queue.put(request)
+        request.done.wait()
+        if self.error is not None:
+            raise self.error
+
+    # Writes everything left, the thread stops even if that fails.
+    def close(self):
+        if not self.running:
+            return
+        try:
+            self.flush(fsync=True)
+        finally:
+            self.running = False
+            self.queue.put(None)
+            self.thread.join()
+
+    def write_failed(self, error):
+        if self.error is None:
+            print ("Could not write the events, will try again: " + repr(error))
+        self.error = error
+        self.write_errors += 1
+        if self.error_counter is not None:
+            self.error_counter.inc()
+
+    def run(self):
+        last_flush = monotonic()
+        dirty = False
+        # events whose write failed, written again before the ones after them
+        batch = []
+        while True:
+            timeout = None
+            if batch or self.error is not None:
+                timeout = self.retry_interval
+            elif dirty:
+                timeout = max(0.0, last_flush + self.flush_interval - monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = FlushRequest(self.fsync)
+
+            # Take everything that is already waiting, up to max_batch more events.
+            batch_size = len(batch) + self.max_batch
+            requests = []
+            stop = False
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, FlushRequest):
+                    requests.append(item)
+                else:
+                    batch.append(item)
+                if len(batch) >= batch_size:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            try:
+                if batch:
+                    self.write_batch(batch)
+                    self.events_written += len(batch)
+                    batch = []
+                    dirty = True
+                if requests or (dirty and monotonic() - last_flush >= self.flush_interval):
+                    self.flush_file(self.fsync or any(request.fsync for request in requests))
+                    last_flush = monotonic()
+                    dirty = False
+                if self.error is not None:
+                    print ("Events written again after " + str(self.write_errors) + " failed writes")
+                    self.error = None
+            except OSError as e:
+                self.write_failed(e)
+            except Exception as e:
+                # not the disk, writing the same events again would fail the same way
+                self.write_failed(e)
+                batch = []
+            for request in requests:
+                request.done.set()
+            if stop:
+                return
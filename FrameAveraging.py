@@ -0,0 +1,278 @@
+__author__ = 'Federico'
+
+import hashlib
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from EventLog import EVENT_CODES, EVENT_NAMES, NUMBERED_EVENTS, SIDE_EVENTS
+from RawVideo import INDEXED_EVENTS, RawVideo, SessionIndex, parse_video_name
+
+"""
+Stimulus-locked averages of the brain camera videos of a session.
+
+For every stimulus event with a video (see RawVideo.SessionIndex) the frames
+from before frames before it to after frames after it are taken, as dF/F:
+each pixel divided by its mean over the baseline frames just before the
+event, minus one. The windows are summed per mouse and event type
+('stimulus', 'light-L', 'light-R'...; 'reward' too if asked for) and
+averaged over the trials.
+
+Each video is done in its own task of a process pool, reading its windows
+straight from the memmapped .raw file a chunk of events at a time, so no
+more than about max_chunk_bytes is held per process whatever the length of
+the video. The sums of every video are cached in cache_dir, by video and
+options, with the size and modification time of the video and the frames of
+its events: a rerun only does the videos that changed or got new events,
+and going back to earlier options finds their results still there.
+"""
+
+
+class AveragingOptions:
+    """
+    before, after  - frames in the window before and after the event frame
+    baseline       - frames just before the event whose mean is F0, None for all before frames
+    channel        - colour channel used (0 red, 1 green, 2 blue)
+    binning        - average binning x binning pixels into one, 1 keeps the full resolution
+    events         - event kinds averaged, out of RawVideo.INDEXED_EVENTS
+    max_chunk_bytes - about the most memory the windows being worked on may take, per process
+    """
+    def __init__(self, before=30, after=60, baseline=None, channel=1, binning=2, events=('stimulus-', 'light-'),
+                 max_chunk_bytes=64 << 20):
+        if baseline is None:
+            baseline = before
+        if not 0 < baseline <= before:
+            raise ValueError("The baseline needs 1 to before (" + str(before) + ") frames, not " + str(baseline))
+        for event in events:
+            if event not in INDEXED_EVENTS:
+                raise ValueError("Only " + ", ".join(INDEXED_EVENTS) + " events can be averaged, not " + event)
+        self.before = before
+        self.after = after
+        self.baseline = baseline
+        self.channel = channel
+        self.binning = binning
+        self.events = tuple(events)
+        self.max_chunk_bytes = max_chunk_bytes
+
+    def window_frames(self):
+        return self.before + self.after + 1
+
+    # Everything the results depend on, max_chunk_bytes does not change them.
+    def key(self):
+        return json.dumps([self.before, self.after, self.baseline, self.channel, self.binning, list(self.events)])
+
+
+# 'stimulus' for stimulus-N (and 'reward' for rewardN), 'light-L' for light-L
+def event_type(code, arg):
+    name = EVENT_NAMES.get(int(code), 'unknown')
+    if name in NUMBERED_EVENTS:
+        return name.rstrip('-')
+    if name in SIDE_EVENTS:
+        return name + chr(int(arg))
+    return name
+
+
+"""
+dF/F windows of the events starting at frames starts of video, summed,
+in chunks of events. Returns the (window, height, width) float64 sum.
+"""
+def sum_windows(video, starts, options):
+    n_window = options.window_frames()
+    b = options.binning
+    height = video.height - video.height % b
+    width = video.width - video.width % b
+    total = np.zeros((n_window, height // b, width // b), dtype=np.float64)
+    # the channel as uint8 and float32, and the dF/F of the binned frames
+    bytes_per_event = n_window * height * width * 5 + n_window * total[0].size * 4
+    chunk_events = max(1, options.max_chunk_bytes // bytes_per_event)
+    offsets = np.arange(n_window)
+    for first in range(0, len(starts), chunk_events):
+        chunk = starts[first:first + chunk_events]
+        frame_numbers = (chunk[:, None] + offsets).ravel()
+        frames = video.frames[frame_numbers, :height, :width, options.channel]
+        if b > 1:
+            # adding up the b x b strided views is several times quicker than reshape().mean()
+            binned = frames[:, ::b, ::b].astype(np.float32)
+            for dy in range(b):
+                for dx in range(b):
+                    if dy or dx:
+                        binned += frames[:, dy::b, dx::b]
+            binned *= 1.0 / (b * b)
+            block = binned.reshape(len(chunk), n_window, height // b, width // b)
+        else:
+            block = frames.astype(np.float32).reshape(len(chunk), n_window, height, width)
+        f0 = block[:, options.before - options.baseline:options.before].mean(axis=1, keepdims=True)
+        # a pixel dark all baseline long would divide by nothing
+        np.maximum(f0, 1.0, out=f0)
+        block /= f0
+        block -= 1.0
+        total += block.sum(axis=0, dtype=np.float64)
+    return total
+
+
+"""
+Pool task: the windows of one video, from its cache file if it is up to date.
+task is (video path, resolution, frame rate, event frames, event types,
+options, cache path, cache key). Returns (video path, tag, {type: (sum, n_events)},
+events whose window does not fit in the video, whether it came from the cache).
+"""
+def average_video(task):
+    video_path, resolution, frame_rate, frames, types, options, cache_path, key = task
+    cached = load_video_cache(cache_path, key)
+    if cached is not None:
+        sums, skipped = cached
+        return video_path, parse_video_name(video_path)[0], sums, skipped, True
+
+    video = RawVideo(video_path, resolution, frame_rate)
+    frames = np.asarray(frames, dtype=np.int64)
+    types = np.asarray(types)
+    fits = (frames - options.before >= 0) & (frames + options.after < video.n_frames)
+    sums = {}
+    for kind in sorted(set(types[fits].tolist())):
+        starts = frames[fits & (types == kind)] - options.before
+        sums[kind] = (sum_windows(video, starts, options).astype(np.float32), len(starts))
+    skipped = int(np.count_nonzero(~fits))
+    save_video_cache(cache_path, key, sums, skipped)
+    return video_path, video.tag, sums, skipped, False
+
+
+def load_video_cache(cache_path, key):
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with np.load(cache_path) as cache:
+            if str(cache['key']) != key:
+                return None
+            sums = {}
+            for kind, count in zip(cache['types'].tolist(), cache['counts'].tolist()):
+                sums[kind] = (cache['sum_' + kind], int(count))
+            return sums, int(cache['skipped'])
+    except (IOError, KeyError, ValueError):
+        return None
+
+
+def save_video_cache(cache_path, key, sums, skipped):
+    # written to a temporary name first so a crash never leaves half a file
+    temp_path = cache_path + ".tmp.npz"
+    kinds = sorted(sums)
+    arrays = dict(('sum_' + kind, sums[kind][0]) for kind in kinds)
+    np.savez(temp_path, key=np.array(key), types=np.array(kinds, dtype=str),
+             counts=np.array([sums[kind][1] for kind in kinds], dtype=np.int64), skipped=np.array(skipped), **arrays)
+    os.replace(temp_path, cache_path)
+
+
+class FrameAverages:
+    """
+    Trial-averaged dF/F around the events of the session in log_path (text or
+    binary), with its videos in video_dir. update() does what is not cached
+    yet, average(tag, kind) is then the (window, height, width) mean dF/F of
+    mouse tag around the events of kind, frame options.before being the event.
+    """
+    def __init__(self, log_path, video_dir, options=None, cache_dir=None, resolution=(256, 256), frame_rate=30,
+                 processes=None):
+        if options is None:
+            options = AveragingOptions()
+        self.options = options
+        self.video_dir = video_dir
+        if cache_dir is None:
+            cache_dir = os.path.join(video_dir, "frame_averages")
+        self.cache_dir = cache_dir
+        self.resolution = resolution
+        self.frame_rate = frame_rate
+        self.processes = processes
+        self.index = SessionIndex(log_path, video_dir, resolution, frame_rate)
+        # (tag, kind) -> [sum of the dF/F windows, number of events]
+        self.sums = {}
+        self.events_skipped = 0
+        self.videos_computed = 0
+        self.videos_cached = 0
+
+    def tasks(self):
+        records = self.index.records
+        wanted = np.isin(records['event'], [EVENT_CODES[event] for event in self.options.events])
+        options_key = self.options.key()
+        options_digest = hashlib.sha1(options_key.encode()).hexdigest()[:12]
+        tasks = []
+        for v, video_path in enumerate(self.index.video_paths):
+            events = self.index.indexed(wanted & (self.index.video_of_event == v))
+            if not len(events):
+                continue
+            frames = self.index.frame_of_event[events].tolist()
+            types = [event_type(code, arg) for code, arg in zip(records['event'][events], records['arg'][events])]
+            name = os.path.basename(video_path)[:-len(".raw")]
+            stat = os.stat(video_path)
+            key = json.dumps([name, stat.st_size, stat.st_mtime, list(self.resolution), self.frame_rate,
+                              options_key, frames, types])
+            cache_path = os.path.join(self.cache_dir, name + "_" + options_digest + ".npz")
+            tasks.append((video_path, self.resolution, self.frame_rate, frames, types, self.options,
+                          cache_path, key))
+        return tasks
+
+    # Returns the number of videos that had to be read (the others came from the cache).
+    def update(self):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tasks = self.tasks()
+        self.sums = {}
+        self.events_skipped = 0
+        self.videos_computed = 0
+        self.videos_cached = 0
+        if len(tasks) > 1 and self.processes != 1:
+            pool = multiprocessing.Pool(self.processes)
+            try:
+                self.store_results(pool.imap_unordered(average_video, tasks))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            self.store_results(map(average_video, tasks))
+        return self.videos_computed
+
+    def store_results(self, results):
+        for video_path, tag, sums, skipped, from_cache in results:
+            for kind, (total, count) in sums.items():
+                entry = self.sums.get((tag, kind))
+                if entry is None:
+                    self.sums[(tag, kind)] = [total.astype(np.float64), count]
+                else:
+                    entry[0] += total
+                    entry[1] += count
+            self.events_skipped += skipped
+            if from_cache:
+                self.videos_cached += 1
+            else:
+                self.videos_computed += 1
+
+    # (tag, kind) of every average there is.
+    def keys(self):
+        return sorted(self.sums)
+
+    def n_events(self, tag, kind):
+        return self.sums[(tag, kind)][1]
+
+    def average(self, tag, kind):
+        total, count = self.sums[(tag, kind)]
+        return (total / count).astype(np.float32)
+
+    """
+    Map of the mean dF/F from start to stop frames after the event (the
+    whole after window by default), i.e. the response to the stimulus.
+    """
+    def response_map(self, tag, kind, start=0, stop=None):
+        if stop is None:
+            stop = self.options.after + 1
+        before = self.options.before
+        return self.average(tag, kind)[before + start:before + stop].mean(axis=0)
+
+
+if __name__ == "__main__":
+    import sys
+    # Usage: python FrameAveraging.py headFix_C1_0705.txt /media/Cage1/0705/C1/Videos
+    averages = FrameAverages(sys.argv[1], sys.argv[2])
+    print ("Read " + str(averages.update()) + " videos, " + str(averages.videos_cached) + " were cached")
+    print ("tag\tevent\tevents\tpeak dF/F")
+    for tag, kind in averages.keys():
+        print (str(tag) + "\t" + kind + "\t" + str(averages.n_events(tag, kind)) + "\t" +
+               "%.4f" % averages.response_map(tag, kind).max())
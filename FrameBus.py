@@ -0,0 +1,251 @@
+__author__ = 'Federico'
+
+import struct
+from multiprocessing import resource_tracker, shared_memory
+from time import sleep, monotonic
+
+import numpy as np
+
+"""
+Camera frames shared with other processes (live preview, online analysis,
+a compressor) without copying them to each one.
+
+The producer writes every frame once into a ring of fixed-size slots in a
+shared-memory segment, every frame gets a sequence number. Consumers, in
+any process, attach to the segment by name and read the frames in place as
+NumPy arrays. The producer never waits for anyone: a consumer that falls
+more than a ring behind skips to the newest frame and counts the frames it
+missed, and the producer sees how far behind each consumer is in the
+consumer table.
+
+Segment layout:
+    header     32 bytes: magic "HFFBUS01", uint32 capacity, frame_bytes,
+               max_consumers, reserved, int64 sequence number of the next frame
+    slot_seqs  int64[capacity]   sequence number of the frame in each slot, -1 while it is written
+    timestamps float64[capacity] time of the frame in each slot
+    consumers  int64[max_consumers, 3] active (0/1), next sequence number to read, frames dropped
+    frames     uint8[capacity, frame_bytes], from a 64 byte boundary
+A frame read in place may be overwritten while it is being used once the
+producer has gone round the ring, still_valid(seq) tells afterwards.
+"""
+
+MAGIC = b"HFFBUS01"
+HEADER = struct.Struct("<8sIIIIq")
+NEXT_SEQ_OFFSET = 24
+
+
+def layout(capacity, frame_bytes, max_consumers):
+    slot_seqs = HEADER.size
+    timestamps = slot_seqs + 8 * capacity
+    consumers = timestamps + 8 * capacity
+    frames = consumers + 8 * 3 * max_consumers
+    frames = (frames + 63) // 64 * 64
+    return slot_seqs, timestamps, consumers, frames, frames + capacity * frame_bytes
+
+
+"""
+Maps the existing segment called name. Before Python 3.13 (track=False)
+attaching also registers the segment with the resource tracker, to be
+removed when the process ends (or twice, for processes sharing a tracker),
+but it belongs to the producer, so the registration is left out.
+"""
+def attach(name):
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class SharedRing:
+    """NumPy views of the parts of a frame bus segment."""
+    def __init__(self, memory, capacity, frame_bytes, max_consumers):
+        self.memory = memory
+        self.capacity = capacity
+        self.frame_bytes = frame_bytes
+        self.max_consumers = max_consumers
+        slot_seqs, timestamps, consumers, frames, size = layout(capacity, frame_bytes, max_consumers)
+        buf = memory.buf
+        self.next_seq = np.ndarray((1,), dtype=np.int64, buffer=buf, offset=NEXT_SEQ_OFFSET)
+        self.slot_seqs = np.ndarray((capacity,), dtype=np.int64, buffer=buf, offset=slot_seqs)
+        self.timestamps = np.ndarray((capacity,), dtype=np.float64, buffer=buf, offset=timestamps)
+        self.consumers = np.ndarray((max_consumers, 3), dtype=np.int64, buffer=buf, offset=consumers)
+        self.frames = np.ndarray((capacity, frame_bytes), dtype=np.uint8, buffer=buf, offset=frames)
+
+    # Oldest frame that is safe to read: the slot after it may be being overwritten right now.
+    def oldest_seq(self):
+        return max(0, int(self.next_seq[0]) - self.capacity + 1)
+
+    # The views have to go before the segment can be closed.
+    def release(self):
+        self.next_seq = self.slot_seqs = self.timestamps = self.consumers = self.frames = None
+        self.memory.close()
+
+
+class FrameBus:
+    """
+    The producer side: creates the segment (name, or one picked by the
+    system, see self.name) with room for capacity frames of frame_bytes and
+    up to max_consumers consumers. publish() never blocks.
+    """
+    def __init__(self, frame_bytes, capacity=30, name=None, max_consumers=8):
+        size = layout(capacity, frame_bytes, max_consumers)[-1]
+        memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+        memory.buf[:HEADER.size] = HEADER.pack(MAGIC, capacity, frame_bytes, max_consumers, 0, 0)
+        self.ring = SharedRing(memory, capacity, frame_bytes, max_consumers)
+        self.ring.slot_seqs[:] = -1
+        self.ring.consumers[:] = 0
+        self.name = memory.name
+        self.frame_bytes = frame_bytes
+        self.capacity = capacity
+
+    def publish(self, frame, timestamp):
+        ring = self.ring
+        seq = int(ring.next_seq[0])
+        slot = seq % self.capacity
+        ring.slot_seqs[slot] = -1
+        ring.frames[slot] = np.frombuffer(frame, dtype=np.uint8)
+        ring.timestamps[slot] = timestamp
+        ring.slot_seqs[slot] = seq
+        ring.next_seq[0] = seq + 1
+        return seq
+
+    # (consumer id, frames behind, frames dropped) of every attached consumer.
+    def consumer_lags(self):
+        next_seq = int(self.ring.next_seq[0])
+        return [(i, next_seq - int(cursor), int(dropped))
+                for i, (active, cursor, dropped) in enumerate(self.ring.consumers) if active]
+
+    # Consumers more than max_lag frames behind.
+    def slow_consumers(self, max_lag=None):
+        if max_lag is None:
+            max_lag = self.capacity // 2
+        return [i for i, lag, dropped in self.consumer_lags() if lag > max_lag]
+
+    # Removes the segment, consumers still attached keep their mapping until they close.
+    def close(self):
+        if self.ring is None:
+            return
+        memory = self.ring.memory
+        self.ring.release()
+        self.ring = None
+        memory.unlink()
+
+
+class FrameBusReader:
+    """
+    A consumer of the frame bus called name, from the newest frame on.
+    consumer_id is its row in the consumer table, each consumer needs its own.
+    """
+    def __init__(self, name, consumer_id=0, poll_interval=0.001):
+        memory = attach(name)
+        magic, capacity, frame_bytes, max_consumers, reserved, next_seq = HEADER.unpack_from(memory.buf)
+        if magic != MAGIC:
+            memory.close()
+            raise ValueError(name + " is not a frame bus")
+        if not 0 <= consumer_id < max_consumers:
+            memory.close()
+            raise ValueError("Consumer id " + str(consumer_id) + " out of range, the bus has " +
+                             str(max_consumers) + " consumers")
+        self.ring = SharedRing(memory, capacity, frame_bytes, max_consumers)
+        self.capacity = capacity
+        self.frame_bytes = frame_bytes
+        self.consumer_id = consumer_id
+        self.poll_interval = poll_interval
+        self.seq = int(self.ring.next_seq[0])
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self.update_table()
+        self.ring.consumers[consumer_id, 0] = 1
+
+    def update_table(self):
+        self.ring.consumers[self.consumer_id, 1] = self.seq
+        self.ring.consumers[self.consumer_id, 2] = self.frames_dropped
+
+    # Waits until frame seq exists or timeout seconds go by, returns whether it does.
+    def wait_for(self, seq, timeout):
+        deadline = monotonic() + timeout
+        while seq >= self.ring.next_seq[0]:
+            if monotonic() >= deadline:
+                return False
+            sleep(self.poll_interval)
+        return True
+
+    """
+    The next frame as (seq, timestamp, frame), frame a read-only view of its
+    slot (frame_bytes uint8), None if none comes within timeout seconds.
+    Falling more than a ring behind skips to the newest frame. Views still
+    held when the reader is closed keep it from unmapping the segment.
+    """
+    def next_frame(self, timeout=1.0):
+        if not self.wait_for(self.seq, timeout):
+            return None
+        ring = self.ring
+        while True:
+            if self.seq < ring.oldest_seq():
+                newest = int(ring.next_seq[0]) - 1
+                self.frames_dropped += newest - self.seq
+                self.seq = newest
+            slot = self.seq % self.capacity
+            timestamp = float(ring.timestamps[slot])
+            # the producer marks a slot before writing it, so the timestamp is good if the mark is still ours
+            if ring.slot_seqs[slot] == self.seq:
+                break
+        seq = self.seq
+        self.seq += 1
+        self.frames_read += 1
+        self.update_table()
+        frame = ring.frames[slot]
+        frame.flags.writeable = False
+        return seq, timestamp, frame
+
+    # Whether frame seq, read in place, had not been overwritten yet. Counts it as dropped if it had.
+    def still_valid(self, seq):
+        if seq >= self.ring.oldest_seq() and self.ring.slot_seqs[seq % self.capacity] == seq:
+            return True
+        self.frames_dropped += 1
+        self.update_table()
+        return False
+
+    def close(self):
+        if self.ring is None:
+            return
+        self.ring.consumers[self.consumer_id, 0] = 0
+        self.ring.release()
+        self.ring = None
+
+
+# Usage: python FrameBus.py <bus name> [--consumer 7]
+# Follows the bus and prints the frame rate, frames dropped and mean of each second.
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Watch the frames on a frame bus")
+    parser.add_argument("name", help="name of the frame bus, the frame_bus_name setting of the task")
+    parser.add_argument("--consumer", type=int, default=7, help="row of the consumer table to use")
+    args = parser.parse_args(argv)
+    reader = FrameBusReader(args.name, args.consumer)
+    try:
+        while True:
+            start = monotonic()
+            n_frames = 0
+            dropped = reader.frames_dropped
+            total = 0.0
+            while monotonic() - start < 1.0:
+                entry = reader.next_frame()
+                if entry is None:
+                    continue
+                seq, timestamp, frame = entry
+                total += float(frame[::97].mean())
+                if reader.still_valid(seq):
+                    n_frames += 1
+                # no views may be left when the reader is closed
+                entry = frame = None
+            print (str(n_frames) + " frames/s, " + str(reader.frames_dropped - dropped) + " dropped, mean " +
+                   "%.1f" % (total / max(1, n_frames)))
+    except KeyboardInterrupt:
+        reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+__author__ = 'Federico'
+
+import threading
+from time import monotonic, sleep
+
+
+def get_gpio_backend(name="rpi"):
+    """
+    Returns an object with the RPi.GPIO interface.
+    "rpi" is the real header on the Raspberry Pi, "simulated" is an in-memory
+    stand-in that lets the task run on any computer.
+    """
+    if name == "rpi":
+        import RPi.GPIO as GPIO
+        return GPIO
+    elif name == "simulated":
+        return SimulatedGPIO()
+    else:
+        raise ValueError("Unknown GPIO backend: " + str(name))
+
+
+class SimulatedGPIO:
+    """
+    Simulated GPIO header with the same calls as RPi.GPIO.
+    Inputs are driven with set_input(), every output change is kept in
+    output_log as (time, pin, level) so timings can be checked afterwards.
+    """
+    # Same constants as RPi.GPIO
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+
+    def __init__(self, clock=monotonic):
+        # function returning the current time in seconds
+        self.clock = clock
+        self.mode = None
+        # direction of every pin that has been set up
+        self.directions = {}
+        # current level of every pin
+        self.levels = {}
+        # pin -> (edge type, list of callbacks)
+        self.event_detects = {}
+        # (time, pin, level) for every output change
+        self.output_log = []
+        self.lock = threading.Lock()
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None, initial=None):
+        self.directions[pin] = direction
+        if initial is not None:
+            self.levels[pin] = int(bool(initial))
+        else:
+            self.levels.setdefault(pin, 0)
+
+    def input(self, pin):
+        return self.levels.get(pin, 0)
+
+    def output(self, pin, value):
+        level = int(bool(value))
+        with self.lock:
+            self.levels[pin] = level
+            self.output_log.append((self.clock(), pin, level))
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        if pin in self.event_detects:
+            raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+        self.event_detects[pin] = (edge, [])
+        if callback is not None:
+            self.add_event_callback(pin, callback)
+
+    def add_event_callback(self, pin, callback):
+        self.event_detects[pin][1].append(callback)
+
+    def remove_event_detect(self, pin):
+        self.event_detects.pop(pin, None)
+
+    def cleanup(self, pin=None):
+        if pin is None:
+            self.directions.clear()
+            self.event_detects.clear()
+        else:
+            self.directions.pop(pin, None)
+            self.event_detects.pop(pin, None)
+
+    # Simulation side: what the sensors would do.
+    def set_input(self, pin, level):
+        level = int(bool(level))
+        previous = self.levels.get(pin, 0)
+        self.levels[pin] = level
+        if level == previous or pin not in self.event_detects:
+            return
+        edge, callbacks = self.event_detects[pin]
+        if edge == self.BOTH or (edge == self.RISING and level) or (edge == self.FALLING and not level):
+            for callback in list(callbacks):
+                callback(pin)
+
+    # Makes the pin chatter like a mechanical contact before settling on level.
+    def bounce_input(self, pin, level, n_bounces=3, bounce_interval=0.0002):
+        for i in range(n_bounces):
+            self.set_input(pin, level)
+            sleep(bounce_interval)
+            self.set_input(pin, not level)
+            sleep(bounce_interval)
+        self.set_input(pin, level)
+
+    def outputs_for(self, pin):
+        return [(t, level) for (t, p, level) in self.output_log if p == pin]
@@ -2,13 +2,41 @@ __author__ = 'Federico'
 
 
 from Modules import *
-import RPi.GPIO as GPIO
+from GPIOBackend import get_gpio_backend, SimulatedGPIO
+from RFIDFramer import SimulatedSerial
+from VideoRingBuffer import SimulatedCamera
+from SensorInput import EdgeInput
+from StimulusScheduler import get_waveform_player, single_pulse
+from TrialEngine import TrialEngine
+from EventStream import EventStream
+from Metrics import Metrics, MetricsExporter, pulse_width
+from Journal import MouseJournal
+from MotionEnergy import SustainedMotion
+from StatusServer import StatusProcess
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
 import os
 
 class Task:
-    def __init__(self):
-        # Array that will hold all the Mice as Mouse objects.
-        self.mice = []
+    """
+    config: dict of settings replacing the defaults below, by attribute name,
+    i.e. {"cage_id": "C1", "reward_time": 0.3}, see load_config.
+    gpio, serial_port and camera replace the real devices, i.e. with simulated ones.
+    mice, a MouseRegistry, and stream, where the events also go (like an
+    EventStream), are given when the task is one of several chambers, see Chambers.py.
+    """
+    def __init__(self, gpio=None, config=None, serial_port=None, camera=None, mice=None, stream=None):
+        # GPIO backend, the real header (or gpio_backend) unless another one is given.
+        self.gpio = gpio
+
+        # Registry that will hold all the Mice as Mouse objects, by tag.
+        # A registry that is given belongs to whoever gave it, with its own files.
+        self.owns_mice = mice is None
+        if mice is None:
+            mice = MouseRegistry()
+        self.mice = mice
+        self.stream = stream
         # Mouse object that holds the mouse currently inside.
         self.currentMouse = Mouse("0123456789")
 
@@ -56,36 +84,154 @@ class Task:
         self.light_stimulation_frequency = 10
         # duration of the piezo on time
         self.piezo_duration = 1.0
-
-        # sets up the GPIO headers each for their respective functionality.
-        self.setup_gpio_lines()
+        # play the stimuli with the pigpio daemon when it is running (only one chamber per host can); the
+        # daemon plays one wave at a time, so actions overlapping in the timeline are software timed anyway
+        self.hardware_timed_stimuli = False
+        # time a sensor edge must be stable for before it counts, in seconds
+        self.sensor_debounce_time = 0.005
+        # the same tag read again within this time, in seconds, is only counted once
+        self.tag_dedupe_window = 1.0
+        # release the mouse early if the head bar contact is lost during a head fix
+        self.abort_on_contact_loss = False
+
+        # video
+        # None records plain .raw files, VideoCompression.CompressionOptions(...)
+        # compresses them while recording, losslessly by default, or i.e. only the
+        # green channel binned 2x2 with CompressionOptions(channel=1, binning=2)
+        self.video_compression = None
+        # seconds of video kept in memory before each head fix, None only records from the head fix on;
+        # with it the camera records all the time and frame 0 of a video is that long before the fixation,
+        # the <name>_timestamps.txt file next to it gives the time of each frame
+        self.pretrigger_video_seconds = None
+        # mean grey-level change per frame above which the mouse counts as moving, see MotionEnergy.py;
+        # None turns off the live motion analysis (it needs pretrigger_video_seconds); calibrate it on
+        # the rig first, MotionEnergy.py prints the energy of still and moving frames
+        self.motion_threshold = None
+        # release the mouse early once it has been moving (3/4 of the frames) for this long, in seconds, None never does
+        self.motion_release_time = None
+        # save a 'moving' event after a head fix whose video has more than this fraction of moving frames
+        self.motion_flag_fraction = None
+        # also share the live frames with other processes (preview, analysis) on a FrameBus of this name,
+        # None does not (it needs pretrigger_video_seconds), see FrameBus.py
+        self.frame_bus_name = None
+        # frames the FrameBus keeps, in seconds, a consumer further behind skips ahead
+        self.frame_bus_seconds = 1.0
+
+        # data writing
+        # write events from a background thread instead of inside the trial
+        self.background_data_writer = True
+        # print every event to the console as well
+        self.print_events = False
+        # longest time, in seconds, an event may wait before being flushed to the data file
+        self.data_flush_interval = 1.0
+        # also save the events as fixed-width binary records (headFix_XX_MMDD.bin)
+        self.save_binary_events = False
+        # carry on with the mice of an earlier run today (journal_XX_MMDD.bin), after a crash or a restart
+        self.resume_from_journal = True
+        # journal records between snapshots, see Journal.py
+        self.journal_snapshot_interval = 1000
+        # also wait for the journal to reach the disk, so it survives a power cut and not only a crash
+        self.journal_fsync = False
+        # also send the events to an EventStream.EventAggregator, i.e. ("192.168.0.10", 5555),
+        # while it cannot be reached they wait in headFix_XX_MMDD.spool
+        self.event_stream_address = None
 
         # where to put the text file and video files
         # Format: /media/Cage1/MMDD/ID_type/Videos/*
         #         /media/Cage1/MMDD/ID_type/TextFiles/*
-        self.data_file_path = "/media/Cage1/"
+        self.data_root_path = "/media/Cage1/"
+        self.data_file_path = ""
         self.textfile_path = "TextFiles/"
-        self.video_path = "Videos/"
+        self.videofile_path = "Videos/"
+        self.video_path = ""
         self.data_full_path = ""
+        self.binary_full_path = ""
         self.stats_full_path = ""
         self.data_file_name = "headFix_"
         self.stats_file_name = "quickStats_"
+        # cage ID used in the paths, asked on the console if None
+        self.cage_id = None
+        # ask on the console whether the paths are right
+        self.confirm_paths = True
 
         #serial port, "/dev/ttyAMA0" for built-in serial port
         #  "/dev/ttyUSB0" for USB-to-Serial
         self.serial_port = "/dev/ttyAMA0"
-        # Call the function that sets up what the files will be called.
-        self.setup_full_path_data()
-
-        # set up all the Modules
-        # The RFID reader class
-        self.reader = TagReader(self.serial_port)
-
-        # The Camera class
-        self.camera = BrainCamera()
+        # "rpi" or "simulated", when no GPIO backend is given
+        self.gpio_backend = "rpi"
+        # longest time, in seconds, to wait for the camera's auto exposure to settle
+        self.camera_settle_timeout = 2.0
+        # real-time mode: the sensors, pistons, rewards and stimuli run in a process of their own
+        # and every data file is written by another one, see RealtimeProcess.py
+        self.realtime_process = False
+        # core the real-time control process is pinned to, None leaves it to the system
+        self.realtime_core = None
+        # SCHED_FIFO priority (1-99) of the real-time control process, None keeps the normal one (it needs root)
+        self.realtime_priority = None
+        # serve the recent events and the counts of the mice here, from a process of its own,
+        # i.e. ("127.0.0.1", 8080) or "/tmp/headfix_C1.sock", None does not, see StatusServer.py
+        self.status_address = None
+        # number of recent events the status server keeps
+        self.status_events = 1000
+        # seconds between writes of the timing metrics file (TextFiles/metrics_XX.prom), None to not write it
+        self.metrics_interval = 10.0
+
+        # clocks, replaced by a virtual one to simulate a session (see Simulator.py)
+        # monotonic clock for the sensors, the stimuli and the timings
+        self.clock = monotonic
+        # epoch clock for the times saved in the data file
+        self.wall_clock = time
+
+        # Settings from a config file or the command line replace the defaults above.
+        if config is not None:
+            self.apply_config(config)
+
+        self.setup(serial_port, camera)
+
+    """
+    Sets up all the Modules. The RFID reader, the camera and the GPIO lines
+    each take a while, so they are set up at the same time while the paths
+    are worked out (and confirmed on the console, if asked to).
+    serial_port and camera replace the real devices, i.e. with simulated ones.
+    """
+    def setup(self, serial_port=None, camera=None):
+        if self.gpio is None:
+            self.gpio = get_gpio_backend(self.gpio_backend)
+        self.reward_waveform = single_pulse(self.reward_pin, self.reward_time)
+        self.setup_metrics()
+        if self.owns_mice:
+            self.mice.set_metrics(self.metrics)
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            # The RFID reader class
+            reader = executor.submit(self.make_reader, serial_port)
+            # The Camera class
+            brain_camera = executor.submit(self.make_camera, camera)
+            gpio_ready = executor.submit(self.setup_gpio)
+            # Call the function that sets up what the files will be called.
+            self.setup_full_path_data()
+            if self.resume_from_journal and self.owns_mice:
+                self.resume_mice()
+            self.reader = reader.result()
+            self.camera = brain_camera.result()
+            gpio_ready.result()
+        self.reader.start_listener()
+        if not self.camera.exposure_settled:
+            print ("The camera exposure had not settled after " + str(self.camera_settle_timeout) + " s")
+
+        # The status server, with the board the events and the mice are published on
+        self.status_server = None
+        self.status_board = None
+        if self.status_address is not None:
+            self.status_server = StatusProcess(self.status_address, self.cage_id, self.status_events)
+            self.status_board = self.status_server.board
+            self.mice.set_status(self.status_board)
 
         # The data collector/writer
-        self.collector = DataCollector(self.data_full_path)
+        self.collector = self.make_collector()
+        self.metrics_exporter = None
+        if self.metrics_interval:
+            self.metrics_exporter = MetricsExporter(self.metrics, self.metrics_full_path, self.metrics_interval)
 
         # The light stimulus class for the 3 LEDs, setups 3 more gpio lines depending on arguments.
         self.light_stimulus = LightStimulus(self.stimulus_left_led_pin,
@@ -93,15 +239,127 @@ class Task:
                                             self.stimulus_right_led_pin,
                                             self.stimulus_led_on_time,
                                             self.length_of_light_stimulus_train,
-                                            self.light_stimulation_frequency)
+                                            self.light_stimulation_frequency,
+                                            self.gpio,
+                                            self.player,
+                                            self.metrics)
 
 
         # A simple stimulus
-        self.piezo_stimulus = SimpleStimulus(self.piezo_pin, self.piezo_duration)
-
-
-
+        self.piezo_stimulus = SimpleStimulus(self.piezo_pin, self.piezo_duration, self.gpio, self.player, self.metrics)
+
+        # Runs the head fix timeline while watching the sensors.
+        # Mouse leaving the chamber always stops the trial, losing head bar contact only if asked to.
+        sensor_policies = {(self.range_pin, 0): 'abort'}
+        if self.abort_on_contact_loss:
+            sensor_policies[(self.contact_pin, 0)] = 'abort'
+        self.trial_engine = TrialEngine({'reward': self.reward_action,
+                                         'light': self.light_action,
+                                         'stimulus': self.stimulus_action,
+                                         'camera_start': self.camera_start_action,
+                                         'camera_stop': self.camera_stop_action,
+                                         'led': self.led_action},
+                                        self.sensors, sensor_policies, self.make_event_loop())
+
+        # self.clock time the pistons last went back in, None before the first head fix
+        self.headfix_end_time = None
+
+        # Watches the live motion energy during head fixes, to release a struggling mouse early.
+        self.motion_release = None
+        if self.camera.motion is not None and self.motion_release_time is not None:
+            self.motion_release = SustainedMotion(self.motion_threshold, self.motion_release_time,
+                                                  self.release_moving_mouse)
+            self.camera.motion.add_listener(self.motion_release)
+
+    # Timings of the real-time paths, see Metrics.
+    def setup_metrics(self):
+        self.metrics = Metrics()
+        self.contact_to_piston = self.metrics.histogram("contact_to_piston_seconds",
+                                                        "Head bar contact edge to pistons out")
+        self.range_to_exit = self.metrics.histogram("range_to_exit_seconds",
+                                                    "Tag out of range edge to the exit event saved")
+        self.valve_open_time = self.metrics.histogram("reward_valve_open_seconds",
+                                                      "Time the water valve was actually open")
+        self.valve_error = self.metrics.histogram("reward_valve_error_seconds",
+                                                  "Difference between the valve open time and reward_time")
+        self.camera_start_time = self.metrics.histogram("camera_start_seconds",
+                                                        "Time camera.start_recording takes")
+        self.trial_time = self.metrics.histogram("trial_seconds", "Entry to exit of a mouse",
+                                                 bounds=(1, 3, 10, 30, 60, 120, 300, 600, 1800, 3600))
+        self.headfix_time = self.metrics.histogram("headfix_seconds", "Pistons out to released",
+                                                   bounds=(1, 3, 10, 20, 30, 40, 60, 120, 300))
+        self.entries = self.metrics.counter("entries_total", "Mice in the chamber")
+        self.headfixes = self.metrics.counter("headfixes_total", "Head fixes")
+        self.aborted_headfixes = self.metrics.counter("aborted_headfixes_total", "Head fixes cut short")
+        self.moving_headfixes = self.metrics.counter("moving_headfixes_total", "Head fixes flagged for motion")
+        self.rewards = self.metrics.counter("rewards_total", "Water rewards")
+
+    # Brings back the mice of an earlier run today from the journal.
+    def resume_mice(self):
+        journal = MouseJournal(self.journal_full_path, self.journal_snapshot_interval, self.journal_fsync)
+        resumed = self.mice.restore(journal)
+        if resumed:
+            print ("Resumed " + str(resumed) + " mice from " + self.journal_full_path)
+        if journal.bad_records or journal.truncated_bytes:
+            print ("Skipped " + str(journal.bad_records) + " damaged journal records and " +
+                   str(journal.truncated_bytes) + " bytes of a torn one")
+
+    def setup_gpio(self):
+        # sets up the GPIO headers each for their respective functionality.
+        self.setup_gpio_lines()
 
+        # Edge events for the contact and range pins, so nothing has to poll them.
+        self.sensors = self.make_sensors()
+
+        # Plays the valve, LED and piezo pulses against absolute deadlines
+        # (hardware timed when the pigpio daemon is running).
+        self.player = self.make_player()
+
+    # The devices, each made by its own method so a simulation can replace them.
+    def make_reader(self, serial_port=None):
+        return TagReader(self.serial_port, self.tag_dedupe_window, serial_port, self.wall_clock, metrics=self.metrics)
+
+    def make_camera(self, camera=None):
+        return BrainCamera(self.video_compression, self.pretrigger_video_seconds, camera, self.camera_settle_timeout,
+                           self.motion_threshold, self.metrics, self.frame_bus_name, self.frame_bus_seconds)
+
+    def make_collector(self):
+        stream = self.stream
+        if stream is None and self.event_stream_address is not None:
+            stream = EventStream(self.event_stream_address, self.cage_id,
+                                 self.data_full_path[:-len(".txt")] + ".spool")
+        return DataCollector(self.data_full_path,
+                             background=self.background_data_writer,
+                             echo=self.print_events,
+                             flush_interval=self.data_flush_interval,
+                             binary_file_path=self.binary_full_path if self.save_binary_events else None,
+                             stream=stream,
+                             metrics=self.metrics,
+                             clock=self.wall_clock,
+                             status=self.status_board)
+
+    def make_sensors(self):
+        return EdgeInput(self.gpio, [self.contact_pin, self.range_pin], self.sensor_debounce_time, self.clock)
+
+    def make_player(self):
+        return get_waveform_player(self.gpio, self.clock, self.hardware_timed_stimuli)
+
+    # Event loop for the trial engine, None for a new real-time one.
+    def make_event_loop(self):
+        return None
+
+    # Replaces the settings named in config (a dict, i.e. from load_config) with its values.
+    def apply_config(self, config):
+        for name, value in config.items():
+            if not hasattr(self, name):
+                raise ValueError("Unknown setting: " + name)
+            if name == "video_compression" and isinstance(value, dict):
+                from VideoCompression import CompressionOptions
+                value = CompressionOptions(**value)
+            elif isinstance(value, list):
+                # JSON has no tuples, i.e. for ["192.168.0.10", 5555]
+                value = tuple(value)
+            setattr(self, name, value)
 
     def start(self):
         self.collector.save_start_session()
@@ -122,207 +380,312 @@ class Task:
             self.save_current_stats()
 
     def tag_reader_loop(self):
-        while(self.reader.getBufferSize() < 16):
-            sleep(self.cpu_rest_time)
-        tag = self.reader.readTag()
+        # The reader thread only hands over tags with a good checksum.
+        tag, read_time = self.reader.wait_for_tag()
         return tag
 
     def run_trial(self):
+        trial_start = self.clock()
         self.collector.save_mouse_entry(self.currentMouse.tag)
         self.currentMouse.entries += 1
+        self.entries.inc()
 
         # Delays the entrance reward for some time.
-        t_start_trial = time()
-        while(time()-t_start_trial < self.entrance_reward_delay_time):
-            # If we manage to get mouse contact get out of here immediately!
-            if GPIO.input(self.contact_pin):
-                break
-            # Mouse left the chamber before the 2 seconds!
-            elif GPIO.input(self.range_pin) == 0:
-                self.collector.save_mouse_exit(self.currentMouse.tag)
-                return
-            else:
-                sleep(self.cpu_rest_time)
+        # If we manage to get mouse contact get out of here immediately!
+        pin, edge_time = self.sensors.wait_for([(self.contact_pin, 1), (self.range_pin, 0)],
+                                               self.entrance_reward_delay_time)
+        # Mouse left the chamber before the 2 seconds!
+        if pin == self.range_pin:
+            self.collector.save_mouse_exit(self.currentMouse.tag)
+            self.range_to_exit.observe_since(edge_time, self.clock)
+            self.trial_time.observe_since(trial_start, self.clock)
+            return
 
         # Mouse does not have contact, give him his entrance reward.
-        if not GPIO.input(self.contact_pin):
+        if not self.sensors.level(self.contact_pin):
             # Check if they are still allowed rewards.
             if (self.currentMouse.entrance_rewards < self.maximum_entrance_rewards):
                 self.dispense_reward()
                 self.currentMouse.entrance_rewards += 1
+                # queued for the journal straight away, so the cap still holds if the task is restarted
+                self.mice.mark_changed(self.currentMouse)
 
 
         # At this point we just wait for head fixation.
         while True:
+            pin, edge_time = self.sensors.wait_for([(self.contact_pin, 1), (self.range_pin, 0)])
             # Mouse made contact!
-            if GPIO.input(self.contact_pin):
-                self.headfix_loop()
+            if pin == self.contact_pin:
+                self.headfix_loop(edge_time)
             # Mouse left the chamber!
-            elif GPIO.input(self.range_pin) == 0:
+            else:
                 self.collector.save_mouse_exit(self.currentMouse.tag)
+                self.range_to_exit.observe_since(edge_time, self.clock)
+                self.trial_time.observe_since(trial_start, self.clock)
                 return
-            else:
-                sleep(self.cpu_rest_time)
 
-    # Loop which runs once a mouse has had head contact
-    def headfix_loop(self):
+    # Loop which runs once a mouse has had head contact, at contact_time on self.clock
+    def headfix_loop(self, contact_time=None):
         # Fire the pistons
-        GPIO.output(self.pistons_pin, True)
+        self.gpio.output(self.pistons_pin, True)
+        # A mouse that kept contact through the last release is fixed again on that same,
+        # old contact edge: the time since it is not a latency.
+        if contact_time is not None and (self.headfix_end_time is None or contact_time > self.headfix_end_time):
+            self.contact_to_piston.observe_since(contact_time, self.clock)
+        headfix_start = self.clock()
         self.currentMouse.headfixes += 1
+        self.headfixes.inc()
 
         #Record fixation time
-        fixation_time = time()
+        fixation_time = self.wall_clock()
         self.collector.save_mouse_Headfix_start(self.currentMouse.tag, fixation_time)
         # Create the path for the video
-        video_name = self.video_path + "M" + str(self.currentMouse.tag) + "_" + str(fixation_time) + ".raw"
+        video_name = self.video_path + "M" + str(self.currentMouse.tag) + "_" + str(fixation_time) + self.camera.video_extension
 
         # Turn on the blue led
-        GPIO.output(self.led_pin, True)
-
-        self.camera.start_recording(video_name)
+        self.gpio.output(self.led_pin, True)
 
+        camera_start = self.clock()
+        self.camera.start_recording(video_name, self.motion_flagger(self.currentMouse.tag))
+        self.camera_start_time.observe_since(camera_start, self.clock)
 
-        for i in range(self.number_of_headfix_rewards):
-            self.collector.save_mouse_Reward_given(self.currentMouse.tag, i)
-            self.dispense_reward()
-            self.currentMouse.headfixed_rewards += 1
 
-
-            # SimpleStimulus, in this case, it's a piezo.
-            sleep(self.inter_reward_interval/2-self.reward_time)
-            self.piezo_stimulus.stimulate(self.collector, self.currentMouse.tag, i)
-            sleep(self.inter_reward_interval/2-self.piezo_duration)
-
-            
-            # Uncomment lines below to get LRL trainled back.
-            # Light stimulus occurs every 10 seconds!
-            #sleep(self.inter_reward_interval/2.0-self.reward_time)
-            # Give the data collector so that it knows where to write the data and the mouse's tag
-            #self.light_stimulus.stimulate(self.collector, self.currentMouse.tag)
-            #sleep(self.inter_reward_interval/2.0-self.length_of_light_stimulus_train)
-
-            ## MODIFY HERE FOR INCLUDING OTHER STIMULI.
-        # end of reward/stimuli loop
+        # Rewards and stimuli run on the trial engine, which keeps watching the
+        # sensors and stops the trial if the mouse pulls out (or keeps moving, if asked to).
+        if self.motion_release is not None:
+            self.motion_release.arm()
+        abort_reason = self.trial_engine.run_timeline(self.headfix_timeline())
+        if self.motion_release is not None:
+            self.motion_release.disarm()
+        if abort_reason is not None:
+            print ("Head fix aborted: " + abort_reason)
+            self.collector.save_trial_aborted(self.currentMouse.tag)
+            self.aborted_headfixes.inc()
 
         # turn off the blue led
-        GPIO.output(self.led_pin, False)
+        self.gpio.output(self.led_pin, False)
 
         self.camera.stop_recording()
 
         # turn off pistons
-        GPIO.output(self.pistons_pin, False)
+        self.gpio.output(self.pistons_pin, False)
+        self.headfix_end_time = self.clock()
 
         # save end of headfixing
         self.collector.save_mouse_Headfix_end(self.currentMouse.tag)
+        self.headfix_time.observe_since(headfix_start, self.clock)
 
 
         # Time before the mouse is headfixed again.
         # However must actively check for  the pin in the event
         # that a mouse changes during this time.
-        t_end_trial = time()
-        while(time()-t_end_trial < self.skedaddle_time):
-            if GPIO.input(self.range_pin) == 0:
-                return
-            else:
-                sleep(self.cpu_rest_time)
+        self.sensors.wait_for([(self.range_pin, 0)], self.skedaddle_time)
+
+
+    # Called from the motion monitor thread once the mouse has been moving for motion_release_time.
+    def release_moving_mouse(self, timestamp):
+        self.trial_engine.abort_threadsafe("moving for " + str(self.motion_release_time) + " s")
+
+    """
+    For camera.start_recording: saves a 'moving' event for mouse tag if it
+    moved for more than motion_flag_fraction of the video. It is called from
+    the motion monitor thread once the trace is finished, so the trial never
+    waits for the analysis to catch up.
+    """
+    def motion_flagger(self, tag):
+        if self.camera.motion is None or self.motion_flag_fraction is None:
+            return None
+
+        def flag_motion(frames, moving_frames):
+            if frames and moving_frames > self.motion_flag_fraction * frames:
+                self.collector.save_trial_moving(tag)
+                self.moving_headfixes.inc()
+        return flag_motion
+
+    # What happens during a head fix, as (time from the start, action, argument).
+    def headfix_timeline(self):
+        timeline = []
+        for i in range(self.number_of_headfix_rewards):
+            t_reward = i * self.inter_reward_interval
+            timeline.append((t_reward, 'reward', i))
 
+            # SimpleStimulus, in this case, it's a piezo.
+            timeline.append((t_reward + self.inter_reward_interval/2, 'stimulus', i))
 
-    # Simply dispenses water reward.
-    def dispense_reward(self):
-        GPIO.output(self.reward_pin, 1)
-        sleep(self.reward_time)
-        GPIO.output(self.reward_pin, 0)
+            # Uncomment line below to get LRL trainled back.
+            # Light stimulus occurs every 10 seconds!
+            #timeline.append((t_reward + self.inter_reward_interval/2.0, 'light', None))
 
-    # Naming scheme: headFix_XX_MMDD.txt
-    def setup_full_path_data(self):
-        #os.chdir(self.data_file_path)
-        cage_id = input("Type the cage ID: ")
+            ## MODIFY HERE FOR INCLUDING OTHER STIMULI.
+        timeline.append((self.number_of_headfix_rewards * self.inter_reward_interval, 'end', None))
+        return timeline
 
+    # Actions the trial engine can run, see TrialEngine.
+    async def reward_action(self, n_reward):
+        self.collector.save_mouse_Reward_given(self.currentMouse.tag, n_reward)
+        await self.player.play_async(self.reward_waveform)
+        self.observe_reward()
+        self.currentMouse.headfixed_rewards += 1
 
-        # This section of the code creates the appropriate name of the file.
-        date_now = ""
-        if datetime.now().month < 10:
-            date_now += "0"
-        date_now += str(datetime.now().month)
+    async def light_action(self, argument):
+        await self.light_stimulus.stimulate_async(self.collector, self.currentMouse.tag)
+
+    async def stimulus_action(self, counter):
+        await self.piezo_stimulus.stimulate_async(self.collector, self.currentMouse.tag, counter)
+
+    async def camera_start_action(self, video_name):
+        camera_start = self.clock()
+        self.camera.start_recording(video_name, self.motion_flagger(self.currentMouse.tag))
+        self.camera_start_time.observe_since(camera_start, self.clock)
+
+    async def camera_stop_action(self, argument):
+        self.camera.stop_recording()
 
-        if datetime.now().day < 10:
-            date_now += "0"
-        date_now += str(datetime.now().day)
+    async def led_action(self, level):
+        self.gpio.output(self.led_pin, level)
 
-        self.data_file_path += (date_now + "/" + cage_id + "/")
+    # Simply dispenses water reward, now or at start_time on the player's clock.
+    def dispense_reward(self, start_time=None):
+        self.player.play(self.reward_waveform, start_time)
+        self.observe_reward()
 
-        if not os.path.exists(self.data_file_path):
-            os.makedirs(self.data_file_path)
+    # Valve open time actually achieved, from the player's edge log.
+    def observe_reward(self):
+        self.rewards.inc()
+        open_time = pulse_width(self.player.edge_log, self.reward_pin)
+        if open_time is not None:
+            self.valve_open_time.observe(open_time)
+            self.valve_error.observe(abs(open_time - self.reward_time))
 
-        self.data_full_path = (self.data_file_path + self.textfile_path)
-        if not os.path.exists(self.data_full_path):
-            os.makedirs(self.data_full_path)
+    # Naming scheme: headFix_XX_MMDD.txt
+    def setup_full_path_data(self):
+        while True:
+            cage_id = self.cage_id
+            if cage_id is None:
+                cage_id = input("Type the cage ID: ")
+            self.make_paths(cage_id)
 
-        self.video_path = (self.data_file_path + self.video_path)
-        if not os.path.exists(self.video_path):
-            os.makedirs(self.video_path)
+            print ("The path of data file will be: " + self.data_full_path)
+            print ("The path of the video files will be: " + self.video_path)
+            print ("The path of the stats file will be: " + self.stats_full_path)
 
-        self.stats_full_path = self.data_full_path
+            if not self.confirm_paths or input("Is this correct? (y/n): ") == "y":
+                self.cage_id = cage_id
+                break
+            # ask for the cage again
+            self.cage_id = None
 
-        self.data_full_path += (self.data_file_name + cage_id + "_" + date_now + ".txt")
-        self.stats_full_path += (self.stats_file_name + cage_id + "_" + date_now + ".txt")
+        for path in (self.data_file_path, os.path.dirname(self.data_full_path), self.video_path):
+            if not os.path.exists(path):
+                os.makedirs(path)
 
-        print ("The path of data file will be: " + self.data_full_path)
-        print ("The path of the video files will be: " + self.video_path)
-        print ("The path of the stats file will be: " + self.stats_full_path)
+    def make_paths(self, cage_id):
+        # This section of the code creates the appropriate name of the file.
+        date_now = datetime.fromtimestamp(self.wall_clock()).strftime("%m%d")
 
-        ans = input("Is this correct? (y/n): ")
+        self.data_file_path = (self.data_root_path + date_now + "/" + cage_id + "/")
+        self.video_path = (self.data_file_path + self.videofile_path)
+        text_path = (self.data_file_path + self.textfile_path)
 
-        if ans == "y":
-            return
-        else:
-            self.setup_full_path_data()
+        self.data_full_path = (text_path + self.data_file_name + cage_id + "_" + date_now + ".txt")
+        self.binary_full_path = self.data_full_path[:-len(".txt")] + ".bin"
+        self.metrics_full_path = (text_path + "metrics_" + cage_id + ".prom")
+        self.stats_full_path = (text_path + self.stats_file_name + cage_id + "_" + date_now + ".txt")
+        self.journal_full_path = (text_path + "journal_" + cage_id + "_" + date_now + ".bin")
+        if self.owns_mice:
+            self.mice.stats_file_path = self.stats_full_path
 
     def setup_mouse(self, tag):
-        # This function iterates through the list of mice and if it finds one
-        # with the same tag it sets it as the curent Mouse, otherwise, it adds it
-        # to the list as a new mouse.
-        for mouse in self.mice:
-            if mouse.tag == tag:
-                self.currentMouse = mouse
-                return
+        # This function looks the tag up in the registry and if it finds it
+        # sets that mouse as the curent Mouse, otherwise, it adds it
+        # to the registry as a new mouse.
+        self.currentMouse = self.mice.get(tag)
+        if self.currentMouse is not None:
+            return
         print ("Mouse not found! Adding to the list!")
-        # At this point we couldn't find the mouse in the list, so we
-        #   create a new mouse object and append it to the list
-
-        self.currentMouse = Mouse(tag)
-        self.mice.append(self.currentMouse)
+        # At this point we couldn't find the mouse in the registry, so we
+        #   create a new mouse object and add it
+        self.currentMouse = self.mice.add(tag)
 
     def setup_gpio_lines(self):
         # set up GPIO use BCM mode for GPIO pin numbering
-        GPIO.setmode (GPIO.BCM)
-        GPIO.setup (self.pistons_pin, GPIO.OUT)
-        GPIO.setup (self.reward_pin, GPIO.OUT)
-        GPIO.setup (self.led_pin, GPIO.OUT)
-        GPIO.setup (self.range_pin, GPIO.IN)
-        GPIO.setup (self.contact_pin, GPIO.IN)
+        self.gpio.setmode (self.gpio.BCM)
+        self.gpio.setup (self.pistons_pin, self.gpio.OUT)
+        self.gpio.setup (self.reward_pin, self.gpio.OUT)
+        self.gpio.setup (self.led_pin, self.gpio.OUT)
+        self.gpio.setup (self.range_pin, self.gpio.IN)
+        self.gpio.setup (self.contact_pin, self.gpio.IN)
 
 
+    # Only the mouse that was just inside has changed, the file itself is
+    # written by the registry's background thread.
     def save_current_stats(self):
-        with open(self.stats_full_path, "w") as file:
-            first_line = "Mouse_ID\tentries\tent_rew\thfixes\thf_rew\n"
-            file.write(first_line)
-            for mouse in self.mice:
-                output_line = str(mouse.tag) + "\t" + str(mouse.entries) + "\t" + str(mouse.entrance_rewards) + "\t" + str(mouse.headfixes) + "\t" + str(mouse.headfixed_rewards) + "\n"
-                file.write(output_line)
+        self.mice.mark_changed(self.currentMouse)
+        self.mice.save_stats()
 
     def quit(self):
+        # first, so a 'moving' event of the last head fix still goes in before the end of the session
+        self.camera.close()
         self.collector.save_end_session()
-
-
-def main():
+        self.collector.close()
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.close()
+        if self.status_server is not None:
+            self.status_server.close()
+        self.trial_engine.close()
+        self.sensors.close()
+        self.reader.close()
+        if self.owns_mice:
+            self.mice.close()
+
+
+def load_config(config_path):
+    with open(config_path) as config_file:
+        return json.load(config_file)
+
+
+# Usage: python HeadFix.py [--config rig.json] [--cage C1] [--data-path /media/Cage1/] [--yes] [--simulated]
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Automated head fixing task")
+    parser.add_argument("--config", help="JSON file of settings, by Task attribute name")
+    parser.add_argument("--cage", help="cage ID, asked on the console if not given")
+    parser.add_argument("--data-path", help="folder the MMDD folders go in, i.e. /media/Cage1/")
+    parser.add_argument("--yes", action="store_true", help="do not ask to confirm the paths")
+    parser.add_argument("--simulated", action="store_true", help="simulated GPIO, RFID reader and camera")
+    parser.add_argument("--realtime", action="store_true",
+                        help="run the sensors, pistons and stimuli in a process of their own, see RealtimeProcess.py")
+    args = parser.parse_args(argv)
+
+    config = {}
+    if args.config is not None:
+        config = load_config(args.config)
+    if args.cage is not None:
+        config["cage_id"] = args.cage
+    if args.data_path is not None:
+        config["data_root_path"] = args.data_path
+    if args.yes:
+        config["confirm_paths"] = False
+    if args.realtime:
+        config["realtime_process"] = True
+    if config.get("realtime_process"):
+        from RealtimeProcess import run_realtime
+        run_realtime(config, args.simulated)
+        return
+    gpio = serial_port = camera = None
+    if args.simulated:
+        gpio = SimulatedGPIO()
+        serial_port = SimulatedSerial()
+        camera = SimulatedCamera()
+
+    task = None
     try:
-        task = Task()
+        task = Task(gpio, config, serial_port, camera)
         task.start()
     except KeyboardInterrupt:
-        task.quit()
-        GPIO.cleanup()
-
+        if task is not None:
+            task.quit()
+            task.gpio.cleanup()
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+__author__ = 'Federico'
+
+import os
+import struct
+import threading
+import zlib
+
+"""
+Crash-safe journal of the per-mouse counts, so a restarted task carries on
+with the registry it had (and the entrance reward cap) instead of starting
+every mouse from zero.
+
+Every change of a mouse appends one record with all its counts, so the last
+record of a tag is its state and replaying a record twice does no harm.
+Each record has a CRC32: a record torn by a crash in the middle of a write,
+or damaged on disk, is skipped, and a torn end of the file is cut off before
+anything else is appended. Every snapshot_interval records the whole state
+is written to <journal>.snapshot (to a temporary file, then renamed) and the
+journal is emptied, so recovery never reads more than snapshot_interval
+records. A crash between the two steps only means some records are replayed
+on top of a snapshot that already has them.
+
+Format, little endian:
+    JOURNAL   magic "HFJRNL01", uint32 record size, then records
+    SNAPSHOT  magic "HFSNAP01", uint32 number of records, then records
+    RECORD    uint64 tag, uint32 entries, entrance_rewards, headfixes,
+              headfixed_rewards, uint32 CRC32 of the 24 bytes before it
+"""
+
+JOURNAL_MAGIC = b"HFJRNL01"
+SNAPSHOT_MAGIC = b"HFSNAP01"
+HEADER = struct.Struct("<8sI")
+RECORD = struct.Struct("<QIIIII")
+# bytes of a record covered by its checksum
+CHECKED_SIZE = RECORD.size - 4
+
+
+def pack_record(tag, counts):
+    data = struct.pack("<QIIII", tag, *counts)
+    return data + struct.pack("<I", zlib.crc32(data))
+
+
+"""
+Reads the whole records in data into state (tag -> counts), in order.
+Returns (number of good records, number of bad ones); a partial record
+at the end is left out of both.
+"""
+def read_records(data, state):
+    n_good = 0
+    n_bad = 0
+    n_records = len(data) // RECORD.size
+    view = memoryview(data)
+    for i, (tag, entries, entrance_rewards, headfixes, headfixed_rewards, crc) in \
+            enumerate(RECORD.iter_unpack(view[:n_records * RECORD.size])):
+        start = i * RECORD.size
+        if zlib.crc32(view[start:start + CHECKED_SIZE]) != crc:
+            n_bad += 1
+            continue
+        state[tag] = (entries, entrance_rewards, headfixes, headfixed_rewards)
+        n_good += 1
+    return n_good, n_bad
+
+
+class MouseJournal:
+    """
+    Journal of the counts of every mouse at path, with its snapshot next to it.
+    Opening it recovers the state (tag -> (entries, entrance_rewards, headfixes,
+    headfixed_rewards), in the order the mice were first seen), write(mouse)
+    records a change. Tags are the integers the RFID reader gives.
+    With fsync the journal also survives a power cut, not just a crash of the
+    program, at the cost of waiting for the disk on every write.
+    """
+    def __init__(self, path, snapshot_interval=1000, fsync=False):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.snapshot_interval = snapshot_interval
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.state = {}
+        # records recovered, records skipped as damaged and bytes cut off the end
+        self.recovered = 0
+        self.bad_records = 0
+        self.truncated_bytes = 0
+        self.read_snapshot()
+        self.records_since_snapshot = self.read_journal()
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+
+    def read_snapshot(self):
+        if not os.path.exists(self.snapshot_path):
+            return
+        with open(self.snapshot_path, 'rb') as snapshot_file:
+            data = snapshot_file.read()
+        if len(data) < HEADER.size:
+            self.bad_records += 1
+            return
+        magic, n_records = HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(self.snapshot_path + " is not a mouse journal snapshot")
+        n_good, n_bad = read_records(data[HEADER.size:HEADER.size + n_records * RECORD.size], self.state)
+        self.recovered += n_good
+        self.bad_records += n_bad + (n_records - n_good - n_bad)
+
+    # Replays the journal, cutting off a torn record at its end. Returns the number of records in it.
+    def read_journal(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < HEADER.size:
+            self.reset_journal()
+            return 0
+        with open(self.path, 'rb') as journal_file:
+            data = journal_file.read()
+        magic, record_size = HEADER.unpack_from(data)
+        if magic != JOURNAL_MAGIC or record_size != RECORD.size:
+            raise ValueError(self.path + " is not a mouse journal")
+        records = data[HEADER.size:]
+        n_good, n_bad = read_records(records, self.state)
+        self.recovered += n_good
+        self.bad_records += n_bad
+        torn = len(records) % RECORD.size
+        if torn:
+            with open(self.path, 'r+b') as journal_file:
+                journal_file.truncate(len(data) - torn)
+            self.truncated_bytes += torn
+        return n_good + n_bad
+
+    # Empties the journal, down to its header.
+    def reset_journal(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'wb') as journal_file:
+            journal_file.write(HEADER.pack(JOURNAL_MAGIC, RECORD.size))
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(temp_path, self.path)
+
+    # mouse: anything with tag, entries, entrance_rewards, headfixes and headfixed_rewards.
+    def write(self, mouse):
+        counts = (mouse.entries, mouse.entrance_rewards, mouse.headfixes, mouse.headfixed_rewards)
+        with self.lock:
+            tag = int(mouse.tag)
+            self.state[tag] = counts
+            os.write(self.fd, pack_record(tag, counts))
+            if self.fsync:
+                os.fsync(self.fd)
+            self.records_since_snapshot += 1
+            if self.records_since_snapshot >= self.snapshot_interval:
+                self.compact()
+
+    def snapshot(self):
+        with self.lock:
+            self.compact()
+
+    # Writes the whole state as the snapshot, then empties the journal. Called with the lock held.
+    def compact(self):
+        self.write_snapshot()
+        os.close(self.fd)
+        self.reset_journal()
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self.records_since_snapshot = 0
+
+    def write_snapshot(self):
+        temp_path = self.snapshot_path + ".tmp"
+        records = [pack_record(tag, counts) for tag, counts in self.state.items()]
+        with open(temp_path, 'wb') as snapshot_file:
+            snapshot_file.write(HEADER.pack(SNAPSHOT_MAGIC, len(records)) + b"".join(records))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temp_path, self.snapshot_path)
+
+    # Compacts, so the next start only has to read the snapshot.
+    def close(self):
+        with self.lock:
+            if self.fd is None:
+                return
+            if self.records_since_snapshot:
+                self.compact()
+            os.close(self.fd)
+            self.fd = None
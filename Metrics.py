@@ -0,0 +1,187 @@
+__author__ = 'Federico'
+
+import os
+import threading
+from bisect import bisect_left
+from time import monotonic, time
+
+"""
+Counters and fixed-bucket histograms for the timing-critical paths.
+
+Recording a value is a bisect and a few additions, no allocation and no
+lock (two threads observing at the very same time may rarely lose a count,
+which is fine for monitoring). Everything can be written out in the
+Prometheus text exposition format, periodically to a file by MetricsExporter
+(i.e. for node_exporter's textfile collector) or by an HTTP server.
+"""
+
+# Upper bounds, in seconds, of the histogram buckets: 10 us to 10 s, 4 per decade.
+DEFAULT_BOUNDS = tuple(m * 10.0 ** e for e in range(-5, 1) for m in (1.0, 1.8, 3.2, 5.6)) + (10.0,)
+
+# Longest time recording one value may take, checked by the tests and benchmarks.
+OVERHEAD_BUDGET = 5e-6
+
+
+class Counter:
+    def __init__(self, name, help_text=""):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def exposition(self):
+        return ("# HELP " + self.name + " " + self.help_text + "\n" +
+                "# TYPE " + self.name + " counter\n" +
+                self.name + " " + str(self.value) + "\n")
+
+
+class Histogram:
+    """
+    Counts of the observed values in fixed buckets, with their sum and maximum.
+    counts[i] is the number of values <= bounds[i] (and > bounds[i - 1]),
+    the last count is for the values above every bound.
+    """
+    def __init__(self, name, help_text="", bounds=DEFAULT_BOUNDS):
+        self.name = name
+        self.help_text = help_text
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    # Records the time since start, a time on clock (monotonic by default).
+    def observe_since(self, start, clock=monotonic):
+        self.observe(clock() - start)
+
+    def count(self):
+        return sum(self.counts)
+
+    # Upper bound of the bucket holding quantile q (0 to 1) of the values, the maximum for the last one.
+    def quantile(self, q):
+        total = self.count()
+        if total == 0:
+            return 0.0
+        cumulative = 0
+        for i, n in enumerate(self.counts):
+            cumulative += n
+            if cumulative >= q * total:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                return self.max
+        return self.max
+
+    def exposition(self):
+        lines = ["# HELP " + self.name + " " + self.help_text,
+                 "# TYPE " + self.name + " histogram"]
+        cumulative = 0
+        for bound, n in zip(self.bounds, self.counts):
+            cumulative += n
+            lines.append(self.name + '_bucket{le="' + repr(bound) + '"} ' + str(cumulative))
+        cumulative += self.counts[-1]
+        lines.append(self.name + '_bucket{le="+Inf"} ' + str(cumulative))
+        lines.append(self.name + "_sum " + repr(self.sum))
+        lines.append(self.name + "_count " + str(cumulative))
+        return "\n".join(lines) + "\n"
+
+
+class Metrics:
+    """
+    The counters and histograms of one rig, by name. Names get the prefix
+    (headfix_ by default) so they do not clash with other exporters.
+    """
+    def __init__(self, prefix="headfix_"):
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self.start_time = time()
+
+    def counter(self, name, help_text=""):
+        if name not in self.counters:
+            self.counters[name] = Counter(self.prefix + name, help_text)
+        return self.counters[name]
+
+    def histogram(self, name, help_text="", bounds=DEFAULT_BOUNDS):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(self.prefix + name, help_text, bounds)
+        return self.histograms[name]
+
+    def exposition(self):
+        parts = [counter.exposition() for name, counter in sorted(self.counters.items())]
+        parts += [histogram.exposition() for name, histogram in sorted(self.histograms.items())]
+        parts.append("# TYPE " + self.prefix + "start_time_seconds gauge\n" +
+                     self.prefix + "start_time_seconds " + repr(self.start_time) + "\n")
+        return "".join(parts)
+
+
+class MetricsExporter:
+    """
+    Writes metrics.exposition() to file_path every interval seconds from a
+    background thread. The file is written under a temporary name and
+    renamed, so readers never see half of it.
+    """
+    def __init__(self, metrics, file_path, interval=10.0):
+        self.metrics = metrics
+        self.file_path = file_path
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="MetricsExporter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.write()
+
+    def write(self):
+        temp_path = self.file_path + ".tmp"
+        with open(temp_path, "w") as metrics_file:
+            metrics_file.write(self.metrics.exposition())
+        os.replace(temp_path, self.file_path)
+
+    # Writes the file one last time.
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.write()
+
+
+"""
+Worst lateness (actual - deadline, in seconds) of the last n_edges entries
+of a WaveformPlayer edge_log on pins, 0.0 if there are none.
+"""
+def edge_lateness(edge_log, pins, n_edges):
+    worst = 0.0
+    found = 0
+    for deadline, actual, pin, level in reversed(edge_log):
+        if pin in pins:
+            worst = max(worst, actual - deadline)
+            found += 1
+            if found >= n_edges:
+                break
+    return worst
+
+
+"""
+How long pin was actually high the last time it went up and down, from a
+WaveformPlayer edge_log, None if that is not in the log.
+"""
+def pulse_width(edge_log, pin):
+    off_time = None
+    for deadline, actual, edge_pin, level in reversed(edge_log):
+        if edge_pin != pin:
+            continue
+        if off_time is None:
+            if level:
+                return None
+            off_time = actual
+        elif level:
+            return off_time - actual
+    return None
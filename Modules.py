@@ -1,60 +1,149 @@
 __author__ = 'Federico'
 
-from serial import Serial
-import picamera
-from time import sleep, time
+from time import sleep, time, monotonic
 from datetime import datetime
-import RPi.GPIO as GPIO
+import os
+import queue
+import threading
+from EventWriter import BackgroundWriter
+from EventLog import BinaryEventFile
+from RFIDFramer import TagFramer
+from StimulusScheduler import WaveformPlayer, pulse_train, single_pulse
+from VideoRingBuffer import PretriggerOutput, RawFileSink, CompressorSink, timestamps_path_for
+from MotionEnergy import MotionMonitor, motion_path_for
+from GPIOBackend import get_gpio_backend
+from Metrics import edge_lateness, pulse_width
 
 port = "/dev/ttyUSB0"
 
 class TagReader:
-    def __init__(self, port):
-        self.serial_port = Serial(port, baudrate=9600, timeout=0.01)
+    """
+    RFID Tag is 16 characters: STX(02h) DATA (10 ASCII) CHECK SUM (2 ASCII) CR LF ETX(03h)
+    Everything waiting on the serial port is read in one call and handed to a
+    TagFramer, which finds the frames, rejects bad checksums and drops repeated
+    reads of the same tag within dedupe_window seconds.
+    start_listener() does this from a background thread and delivers the tags
+    through a queue (wait_for_tag) and, if given, a callback(tag, read_time).
+    read_time is on clock, the epoch by default.
+    A read returns as soon as bytes arrive, read_timeout only sets how often the
+    listener wakes up with nothing to read; stop_listener cancels the read
+    that is waiting, so it does not have to wait for it.
+    If reading fails (a SerialException or OSError, i.e. the USB reader was
+    unplugged) the listener logs it, counts it in errors (and in metrics, a
+    Metrics.Metrics, if given) and reopens the port every retry_interval
+    seconds until it works, instead of dying and leaving the task deaf.
+    """
+    def __init__(self, port, dedupe_window=1.0, serial_port=None, clock=time, retry_interval=0.5, metrics=None,
+                 read_timeout=0.5):
+        if serial_port is None:
+            # pyserial is only needed for the real reader
+            from serial import Serial
+            serial_port = Serial(port, baudrate=9600, timeout=read_timeout)
+        self.serial_port = serial_port
+        self.clock = clock
         self.serial_port.close()
         self.serial_port.open()
         self.serial_port.flush()  # Flush any old data
         self.should_do_checksum = True
+        self.framer = TagFramer(check_sum=self.should_do_checksum, dedupe_window=dedupe_window, clock=clock)
 
-    def getBufferSize(self):
-        return self.serial_port.inWaiting()
+        # (tag, read_time) found by the listener thread
+        self.tags = queue.Queue()
+        self.callback = None
+        self.listener = None
+        self.listening = False
 
-    """
-    RFID Tag is 16 characters: STX(02h) DATA (10 ASCII) CHECK SUM (2 ASCII) CR LF ETX(03h)
-    1 char of junk, 10 of hexadecimal data, 2 of hexadecimal check sum, 3 of junk
-    XOR-ing 5 1-byte hex values will give the 1-byte check sum - if requested
-    """
-    def readTag(self):
-        #  run the while loop since it may read a tag twice.
-        #  May not be necessary
-        while (self.getBufferSize() >= 16):
-            junk = self.serial_port.read(1)  # Junk byte 1
-            tag  = self.serial_port.read(10) # tag bytes 10
-            check_sum = self.serial_port.read(2) # check sum 2 bytes
-            junk = self.serial_port.read(3)  # Last 3 bytes are junk
+        self.retry_interval = retry_interval
+        self.errors = 0
+        self.error_counter = None
+        if metrics is not None:
+            self.error_counter = metrics.counter("tag_reader_errors_total", "Failed reads of the RFID reader's port")
 
-            if (self.should_do_checksum):
-                self.doCheckSum(tag, check_sum)
+    def getBufferSize(self):
+        return self.serial_port.inWaiting()
 
-        return int(tag, base=16)  # Convert the tag to an integer.
+    # Reads all the bytes available (waiting up to the port timeout for the first one)
+    # and returns the new (tag, read_time) found in them.
+    def read_available(self):
+        data = self.serial_port.read(max(1, self.serial_port.inWaiting()))
+        if not data:
+            return []
+        return self.framer.feed(data, self.clock())
 
-    def doCheckSum(self, tag, check_sum):
+    # Returns the last tag in what is waiting on the port, None if there is no valid one.
+    def readTag(self):
+        tags = self.read_available()
+        if not tags:
+            return None
+        return tags[-1][0]
+
+    def start_listener(self, callback=None):
+        self.callback = callback
+        self.listening = True
+        self.listener = threading.Thread(target=self.listen, name="TagReader")
+        self.listener.daemon = True
+        self.listener.start()
+
+    def listen(self):
+        while self.listening:
+            # pyserial's SerialException is an OSError
+            try:
+                tags = self.read_available()
+            except OSError as error:
+                self.reopen(error)
+                continue
+            for tag, read_time in tags:
+                self.tags.put((tag, read_time))
+                if self.callback is not None:
+                    self.callback(tag, read_time)
+
+    # Logs the failed read, then reopens the port until it works or the listener is stopped.
+    def reopen(self, error):
+        self.errors += 1
+        if self.error_counter is not None:
+            self.error_counter.inc()
+        print ("RFID reader error, reopening the port: " + repr(error))
+        while self.listening:
+            sleep(self.retry_interval)
+            try:
+                self.serial_port.close()
+                self.serial_port.open()
+                self.serial_port.flush()
+                print ("RFID reader port reopened")
+                return
+            except OSError:
+                pass
+
+    # Blocks until a tag is read, returns the newest (tag, read_time) waiting
+    # or (None, None) after timeout seconds.
+    def wait_for_tag(self, timeout=None):
         try:
-            checked_val = 0
-            for i in range(0,5):
-                checked_val = checked_val ^ int(tag [(2 * i) : (2 * (i + 1))], 16)
-
-            if checked_val != int(check_sum, 16):
-                print ("Tag reader checksum error. Tag was not read fully...")
-        except ValueError:
-            print ("Error reading the tag properly.")
-            print ("Tag: " + tag)
+            tag = self.tags.get(timeout=timeout)
+        except queue.Empty:
+            return None, None
+        # Reads that piled up while nobody was waiting are old news, keep the newest.
+        while True:
+            try:
+                tag = self.tags.get_nowait()
+            except queue.Empty:
+                return tag
+
+    def stop_listener(self):
+        self.listening = False
+        if self.listener is not None:
+            self.serial_port.cancel_read()
+            self.listener.join()
+            self.listener = None
 
     def close(self):
+        self.stop_listener()
         self.serial_port.close()
 
 
 class Mouse:
+    # Fixed attributes, no per-mouse dict, so thousands of mice stay small.
+    __slots__ = ('tag', 'entries', 'headfixes', 'entrance_rewards', 'headfixed_rewards')
+
     def __init__(self, tag):
         self.tag = tag
         self.entries = 0
@@ -62,18 +151,248 @@ class Mouse:
         self.entrance_rewards = 0
         self.headfixed_rewards = 0
 
+    # The counts as they are now, for a thread that works on them later.
+    def copy(self):
+        mouse = Mouse(self.tag)
+        mouse.entries = self.entries
+        mouse.headfixes = self.headfixes
+        mouse.entrance_rewards = self.entrance_rewards
+        mouse.headfixed_rewards = self.headfixed_rewards
+        return mouse
+
+
+class MouseRegistry:
+    """
+    All the mice seen so far, by tag, in the order they first came in.
+    The quickStats file keeps one formatted line per mouse. Only the lines of mice
+    marked as changed are formatted again, and the file is written by a background
+    thread to a temp file that is then renamed over the old one, so a reader never
+    sees half a file and the trial loop never waits for the disk.
+    journal, a Journal.MouseJournal, brings back the mice of an earlier run
+    and gets every change from then on, see restore. The changes are queued
+    and journaled by the same background thread, fsync and compaction
+    included, so they do not hold up the trial either. The
+    StatusServer.StatusBoard given to set_status gets every change too.
+    A failed write (i.e. the USB disk went away for a moment) is logged and
+    counted in write_errors (and in the Metrics.Metrics given to set_metrics),
+    and what was not written is tried again on the next change. error is the
+    failure of the last pass, None once a pass works again; close() raises it.
+    """
+    header = "Mouse_ID\tentries\tent_rew\thfixes\thf_rew\n"
+
+    def __init__(self, stats_file_path=None, journal=None):
+        self.stats_file_path = stats_file_path
+        # tag -> Mouse
+        self.mice = {}
+        # tag -> line of the stats file
+        self.lines = {}
+        # tags whose line has to be formatted again
+        self.changed = set()
+
+        self.lock = threading.Lock()
+        self.save_requested = threading.Event()
+        self.stats_requested = False
+        # copies of the changed mice, for the background thread to journal
+        self.journal_pending = []
+        self.writer = None
+        self.running = False
+        self.write_errors = 0
+        self.error_counter = None
+        self.error = None
+
+        self.journal = None
+        self.status = None
+        if journal is not None:
+            self.restore(journal)
+
+    # Adds the mice recovered by journal and journals every change from now on.
+    # Returns the number of mice recovered.
+    def restore(self, journal):
+        with self.lock:
+            for tag, counts in journal.state.items():
+                mouse = self.mice.get(tag)
+                if mouse is None:
+                    mouse = self.mice[tag] = Mouse(tag)
+                mouse.entries, mouse.entrance_rewards, mouse.headfixes, mouse.headfixed_rewards = counts
+                self.changed.add(tag)
+                if self.status is not None:
+                    self.status.update_mouse(mouse)
+            self.journal = journal
+        return len(journal.state)
+
+    # Publishes the counts of every mouse on status, and every change from now on.
+    def set_status(self, status):
+        with self.lock:
+            for mouse in self.mice.values():
+                status.update_mouse(mouse)
+            self.status = status
+
+    def set_metrics(self, metrics):
+        self.error_counter = metrics.counter("stats_write_errors_total",
+                                             "Failed writes of the quickStats file or the mouse journal")
+
+    def __len__(self):
+        return len(self.mice)
+
+    def __iter__(self):
+        return iter(list(self.mice.values()))
+
+    def __contains__(self, tag):
+        return tag in self.mice
+
+    def get(self, tag):
+        return self.mice.get(tag)
+
+    def add(self, tag):
+        mouse = Mouse(tag)
+        with self.lock:
+            self.mice[tag] = mouse
+            self.changed.add(tag)
+        if self.journal is not None:
+            self.journal_change(mouse)
+        if self.status is not None:
+            self.status.update_mouse(mouse)
+        return mouse
+
+    def mark_changed(self, mouse):
+        with self.lock:
+            self.changed.add(mouse.tag)
+        if self.journal is not None:
+            self.journal_change(mouse)
+        if self.status is not None:
+            self.status.update_mouse(mouse)
+
+    def format_line(self, mouse):
+        return (str(mouse.tag) + "\t" + str(mouse.entries) + "\t" + str(mouse.entrance_rewards) + "\t" +
+                str(mouse.headfixes) + "\t" + str(mouse.headfixed_rewards) + "\n")
+
+    # Queues the counts of mouse for the background thread to journal.
+    def journal_change(self, mouse):
+        with self.lock:
+            self.journal_pending.append(mouse.copy())
+        self.wake_writer()
+
+    # Asks the background thread to write the stats file, returns straight away.
+    def save_stats(self):
+        self.stats_requested = True
+        self.wake_writer()
+
+    def wake_writer(self):
+        # several chambers may share the registry, only one of them starts the thread
+        with self.lock:
+            if self.writer is None:
+                self.running = True
+                self.writer = threading.Thread(target=self.run_writer, name="MouseRegistry")
+                self.writer.daemon = True
+                self.writer.start()
+        self.save_requested.set()
+
+    def run_writer(self):
+        while self.running:
+            self.save_requested.wait()
+            self.save_requested.clear()
+            if self.running:
+                self.write_pending()
+
+    # Journals the queued changes and writes the stats file if asked to. If that
+    # fails what was not written stays queued, for the next pass to try again.
+    def write_pending(self):
+        stats_requested = self.stats_requested
+        self.stats_requested = False
+        try:
+            self.write_journal()
+            if stats_requested and self.stats_file_path is not None:
+                self.write_stats()
+        except OSError as error:
+            if stats_requested:
+                self.stats_requested = True
+            self.write_errors += 1
+            if self.error_counter is not None:
+                self.error_counter.inc()
+            print ("Could not write the mouse stats, will try again: " + repr(error))
+            self.error = error
+            return
+        self.error = None
+
+    def write_journal(self):
+        with self.lock:
+            pending = self.journal_pending
+            self.journal_pending = []
+        for i, mouse in enumerate(pending):
+            try:
+                self.journal.write(mouse)
+            except OSError:
+                with self.lock:
+                    self.journal_pending[:0] = pending[i:]
+                raise
+
+    def write_stats(self):
+        with self.lock:
+            for tag in self.changed:
+                self.lines[tag] = self.format_line(self.mice[tag])
+            self.changed.clear()
+            text = self.header + "".join([self.lines[tag] for tag in self.mice])
+        temp_path = self.stats_file_path + ".tmp"
+        with open(temp_path, "w") as stats_file:
+            stats_file.write(text)
+            stats_file.flush()
+            os.fsync(stats_file.fileno())
+        os.replace(temp_path, self.stats_file_path)
+
+    # Stops the background thread and writes whatever is still pending,
+    # raises the error if that still fails.
+    def close(self):
+        if self.writer is not None:
+            self.running = False
+            self.save_requested.set()
+            self.writer.join()
+            self.writer = None
+        if self.changed:
+            self.stats_requested = True
+        if self.journal_pending or self.stats_requested:
+            self.write_pending()
+        if self.journal is not None:
+            self.journal.close()
+        if self.error is not None:
+            raise self.error
+
 
 class BrainCamera:
-    def __init__(self):
+    """
+    compression: VideoCompression.CompressionOptions to compress the frames on the
+    fly in a separate process (chunks <name>.NNN.hfz), None writes plain .raw files.
+    pretrigger_seconds: if given, the camera records all the time into a circular
+    buffer in memory and each recording starts that many seconds before
+    start_recording was called, without restarting the encoder. Every recording
+    gets a <name>_timestamps.txt file with the time of each frame.
+    camera: picamera.PiCamera() unless another one (i.e. VideoRingBuffer.SimulatedCamera) is given.
+    settle_timeout: longest time to wait for the auto exposure to settle before
+    it is fixed, the wait ends as soon as the readings stop changing.
+    motion_threshold: if given (it needs pretrigger_seconds), the motion energy of
+    every frame is worked out live by a MotionEnergy.MotionMonitor, self.motion,
+    and every recording gets a <name>_motion.bin trace. Frames changing by more
+    than motion_threshold grey levels on average count as moving.
+    start_recording(path, on_motion) calls on_motion(frames, moving frames) from
+    the monitor thread once the trace of that recording is finished.
+    metrics, a Metrics.Metrics, gets the time the motion analysis takes.
+    frame_bus_name: if given (it needs pretrigger_seconds too), every frame is
+    also published on a FrameBus.FrameBus of that name, self.frame_bus, with
+    room for frame_bus_seconds of frames, for other processes to read.
+    """
+    def __init__(self, compression=None, pretrigger_seconds=None, camera=None, settle_timeout=2.0,
+                 motion_threshold=None, metrics=None, frame_bus_name=None, frame_bus_seconds=1.0):
         self.video_format = "rgb"
         #self.video_quality = 5
 
         # Set up the settings of the camera so that
         # Exposure and gains are constant.
-        self.camera = picamera.PiCamera()
+        if camera is None:
+            import picamera
+            camera = picamera.PiCamera()
+        self.camera = camera
         self.camera.resolution = (256,256)
         self.camera.framerate = 30
-        sleep(2.0)
+        self.exposure_settled = self.wait_for_exposure(settle_timeout)
         self.camera.shutter_speed = self.camera.exposure_speed
         self.camera.exposure_mode = 'off'
         g = self.camera.awb_gains
@@ -82,49 +401,231 @@ class BrainCamera:
         self.camera.shutter_speed = 30000
         self.camera.awb_gains = (1,1)
 
-    def start_recording(self, video_name_path):
-        self.camera.start_recording(video_name_path, format=self.video_format)
+        self.compressor = None
+        self.video_extension = ".raw"
+        if compression is not None:
+            from VideoCompression import VideoCompressor
+            self.compressor = VideoCompressor((256, 256), 30, compression)
+            self.video_extension = ""
+
+        self.frame_bus = None
+        if frame_bus_name is not None and pretrigger_seconds:
+            from FrameBus import FrameBus
+            self.frame_bus = FrameBus(256 * 256 * 3, max(2, int(frame_bus_seconds * 30)), frame_bus_name)
+
+        self.pretrigger_output = None
+        if pretrigger_seconds:
+            self.pretrigger_output = PretriggerOutput((256, 256), 30, pretrigger_seconds, bus=self.frame_bus)
+            self.camera.start_recording(self.pretrigger_output, format=self.video_format)
+            self.camera.start_preview()
+
+        self.motion = None
+        if motion_threshold is not None and self.pretrigger_output is not None:
+            self.motion = MotionMonitor(self.pretrigger_output.ring, (256, 256), motion_threshold, metrics=metrics)
+
+    # Waits until exposure, white balance and gain read the same stable_reads times in a row.
+    def wait_for_exposure(self, timeout, poll_interval=0.05, stable_reads=3):
+        deadline = monotonic() + timeout
+        last = None
+        same = 0
+        while monotonic() < deadline:
+            reading = (self.camera.exposure_speed,
+                       tuple(float(gain) for gain in self.camera.awb_gains),
+                       float(self.camera.analog_gain))
+            # the exposure reads 0 until the first frames are out
+            if reading == last and reading[0] > 0:
+                same += 1
+                if same >= stable_reads:
+                    return True
+            else:
+                same = 0
+            last = reading
+            sleep(poll_interval)
+        return False
+
+    def start_recording(self, video_name_path, on_motion=None):
+        if self.pretrigger_output is not None:
+            if self.compressor is not None:
+                sink = CompressorSink(self.compressor, video_name_path)
+            else:
+                sink = RawFileSink(video_name_path)
+            start_seq = self.pretrigger_output.begin_capture(sink, timestamps_path_for(video_name_path))
+            if self.motion is not None:
+                self.motion.begin_trace(motion_path_for(video_name_path), start_seq, on_motion)
+            return
+        if self.compressor is not None:
+            self.compressor.start(video_name_path)
+            self.camera.start_recording(self.compressor, format=self.video_format)
+        else:
+            self.camera.start_recording(video_name_path, format=self.video_format)
         self.camera.start_preview()
 
     def stop_recording(self):
+        if self.pretrigger_output is not None:
+            stop_seq = self.pretrigger_output.end_capture()
+            if self.motion is not None and stop_seq is not None:
+                self.motion.end_trace(stop_seq)
+            return
         self.camera.stop_recording()
+        if self.compressor is not None:
+            self.compressor.stop()
         self.camera.stop_preview()
 
-    # Destructor
-    def __del__(self):
+    """
+    Finishes the motion trace and the captures still being written, stops the
+    compressor process and unlinks the frame bus, then closes the camera.
+    Only the first call does anything.
+    """
+    def close(self):
+        if self.camera is None:
+            return
         print ("Closed Camera")
+        if self.motion is not None:
+            self.motion.close()
+        if self.pretrigger_output is not None:
+            self.camera.stop_recording()
+            self.pretrigger_output.close()
+        if self.frame_bus is not None:
+            self.frame_bus.close()
+        if self.compressor is not None:
+            self.compressor.close()
         self.camera.close()
+        self.camera = None
+
+    # Destructor, a fallback: it may never run at interpreter exit, Task.quit calls close().
+    def __del__(self):
+        if getattr(self, "camera", None) is not None:
+            self.close()
 
 
 class DataCollector:
     """
     Format of the output string:
     tag     time_epoch      datetime       event
+
+    With background=True events are queued and written in batches by a
+    BackgroundWriter thread, the file stays open between batches and
+    flush_interval/fsync set how often it reaches the disk.
+    echo prints every event to the console as well.
+    binary_file_path, if given, also saves every event as a fixed-width
+    binary record (see EventLog.py).
+    stream, an EventStream.EventStream, also sends every event to an aggregator.
+    metrics, a Metrics.Metrics, gets the time each save takes and the number of events.
+    clock gives the event times, the epoch by default.
+    writer, given, takes the events instead of a BackgroundWriter, i.e. a
+    RealtimeProcess.RingWriter handing them to another process to write.
+    status, a StatusServer.StatusBoard, also gets every event, for the status server.
     """
-    def __init__(self, data_file_path):
+    def __init__(self, data_file_path, background=False, echo=True,
+                 queue_size=4096, flush_interval=1.0, fsync=False, binary_file_path=None, stream=None,
+                 metrics=None, clock=time, writer=None, status=None):
         self.data_file_path = data_file_path
+        self.clock = clock
+        self.echo = echo
+        self.stream = stream
+        self.status = status
+        self.save_time = None
+        if metrics is not None:
+            self.save_time = metrics.histogram("save_event_seconds", "Time the task spends saving one event")
+            self.events_saved = metrics.counter("events_saved_total", "Events saved")
+        # file kept open by the background writer
+        self.data_file = None
+        self.binary_file = None
+        if binary_file_path is not None:
+            self.binary_file = BinaryEventFile(binary_file_path)
+        self.writer = writer
+        if background and writer is None:
+            self.writer = BackgroundWriter(self.write_events, self.flush_events,
+                                           queue_size=queue_size,
+                                           flush_interval=flush_interval,
+                                           fsync=fsync, metrics=metrics)
 
     # This functions saves and prints the output string
     # Tag is the tag of the mouse inside
     # time_event is when did the event happen
     # event is the type of event occurring (i.e. entry, exit, reward, etc)
     def save_helper(self, tag, time_event, event):
+        start = monotonic()
+        if self.status is not None:
+            self.status.add(tag, time_event, event)
+        if self.writer is not None:
+            self.writer.put((tag, time_event, datetime.fromtimestamp(self.clock()), event))
+        else:
+            self.write_event(tag, time_event, event)
+        if self.save_time is not None:
+            self.save_time.observe_since(start)
+            self.events_saved.inc()
+
+    # Writes one event straight away, without the background writer.
+    def write_event(self, tag, time_event, event):
         with open(self.data_file_path, 'a') as data_file:
-            output_string = str(tag) + '\t' + str(time_event) + '\t' + str(datetime.now()) + '\t' + event + '\n'
-            print (output_string)
+            date_time = datetime.fromtimestamp(self.clock())
+            output_string = self.format_event(tag, time_event, date_time, event)
+            if self.echo:
+                print (output_string)
             data_file.write(output_string)
+        if self.binary_file is not None:
+            self.binary_file.write([(tag, time_event, date_time, event)])
+            self.binary_file.flush()
+        if self.stream is not None:
+            self.stream.write([(tag, time_event, date_time, event)])
+
+    def format_event(self, tag, time_event, date_time, event):
+        return str(tag) + '\t' + str(time_event) + '\t' + str(date_time) + '\t' + event + '\n'
+
+    # Called from the background writer thread with a list of queued events.
+    def write_events(self, events):
+        if self.data_file is None:
+            self.data_file = open(self.data_file_path, 'a')
+        output_string = ''.join([self.format_event(*event) for event in events])
+        if self.echo:
+            print (output_string)
+        self.data_file.write(output_string)
+        if self.binary_file is not None:
+            self.binary_file.write(events)
+        if self.stream is not None:
+            self.stream.write(events)
+
+    def flush_events(self, fsync):
+        if self.binary_file is not None:
+            self.binary_file.flush(fsync)
+        if self.data_file is None:
+            return
+        self.data_file.flush()
+        if fsync:
+            os.fsync(self.data_file.fileno())
+
+    # Waits until every event saved so far is on disk.
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush(fsync=True)
+        if self.stream is not None:
+            self.stream.flush()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.data_file is not None:
+            self.data_file.close()
+            self.data_file = None
+        if self.binary_file is not None:
+            self.binary_file.close()
+            self.binary_file = None
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
 
     def save_start_session(self):
-        self.save_helper('0000000000', time(), 'SeshStart')
+        self.save_helper('0000000000', self.clock(), 'SeshStart')
 
     def save_mouse_entry(self, tag):
-        self.save_helper(tag, time(), 'entry')
+        self.save_helper(tag, self.clock(), 'entry')
 
     def save_mouse_Headfix_start(self, tag, time_headfix):
         self.save_helper(tag, time_headfix, 'check+')
 
     def save_mouse_Reward_given(self, tag, n_reward):
-        self.save_helper(tag, time(), 'reward' + str(n_reward))
+        self.save_helper(tag, self.clock(), 'reward' + str(n_reward))
 
     ''' led_side is one of:
             L for left LED
@@ -132,23 +633,46 @@ class DataCollector:
             R for right LED
     '''
     def save_light_stimulus(self, tag, led_side):
-        self.save_helper(tag, time(), 'light-' + led_side)
+        self.save_helper(tag, self.clock(), 'light-' + led_side)
 
     def save_simple_stimulus(self, tag, counter):
-        self.save_helper(tag, time(), 'stimulus-' + str(counter))
+        self.save_helper(tag, self.clock(), 'stimulus-' + str(counter))
 
     def save_mouse_Headfix_end(self, tag):
-        self.save_helper(tag, time(), 'complete')
+        self.save_helper(tag, self.clock(), 'complete')
+
+    # The head fix was cut short by the trial engine (i.e. the mouse pulled out).
+    def save_trial_aborted(self, tag):
+        self.save_helper(tag, self.clock(), 'abort')
+
+    # The mouse moved for much of the head fix video, see MotionEnergy.
+    def save_trial_moving(self, tag):
+        self.save_helper(tag, self.clock(), 'moving')
 
     def save_mouse_exit(self, tag):
-        self.save_helper(tag, time(), 'exit')
+        self.save_helper(tag, self.clock(), 'exit')
 
     def save_end_session(self):
-        self.save_helper('0000000000', time(), 'SeshEnd')
+        self.save_helper('0000000000', self.clock(), 'SeshEnd')
+        self.flush()
 
 
 class LightStimulus():
-    def __init__(self, left, center, right, time_on, length, frequency):
+    def __init__(self, left, center, right, time_on, length, frequency, gpio=None, player=None, metrics=None):
+        # GPIO backend used for the LEDs
+        if gpio is None:
+            gpio = get_gpio_backend("rpi")
+        self.gpio = gpio
+        # how late the flashes come out, if given a Metrics.Metrics
+        self.lateness = None
+        if metrics is not None:
+            self.lateness = metrics.histogram("light_stimulus_lateness_seconds",
+                                              "Worst lateness of the flashes of a light stimulus")
+            self.stimuli = metrics.counter("light_stimuli_total", "Light stimuli given")
+        # plays the flashes against absolute deadlines
+        if player is None:
+            player = WaveformPlayer(gpio)
+        self.player = player
         # output pin for the stimulus the left LED (blue cable)
         self.stimulus_left_led_pin = left
         # output pin for the stimulus the center led (green cable)
@@ -172,50 +696,88 @@ class LightStimulus():
         self.counter = 0
         self.number_of_leds = len(self.led_to_turn_on)
 
+        # The flash train of each LED, worked out once.
+        self.waveforms = {}
+        for side, pin in (('L', left), ('C', center), ('R', right)):
+            self.waveforms[side] = pulse_train(pin, self.stimulus_led_on_time,
+                                               self.light_stimulation_frequency,
+                                               self.length_of_light_stimulus_train)
+
     def setup_gpio_for_leds(self):
-        GPIO.setup (self.stimulus_left_led_pin, GPIO.OUT)
-        GPIO.setup (self.stimulus_center_led_pin, GPIO.OUT)
-        GPIO.setup (self.stimulus_right_led_pin, GPIO.OUT)
+        self.gpio.setup (self.stimulus_left_led_pin, self.gpio.OUT)
+        self.gpio.setup (self.stimulus_center_led_pin, self.gpio.OUT)
+        self.gpio.setup (self.stimulus_right_led_pin, self.gpio.OUT)
 
     # Simple light stimulus!
     def stimulate(self, collector, tag):
-        collector.save_light_stimulus(tag, self.led_to_turn_on[self.counter])
+        side = self.led_to_turn_on[self.counter]
+        collector.save_light_stimulus(tag, side)
+        self.counter = (self.counter + 1) % self.number_of_leds
 
-        # Left LED's turn
-        if self.led_to_turn_on[self.counter] == 'L':
-            led_pin_to_use = self.stimulus_left_led_pin
-        # Right LED's turn
-        elif self.led_to_turn_on[self.counter] == 'R':
-            led_pin_to_use = self.stimulus_right_led_pin
-        else: # Center's LED
-            led_pin_to_use = self.stimulus_center_led_pin
+        # All the flashes of this LED's turn (L, C or R), on absolute deadlines.
+        self.player.play(self.waveforms[side])
+        self.observe(side)
 
+    # Same as stimulate, for the trial engine's event loop.
+    async def stimulate_async(self, collector, tag):
+        side = self.led_to_turn_on[self.counter]
+        collector.save_light_stimulus(tag, side)
         self.counter = (self.counter + 1) % self.number_of_leds
+        await self.player.play_async(self.waveforms[side])
+        self.observe(side)
 
-        # Iterate through all the number of flashes.
-        for i in range(self.number_of_led_flashes):
-            GPIO.output(led_pin_to_use, True)
-            sleep(self.stimulus_led_on_time)
-            GPIO.output(led_pin_to_use, False)
-            sleep(self.stimulus_led_off_time)
+    def observe(self, side):
+        if self.lateness is None:
+            return
+        waveform = self.waveforms[side]
+        self.lateness.observe(edge_lateness(self.player.edge_log, set([pin for (t, pin, level) in waveform.edges]),
+                                            len(waveform)))
+        self.stimuli.inc()
 
 
 class SimpleStimulus():
-    def __init__(self, trigger_pin, duration):
+    def __init__(self, trigger_pin, duration, gpio=None, player=None, metrics=None):
+        # GPIO backend used for the trigger
+        if gpio is None:
+            gpio = get_gpio_backend("rpi")
+        self.gpio = gpio
+        # how long the trigger was actually high, if given a Metrics.Metrics
+        self.pulse_time = None
+        if metrics is not None:
+            self.pulse_time = metrics.histogram("simple_stimulus_pulse_seconds",
+                                                "Time the stimulus trigger was actually high")
+            self.stimuli = metrics.counter("simple_stimuli_total", "Simple stimuli given")
+        if player is None:
+            player = WaveformPlayer(gpio)
+        self.player = player
         # output pin that will go high
         self.trigger_pin = trigger_pin
         # duration of the high output in seconds
         self.duration = duration
+        self.waveform = single_pulse(self.trigger_pin, self.duration)
 
         self.setup_gpio_lines()
 
     def setup_gpio_lines(self):
-        GPIO.setup(self.trigger_pin, GPIO.OUT)
+        self.gpio.setup(self.trigger_pin, self.gpio.OUT)
 
     def stimulate(self, collector, tag, counter):
         collector.save_simple_stimulus(tag, counter)
 
         #Turn on the trigger for 'duration' time
-        GPIO.output(self.trigger_pin, True)
-        sleep(self.duration)
-        GPIO.output(self.trigger_pin, False)
+        self.player.play(self.waveform)
+        self.observe()
+
+    # Same as stimulate, for the trial engine's event loop.
+    async def stimulate_async(self, collector, tag, counter):
+        collector.save_simple_stimulus(tag, counter)
+        await self.player.play_async(self.waveform)
+        self.observe()
+
+    def observe(self):
+        if self.pulse_time is None:
+            return
+        width = pulse_width(self.player.edge_log, self.trigger_pin)
+        if width is not None:
+            self.pulse_time.observe(width)
+        self.stimuli.inc()
@@ -0,0 +1,277 @@
+__author__ = 'Federico'
+
+import struct
+import threading
+from collections import deque
+from time import monotonic
+
+import numpy as np
+
+"""
+Motion energy of the live brain camera frames, while they are being recorded.
+
+Every frame is compared with the one before it on a subsampled colour
+channel (every step-th pixel of the green one by default, 16384 pixels of a
+256x256 frame): the motion energy is the mean absolute difference, in grey
+levels, and the changed fraction the fraction of pixels that changed by
+more than pixel_threshold. That is a few vectorised NumPy operations on
+preallocated arrays, a small fraction of the 33 ms between frames at 30 fps
+even on one Pi core, so every frame is analysed as it comes in.
+
+Every head fix video gets its trace next to it, <name>_motion.bin, little endian:
+    header  16 bytes: magic "HFMOTN01", uint32 record size, uint32 reserved
+    records 20 bytes each:
+        frame     uint32   frame number, as in <name>_timestamps.txt
+        epoch     float64  time of the frame
+        energy    float32  mean absolute difference with the frame before, grey levels
+        fraction  float32  fraction of the pixels that changed by more than pixel_threshold
+Read it with read_motion_trace().
+"""
+
+MAGIC = b"HFMOTN01"
+HEADER = struct.Struct("<8sII")
+RECORD = struct.Struct("<Idff")
+
+
+def record_dtype():
+    return np.dtype([('frame', '<u4'), ('epoch', '<f8'), ('energy', '<f4'), ('fraction', '<f4')])
+
+
+# M<tag>_<epoch>.raw -> M<tag>_<epoch>_motion.bin, like VideoRingBuffer.timestamps_path_for
+def motion_path_for(video_name_path):
+    if video_name_path.endswith(".raw"):
+        video_name_path = video_name_path[:-len(".raw")]
+    return video_name_path + "_motion.bin"
+
+
+# The trace of a video as a NumPy structured array with fields frame, epoch, energy and fraction.
+def read_motion_trace(file_path):
+    with open(file_path, 'rb') as f:
+        magic, record_size, reserved = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or record_size != RECORD.size:
+        raise ValueError("Not a motion trace: " + file_path)
+    return np.fromfile(file_path, dtype=record_dtype(), offset=HEADER.size)
+
+
+class MotionAnalyzer:
+    """
+    Frame to frame motion of rgb frames of resolution (width, height), on
+    channel (0 red, 1 green, 2 blue) subsampled every step pixels.
+    """
+    def __init__(self, resolution=(256, 256), channel=1, step=2, pixel_threshold=10):
+        width, height = resolution
+        self.shape = (height, width, 3)
+        self.channel = channel
+        self.step = step
+        self.pixel_threshold = pixel_threshold
+        sampled_shape = ((height + step - 1) // step, (width + step - 1) // step)
+        self.n_pixels = sampled_shape[0] * sampled_shape[1]
+        self.previous = np.zeros(sampled_shape, dtype=np.uint8)
+        self.diff = np.zeros(sampled_shape, dtype=np.int16)
+        self.changed = np.zeros(sampled_shape, dtype=bool)
+        self.has_previous = False
+
+    # The next frame is compared with nothing, i.e. after frames were missed.
+    def reset(self):
+        self.has_previous = False
+
+    # (energy, changed fraction) of frame (bytes) against the one before, (0.0, 0.0) for the first one.
+    def analyze(self, frame):
+        sampled = np.frombuffer(frame, dtype=np.uint8).reshape(self.shape)[::self.step, ::self.step, self.channel]
+        if not self.has_previous:
+            self.previous[...] = sampled
+            self.has_previous = True
+            return 0.0, 0.0
+        np.subtract(sampled, self.previous, out=self.diff, dtype=np.int16)
+        np.abs(self.diff, out=self.diff)
+        np.greater(self.diff, self.pixel_threshold, out=self.changed)
+        self.previous[...] = sampled
+        return float(self.diff.mean()), float(np.count_nonzero(self.changed)) / self.n_pixels
+
+
+class MotionMonitor:
+    """
+    Analyses every frame of a VideoRingBuffer.FrameRingBuffer in its own
+    thread as it comes in, from the live frame on. The energy of the frames
+    still in the ring is kept, so a trace begun with begin_trace starts
+    from the first frame of the recording, pre-trigger frames included.
+    Frames with energy above threshold count as moving.
+
+    Listeners are called from the monitor thread as
+    listener(timestamp, energy, fraction) for every frame, they must be quick.
+    metrics, a Metrics.Metrics, gets the time each frame takes to analyse.
+    """
+    def __init__(self, ring, resolution=(256, 256), threshold=4.0, channel=1, step=2, pixel_threshold=10,
+                 metrics=None):
+        self.ring = ring
+        self.analyzer = MotionAnalyzer(resolution, channel, step, pixel_threshold)
+        self.threshold = threshold
+        self.listeners = []
+        self.analysis_time = None
+        if metrics is not None:
+            self.analysis_time = metrics.histogram("motion_analysis_seconds", "Time to analyse the motion of one frame")
+        # energy, fraction and time of the frames still in the ring, by seq % capacity
+        self.seqs = np.full(ring.capacity, -1, dtype=np.int64)
+        self.energies = np.zeros(ring.capacity, dtype=np.float32)
+        self.fractions = np.zeros(ring.capacity, dtype=np.float32)
+        self.timestamps = np.zeros(ring.capacity, dtype=np.float64)
+        self.seq = ring.next_seq
+        self.frames_analyzed = 0
+        self.frames_lost = 0
+
+        self.lock = threading.Lock()
+        self.trace_file = None
+        self.trace_start = 0
+        self.trace_stop = None
+        # (frames, moving frames) of the trace being written and of the last one finished
+        self.trace_counts = [0, 0]
+        self.last_trace = None
+        self.trace_on_done = None
+        self.trace_done = threading.Event()
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="MotionMonitor")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def run(self):
+        while self.running:
+            if not self.ring.wait_for(self.seq, 0.1):
+                continue
+            if self.seq < self.ring.oldest_seq():
+                self.frames_lost += self.ring.oldest_seq() - self.seq
+                self.seq = self.ring.oldest_seq()
+                self.analyzer.reset()
+                continue
+            entry = self.ring.get(self.seq)
+            if entry is None:
+                continue
+            frame, timestamp = entry
+            start = monotonic()
+            energy, fraction = self.analyzer.analyze(frame)
+            if self.analysis_time is not None:
+                self.analysis_time.observe_since(start)
+            self.frames_analyzed += 1
+            slot = self.seq % self.ring.capacity
+            self.seqs[slot] = self.seq
+            self.energies[slot] = energy
+            self.fractions[slot] = fraction
+            self.timestamps[slot] = timestamp
+            with self.lock:
+                if self.trace_file is not None:
+                    self.write_trace(self.seq, self.seq + 1)
+                self.seq += 1
+            for listener in self.listeners:
+                listener(timestamp, energy, fraction)
+
+    """
+    Starts writing the trace of the frames from start_seq on to path, straight
+    away for the ones already analysed. A trace still open is finished first.
+    on_done, if given, is called as on_done(frames, moving frames) once the
+    trace is finished, usually from the monitor thread; it must be quick.
+    """
+    def begin_trace(self, path, start_seq, on_done=None):
+        with self.lock:
+            if self.trace_file is not None:
+                self.finish_trace()
+            self.trace_file = open(path, "wb")
+            self.trace_file.write(HEADER.pack(MAGIC, RECORD.size, 0))
+            self.trace_start = start_seq
+            self.trace_stop = None
+            self.trace_counts = [0, 0]
+            self.trace_on_done = on_done
+            self.trace_done.clear()
+            self.write_trace(start_seq, self.seq)
+
+    # Frames up to (not including) stop_seq are still written, then the trace is closed.
+    def end_trace(self, stop_seq):
+        with self.lock:
+            if self.trace_file is None:
+                return
+            self.trace_stop = stop_seq
+            if self.seq >= stop_seq:
+                self.finish_trace()
+
+    # Waits for the last trace to be finished, returns its (frames, moving frames), None on timeout.
+    def wait_trace(self, timeout):
+        if not self.trace_done.wait(timeout):
+            return None
+        return self.last_trace
+
+    # Writes the analysed frames from start_seq to stop_seq that are still kept. Called with the lock held.
+    def write_trace(self, start_seq, stop_seq):
+        if self.trace_stop is not None:
+            stop_seq = min(stop_seq, self.trace_stop)
+        records = []
+        for seq in range(max(start_seq, self.trace_start), stop_seq):
+            slot = seq % self.ring.capacity
+            if self.seqs[slot] != seq:
+                continue
+            energy = float(self.energies[slot])
+            records.append(RECORD.pack(seq - self.trace_start, self.timestamps[slot], energy, self.fractions[slot]))
+            self.trace_counts[0] += 1
+            if energy > self.threshold:
+                self.trace_counts[1] += 1
+        self.trace_file.write(b"".join(records))
+        if self.trace_stop is not None and stop_seq >= self.trace_stop:
+            self.finish_trace()
+
+    def finish_trace(self):
+        self.trace_file.close()
+        self.trace_file = None
+        self.last_trace = tuple(self.trace_counts)
+        self.trace_done.set()
+        if self.trace_on_done is not None:
+            self.trace_on_done(*self.last_trace)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        with self.lock:
+            if self.trace_file is not None:
+                self.finish_trace()
+
+
+class SustainedMotion:
+    """
+    Listener for a MotionMonitor that calls callback(timestamp) once at least
+    fraction of the frames of the last duration seconds had energy above
+    threshold (a struggling mouse still has the odd quiet frame). It only
+    watches while armed and disarms itself when it fires.
+    """
+    def __init__(self, threshold, duration, callback, fraction=0.75):
+        self.threshold = threshold
+        self.duration = duration
+        self.callback = callback
+        self.fraction = fraction
+        self.armed = False
+        # (timestamp, moving) of the frames of the last duration seconds
+        self.window = deque()
+        self.n_moving = 0
+        self.armed_since = None
+
+    def arm(self):
+        self.window.clear()
+        self.n_moving = 0
+        self.armed_since = None
+        self.armed = True
+
+    def disarm(self):
+        self.armed = False
+
+    def __call__(self, timestamp, energy, fraction):
+        if not self.armed:
+            return
+        if self.armed_since is None:
+            self.armed_since = timestamp
+        moving = energy > self.threshold
+        self.window.append((timestamp, moving))
+        self.n_moving += moving
+        while self.window[0][0] < timestamp - self.duration:
+            self.n_moving -= self.window.popleft()[1]
+        if timestamp - self.armed_since >= self.duration and self.n_moving >= self.fraction * len(self.window):
+            self.armed = False
+            self.callback(timestamp)
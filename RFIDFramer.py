@@ -0,0 +1,185 @@
+__author__ = 'Federico'
+
+import random
+import threading
+from time import monotonic
+
+STX = 0x02
+ETX = 0x03
+FRAME_TAIL = b'\r\n\x03'
+FRAME_LENGTH = 16
+HEX_DIGITS = b'0123456789ABCDEFabcdef'
+
+
+class TagFramer:
+    """
+    Streaming parser for the RFID reader output.
+    RFID Tag is 16 characters: STX(02h) DATA (10 ASCII) CHECK SUM (2 ASCII) CR LF ETX(03h)
+    Bytes are fed in whatever chunks the serial port gives, frames are found by
+    looking for STX and checking the CR LF ETX tail, so a lost or extra byte only
+    costs the frame it happened in. Frames with a bad checksum are thrown away and
+    the same tag read again within dedupe_window seconds is only reported once.
+    """
+    def __init__(self, check_sum=True, dedupe_window=1.0, buffer_size=4096, clock=monotonic):
+        self.check_sum = check_sum
+        self.dedupe_window = dedupe_window
+        # most bytes kept while looking for a frame, older ones are dropped
+        self.buffer_size = buffer_size
+        self.clock = clock
+
+        # bytes read but not parsed yet, starts at the next possible frame
+        self.buffer = bytearray()
+        self.last_tag = None
+        self.last_tag_time = None
+
+        # statistics
+        self.frames_ok = 0
+        self.checksum_errors = 0
+        self.framing_errors = 0
+        self.duplicates = 0
+        self.bytes_discarded = 0
+
+    """
+    Adds data to the buffer and returns a list of (tag, time) for every new tag
+    found. time is when the data was read, or now if not given.
+    """
+    def feed(self, data, timestamp=None):
+        if timestamp is None:
+            timestamp = self.clock()
+        self.buffer += data
+        tags = []
+        buffer = self.buffer
+        position = 0
+        while True:
+            start = buffer.find(STX, position)
+            if start < 0:
+                self.bytes_discarded += len(buffer) - position
+                position = len(buffer)
+                break
+            self.bytes_discarded += start - position
+            position = start
+            if len(buffer) - start < FRAME_LENGTH:
+                break
+            frame = bytes(buffer[start:start + FRAME_LENGTH])
+            tag = self.parse_frame(frame)
+            if tag is None:
+                # Not a frame, this STX was noise. Look again from the next byte.
+                self.bytes_discarded += 1
+                position = start + 1
+                continue
+            position = start + FRAME_LENGTH
+            if (tag == self.last_tag and self.last_tag_time is not None and
+                    timestamp - self.last_tag_time < self.dedupe_window):
+                self.duplicates += 1
+                continue
+            self.last_tag = tag
+            self.last_tag_time = timestamp
+            tags.append((tag, timestamp))
+
+        # Drop what has been parsed, and the oldest bytes if the buffer grew too big.
+        if len(buffer) - position > self.buffer_size:
+            self.bytes_discarded += len(buffer) - position - self.buffer_size
+            position = len(buffer) - self.buffer_size
+        del buffer[:position]
+        return tags
+
+    # Returns the tag as an integer, or None if frame is not a valid frame.
+    def parse_frame(self, frame):
+        if frame[13:16] != FRAME_TAIL:
+            self.framing_errors += 1
+            return None
+        data = frame[1:13]
+        for byte in data:
+            if byte not in HEX_DIGITS:
+                self.framing_errors += 1
+                return None
+        tag = data[0:10]
+        if self.check_sum:
+            checked_val = 0
+            for i in range(0, 5):
+                checked_val = checked_val ^ int(tag[(2 * i):(2 * (i + 1))], 16)
+            if checked_val != int(data[10:12], 16):
+                self.checksum_errors += 1
+                return None
+        self.frames_ok += 1
+        return int(tag, 16)
+
+
+# Builds the 16 bytes the reader sends for a tag (10 hex digits).
+def make_frame(tag):
+    tag = tag.encode('ascii') if not isinstance(tag, bytes) else tag
+    checked_val = 0
+    for i in range(0, 5):
+        checked_val = checked_val ^ int(tag[(2 * i):(2 * (i + 1))], 16)
+    return bytes([STX]) + tag + ("%02X" % checked_val).encode('ascii') + FRAME_TAIL
+
+
+"""
+Corrupts a byte stream like a noisy serial line: each byte can be dropped,
+have a bit flipped, or get a random junk byte inserted before it.
+"""
+def add_noise(data, drop_rate=0.0, flip_rate=0.0, junk_rate=0.0, rng=random):
+    noisy = bytearray()
+    for byte in data:
+        if junk_rate and rng.random() < junk_rate:
+            noisy.append(rng.randrange(256))
+        if drop_rate and rng.random() < drop_rate:
+            continue
+        if flip_rate and rng.random() < flip_rate:
+            byte ^= 1 << rng.randrange(8)
+        noisy.append(byte)
+    return bytes(noisy)
+
+
+class SimulatedSerial:
+    """
+    In-memory stand-in for serial.Serial with the calls TagReader uses.
+    The simulation side puts bytes in with send(), read() blocks up to timeout
+    or until cancel_read().
+    """
+    def __init__(self, port=None, baudrate=9600, timeout=0.5):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.buffer = bytearray()
+        self.condition = threading.Condition()
+        self.is_open = True
+        self.cancelled = False
+        # number of read() calls, i.e. how often the reader woke up
+        self.reads = 0
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        with self.condition:
+            self.is_open = False
+            self.condition.notify_all()
+
+    def flush(self):
+        pass
+
+    def inWaiting(self):
+        return len(self.buffer)
+
+    def read(self, size=1):
+        with self.condition:
+            self.reads += 1
+            if not self.buffer and self.is_open and not self.cancelled:
+                self.condition.wait(self.timeout)
+            self.cancelled = False
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+
+    # Like pyserial's, makes the read waiting (or the next one) return straight away.
+    def cancel_read(self):
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+    # Simulation side: bytes arriving on the line.
+    def send(self, data):
+        with self.condition:
+            self.buffer += data
+            self.condition.notify_all()
@@ -0,0 +1,262 @@
+__author__ = 'Federico'
+
+import json
+import os
+
+import numpy as np
+
+from EventLog import HEADER, MAGIC, EVENT_CODES, encode_event, encode_tag, parse_text_line, read_events, record_dtype
+
+"""
+Reading the .raw videos written by BrainCamera without loading them.
+
+A .raw file is just frames one after the other, 256 x 256 x 3 bytes each,
+named M<tag>_<epoch of the head fix>.raw. RawVideo memory-maps it as an
+(n_frames, height, width, 3) array, so a frame is only read from disk when
+it is used. SessionIndex matches the events of a session log to the video
+and frame they happened in, and keeps that in a cache file next to the videos.
+"""
+
+# Events that get a frame in the index: reward0, stimulus-N, light-L...
+INDEXED_EVENTS = ('reward', 'stimulus-', 'light-')
+
+
+# "Videos/M123_1436126551.92.raw" -> (123, 1436126551.92)
+def parse_video_name(file_path):
+    name = os.path.basename(file_path)
+    if name.endswith(".raw"):
+        name = name[:-len(".raw")]
+    tag, epoch = name[1:].split("_", 1)
+    return encode_tag(tag), float(epoch)
+
+
+class RawVideo:
+    """
+    One .raw video as an (n_frames, height, width, 3) uint8 memmap.
+    frame_times is the epoch of every frame, from the <name>_timestamps.txt
+    file when there is one, otherwise worked out from the head fix time in
+    the file name and the frame rate. It is only read when first used.
+    """
+    def __init__(self, file_path, resolution=(256, 256), frame_rate=30):
+        self.file_path = file_path
+        self.width, self.height = resolution
+        self.frame_rate = frame_rate
+        self.tag, self.start_time = parse_video_name(file_path)
+        frame_bytes = self.width * self.height * 3
+        # a frame cut short by a crash at the end of the file is left out
+        self.n_frames = os.path.getsize(file_path) // frame_bytes
+        if self.n_frames:
+            self.frames = np.memmap(file_path, dtype=np.uint8, mode='r',
+                                    shape=(self.n_frames, self.height, self.width, 3))
+        else:
+            self.frames = np.zeros((0, self.height, self.width, 3), dtype=np.uint8)
+        self.times = None
+
+    @property
+    def frame_times(self):
+        if self.times is None:
+            self.times = self.read_frame_times()
+        return self.times
+
+    def read_frame_times(self):
+        timestamps_path = timestamps_path_for(self.file_path)
+        if os.path.exists(timestamps_path):
+            times = np.loadtxt(timestamps_path, dtype=np.float64, usecols=(1,), ndmin=1)
+            if len(times) >= self.n_frames:
+                return times[:self.n_frames]
+        return self.start_time + np.arange(self.n_frames) / float(self.frame_rate)
+
+    def __len__(self):
+        return self.n_frames
+
+    def __getitem__(self, item):
+        return self.frames[item]
+
+    # Frame showing epoch t (the last one taken at or before t), -1 if t is outside the video.
+    def frame_at(self, t):
+        if not self.n_frames or t < self.frame_times[0] or t > self.frame_times[-1] + 1.0 / self.frame_rate:
+            return -1
+        return int(np.searchsorted(self.frame_times, t, side='right')) - 1
+
+
+# M<tag>_<epoch>.raw -> M<tag>_<epoch>_timestamps.txt
+def timestamps_path_for(file_path):
+    return file_path[:-len(".raw")] + "_timestamps.txt"
+
+
+# Size and modification time of a video and of its timestamps file (None if it has none).
+def video_key(file_path):
+    key = [os.path.basename(file_path), os.path.getsize(file_path), os.path.getmtime(file_path)]
+    timestamps_path = timestamps_path_for(file_path)
+    if os.path.exists(timestamps_path):
+        return key + [os.path.getsize(timestamps_path), os.path.getmtime(timestamps_path)]
+    return key + [None, None]
+
+
+class VideoList:
+    """The RawVideo of each path, only opened when asked for."""
+    def __init__(self, paths, resolution, frame_rate):
+        self.paths = paths
+        self.resolution = resolution
+        self.frame_rate = frame_rate
+        self.videos = [None] * len(paths)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, v):
+        if self.videos[v] is None:
+            self.videos[v] = RawVideo(self.paths[v], self.resolution, self.frame_rate)
+        return self.videos[v]
+
+    def __iter__(self):
+        for v in range(len(self.paths)):
+            yield self[v]
+
+
+"""
+Events of a session log as an EventLog record array, from either the binary
+event file or the text file written by DataCollector.
+"""
+def load_events(log_path):
+    with open(log_path, 'rb') as f:
+        is_binary = f.read(HEADER.size)[:len(MAGIC)] == MAGIC
+    if is_binary:
+        return read_events(log_path)
+    rows = []
+    with open(log_path) as text_file:
+        for line in text_file:
+            parsed = parse_text_line(line)
+            if parsed is None:
+                continue
+            tag, epoch, event = parsed
+            rows.append((encode_tag(tag), epoch) + encode_event(event))
+    return np.array(rows, dtype=record_dtype())
+
+
+class SessionIndex:
+    """
+    Maps the events of a session to the frames of its videos.
+
+    events is the record array of the log, with the video (position in
+    videos, -1 if no video) and frame number of every reward, stimulus and
+    light event. frame(i) gets the frame of event i without reading anything
+    else from disk. The index is saved to cache_path (frame_index.npz in the
+    video folder by default) and only rebuilt when the log or the videos change.
+    The cache also keeps the frame times of every video, so a rebuild only
+    reads the timestamps of the videos that changed, and the videos
+    themselves are only opened when one of their frames is asked for.
+    """
+    def __init__(self, log_path, video_dir, resolution=(256, 256), frame_rate=30, cache_path=None):
+        self.log_path = log_path
+        self.video_dir = video_dir
+        self.resolution = resolution
+        self.frame_rate = frame_rate
+        if cache_path is None:
+            cache_path = os.path.join(video_dir, "frame_index.npz")
+        self.cache_path = cache_path
+
+        self.records = load_events(log_path)
+        video_names = sorted(f for f in os.listdir(video_dir) if f.startswith("M") and f.endswith(".raw"))
+        self.video_paths = [os.path.join(video_dir, f) for f in video_names]
+        self.videos = VideoList(self.video_paths, resolution, frame_rate)
+        # frame times of the videos, from the cache or read as the index is built
+        self.frame_times = [None] * len(self.video_paths)
+
+        video_keys = [json.dumps(video_key(path)) for path in self.video_paths]
+        key = self.cache_key(video_keys)
+        if not self.load_cache(key, video_keys):
+            self.video_of_event, self.frame_of_event = self.build()
+            self.save_cache(key, video_keys)
+
+    # Size and modification time of everything the index depends on.
+    def cache_key(self, video_keys):
+        log_key = [os.path.basename(self.log_path), os.path.getsize(self.log_path), os.path.getmtime(self.log_path)]
+        return json.dumps([log_key] + video_keys + [list(self.resolution), self.frame_rate])
+
+    # Loads the index if key matches, otherwise keeps the frame times of the videos still the same.
+    def load_cache(self, key, video_keys):
+        if not os.path.exists(self.cache_path):
+            return False
+        try:
+            with np.load(self.cache_path) as cache:
+                if str(cache['key']) == key:
+                    self.video_of_event = cache['video']
+                    self.frame_of_event = cache['frame']
+                    return True
+                if 'video_keys' not in cache:
+                    return False
+                cached = dict(zip(cache['video_keys'].tolist(),
+                                  np.split(cache['times'], np.cumsum(cache['n_frames'])[:-1])))
+        except (IOError, KeyError, ValueError):
+            return False
+        for v, video in enumerate(video_keys):
+            if video in cached:
+                self.frame_times[v] = cached[video]
+        return False
+
+    def save_cache(self, key, video_keys):
+        times = [self.times_of(v) for v in range(len(self.video_paths))]
+        # written to a temporary name first so a crash never leaves half an index
+        temp_path = self.cache_path + ".tmp.npz"
+        np.savez(temp_path, key=np.array(key), video=self.video_of_event, frame=self.frame_of_event,
+                 video_keys=np.array(video_keys, dtype=str), n_frames=np.array([len(t) for t in times], dtype=np.int64),
+                 times=np.concatenate(times) if times else np.zeros(0))
+        os.replace(temp_path, self.cache_path)
+
+    # Frame times of video v, read from its files unless the cache had them.
+    def times_of(self, v):
+        if self.frame_times[v] is None:
+            self.frame_times[v] = self.videos[v].frame_times
+        return self.frame_times[v]
+
+    def build(self):
+        records = self.records
+        video_of_event = np.full(len(records), -1, dtype=np.int32)
+        frame_of_event = np.full(len(records), -1, dtype=np.int64)
+        if not len(records):
+            return video_of_event, frame_of_event
+        wanted = np.isin(records['event'], [EVENT_CODES[event] for event in INDEXED_EVENTS])
+        for v, path in enumerate(self.video_paths):
+            frame_times = self.times_of(v)
+            if not len(frame_times):
+                continue
+            tag = parse_video_name(path)[0]
+            end_time = frame_times[-1] + 1.0 / self.frame_rate
+            mask = (wanted & (records['tag'] == tag) &
+                    (records['epoch'] >= frame_times[0]) & (records['epoch'] <= end_time))
+            events = np.nonzero(mask)[0]
+            video_of_event[events] = v
+            frame_of_event[events] = np.searchsorted(frame_times, records['epoch'][events], side='right') - 1
+        return video_of_event, frame_of_event
+
+    def __len__(self):
+        return len(self.records)
+
+    # Numbers of the events with a frame, optionally filtered like EventLog.select.
+    def indexed(self, mask=None):
+        has_frame = self.video_of_event >= 0
+        if mask is not None:
+            has_frame &= mask
+        return np.nonzero(has_frame)[0]
+
+    # (video, frame number) of event i, (None, -1) if it has no frame.
+    def locate(self, i):
+        v = self.video_of_event[i]
+        if v < 0:
+            return None, -1
+        return self.videos[v], int(self.frame_of_event[i])
+
+    # Frame of event i, a view into the memmap.
+    def frame(self, i):
+        video, n = self.locate(i)
+        if video is None:
+            raise KeyError("Event " + str(i) + " has no video frame")
+        return video[n]
+
+    # before frames before event i to after frames after it, as a view (cut at the ends of the video).
+    def frames_around(self, i, before, after):
+        video, n = self.locate(i)
+        if video is None:
+            raise KeyError("Event " + str(i) + " has no video frame")
+        return video[max(0, n - before):n + after + 1]
@@ -0,0 +1,457 @@
+__author__ = 'Federico'
+
+import gc
+import multiprocessing
+import os
+import struct
+import threading
+from datetime import datetime
+from multiprocessing import shared_memory
+from time import sleep, monotonic
+
+import numpy as np
+
+from EventLog import decode_event, encode_event, encode_tag
+from FrameBus import attach
+from HeadFix import Task
+from Journal import MouseJournal
+from Modules import DataCollector, MouseRegistry
+
+"""
+Real-time mode of the task: the timing-critical loop in a process of its own.
+
+In the normal mode the sensors, pistons, rewards and stimuli share one
+Python process with the data file, the binary event log, the event stream,
+the journal and the quickStats file, whose writer threads compete with it
+for the interpreter, so a slow USB disk under /media/Cage1 can still show
+up in the valve and piston timing. In real-time mode the Task runs in a control
+process (RealtimeTask, optionally pinned to a core at SCHED_FIFO priority)
+that never touches those files: its events and mouse counts go into two
+preallocated single-producer/single-consumer rings in shared memory, and
+the process that started it (IOWorker) drains them and does all the
+writing. Putting a record in a ring is a pack and a copy, with no lock
+shared with the other process and no system call, and the control
+process never waits for the disk unless a ring is full (4096 events, far
+more than a session ever has waiting). Video was already written by the
+camera's own threads and compressed in a process of its own, see
+VideoCompression.py.
+
+Rings, little endian:
+    header   64 bytes: magic "HFSPSC01", uint32 record size, uint32 capacity,
+             int64 head (records put, written only by the producer),
+             int64 tail (records taken, written only by the consumer)
+    records  capacity * record size, from byte 64
+Event records are EventLog records plus the time they were saved (the
+datetime column of the data file), journal records are Journal records
+without the CRC. Setting the files up, flushing and closing, which are
+rare and may wait, go over a Pipe.
+"""
+
+MAGIC = b"HFSPSC01"
+HEADER = struct.Struct("<8sII")
+HEAD_OFFSET = 16
+TAIL_OFFSET = 24
+RECORDS_OFFSET = 64
+
+# tag, epoch, event code, argument (as in EventLog.RECORD), time it was saved
+EVENT_RECORD = struct.Struct("<QdHhd")
+# tag, entries, entrance_rewards, headfixes, headfixed_rewards (as in Journal.RECORD)
+COUNTS_RECORD = struct.Struct("<QIIII")
+
+# tag of the session events, as the data file has it
+SESSION_TAG = '0000000000'
+
+
+class SPSCRing:
+    """
+    A ring of capacity fixed-size records in shared memory, for exactly one
+    producer and one consumer (each may be in any process). Made with
+    record_size and capacity it creates the segment (name, or one picked by
+    the system, see self.name), made with only name it attaches to it.
+    Each side only ever writes its own counter, after the record it covers,
+    so neither needs a lock.
+    """
+    def __init__(self, record_size=None, capacity=None, name=None):
+        self.owner = record_size is not None
+        if self.owner:
+            memory = shared_memory.SharedMemory(name=name, create=True, size=RECORDS_OFFSET + record_size * capacity)
+            memory.buf[:HEADER.size] = HEADER.pack(MAGIC, record_size, capacity)
+        else:
+            memory = attach(name)
+            magic, record_size, capacity = HEADER.unpack_from(memory.buf)
+            if magic != MAGIC:
+                memory.close()
+                raise ValueError(name + " is not a ring")
+        self.memory = memory
+        self.name = memory.name
+        self.record_size = record_size
+        self.capacity = capacity
+        self.head = np.ndarray((1,), dtype=np.int64, buffer=memory.buf, offset=HEAD_OFFSET)
+        self.tail = np.ndarray((1,), dtype=np.int64, buffer=memory.buf, offset=TAIL_OFFSET)
+        self.records = np.ndarray((capacity, record_size), dtype=np.uint8, buffer=memory.buf, offset=RECORDS_OFFSET)
+        if self.owner:
+            self.head[0] = 0
+            self.tail[0] = 0
+        # times put() found the ring full
+        self.full_count = 0
+
+    def __len__(self):
+        return int(self.head[0] - self.tail[0])
+
+    # Producer side: adds record (record_size bytes), returns False if the ring is full.
+    def put(self, record):
+        head = int(self.head[0])
+        if head - int(self.tail[0]) >= self.capacity:
+            self.full_count += 1
+            return False
+        self.records[head % self.capacity] = np.frombuffer(record, dtype=np.uint8)
+        self.head[0] = head + 1
+        return True
+
+    # Consumer side: takes up to max_records records, oldest first, as bytes.
+    def get_batch(self, max_records=512):
+        tail = int(self.tail[0])
+        n = min(int(self.head[0]) - tail, max_records)
+        if n <= 0:
+            return []
+        first = tail % self.capacity
+        if first + n <= self.capacity:
+            data = self.records[first:first + n].tobytes()
+        else:
+            data = self.records[first:].tobytes() + self.records[:first + n - self.capacity].tobytes()
+        self.tail[0] = tail + n
+        size = self.record_size
+        return [data[i:i + size] for i in range(0, n * size, size)]
+
+    # The views have to go before the segment can be closed, the creator also removes it.
+    def close(self):
+        if self.memory is None:
+            return
+        self.head = self.tail = self.records = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+        self.memory = None
+
+
+# Puts record in ring, waiting for room if it is full. Returns whether it had to wait.
+def put_waiting(ring, record, poll_interval=0.001):
+    if ring.put(record):
+        return False
+    while not ring.put(record):
+        sleep(poll_interval)
+    return True
+
+
+class RingWriter:
+    """
+    Takes the place of the BackgroundWriter of a DataCollector in the control
+    process: put() packs the event into the event ring, the IOWorker at the
+    other end writes it. flush() waits for the worker to have it on disk.
+    Threads of the control process take turns putting, so the ring still
+    has one producer.
+    """
+    def __init__(self, ring, connection):
+        self.ring = ring
+        self.connection = connection
+        self.lock = threading.Lock()
+        # number of times put() had to wait for room in the ring
+        self.stall_count = 0
+
+    def put(self, event):
+        tag, time_event, date_time, name = event
+        code, argument = encode_event(name)
+        record = EVENT_RECORD.pack(encode_tag(tag), time_event, code, argument, date_time.timestamp())
+        with self.lock:
+            if put_waiting(self.ring, record):
+                self.stall_count += 1
+
+    def flush(self, fsync=False):
+        with self.lock:
+            self.connection.send(("flush", fsync))
+            self.connection.recv()
+
+    def close(self):
+        self.flush(fsync=True)
+
+
+class RingJournal:
+    """
+    Journal of a MouseRegistry in the control process: every change goes into
+    the counts ring, the IOWorker journals it and rewrites the quickStats file.
+    state is what the worker recovered from the real journal.
+    """
+    def __init__(self, ring, state):
+        self.ring = ring
+        self.state = state
+        self.lock = threading.Lock()
+        self.stall_count = 0
+
+    def write(self, mouse):
+        record = COUNTS_RECORD.pack(encode_tag(mouse.tag), mouse.entries, mouse.entrance_rewards,
+                                    mouse.headfixes, mouse.headfixed_rewards)
+        with self.lock:
+            if put_waiting(self.ring, record):
+                self.stall_count += 1
+
+    def close(self):
+        pass
+
+
+class RingMouseRegistry(MouseRegistry):
+    """The control process's registry, the IOWorker writes the quickStats file after every change."""
+    def save_stats(self):
+        pass
+
+    # The counts ring never waits for the disk, so the change goes straight in, without a thread.
+    def journal_change(self, mouse):
+        self.journal.write(mouse)
+
+
+class RealtimeTask(Task):
+    """
+    The Task of the control process. events and counts are the names of the
+    event and counts rings, connection the control process's end of the Pipe
+    to the IOWorker, the rest as for Task.
+    """
+    def __init__(self, events, counts, connection, gpio=None, config=None, serial_port=None, camera=None):
+        self.event_ring = SPSCRing(name=events)
+        self.counts_ring = SPSCRing(name=counts)
+        self.connection = connection
+        Task.__init__(self, gpio, config, serial_port, camera, RingMouseRegistry())
+
+    # The IOWorker opens the files, and hands back the mice of the journal if asked to.
+    def make_collector(self):
+        self.connection.send(("open", {
+            "data_full_path": self.data_full_path,
+            "binary_full_path": self.binary_full_path if self.save_binary_events else None,
+            "stats_full_path": self.stats_full_path,
+            "journal_full_path": self.journal_full_path if self.resume_from_journal else None,
+            "journal_snapshot_interval": self.journal_snapshot_interval,
+            "journal_fsync": self.journal_fsync,
+            "print_events": self.print_events,
+            "data_flush_interval": self.data_flush_interval,
+            "event_stream_address": self.event_stream_address,
+            "cage_id": self.cage_id}))
+        state = self.connection.recv()
+        self.mice.restore(RingJournal(self.counts_ring, state))
+        return DataCollector(None, echo=False, metrics=self.metrics, clock=self.wall_clock,
+                             writer=RingWriter(self.event_ring, self.connection), status=self.status_board)
+
+    def quit(self):
+        Task.quit(self)
+        self.connection.send(("close", None))
+        self.connection.recv()
+        self.event_ring.close()
+        self.counts_ring.close()
+
+
+class IOWorker:
+    """
+    The other end of the rings: writes the events of the control process
+    to its data files (and event stream) and its mouse counts to the journal
+    and the quickStats file. collector and mice, given, replace the ones
+    the control process asks for, i.e. to test or benchmark the worker.
+    The rings are looked at every poll_interval seconds.
+    """
+    def __init__(self, event_ring, counts_ring, connection, collector=None, mice=None, flush_interval=1.0,
+                 poll_interval=0.005):
+        self.event_ring = event_ring
+        self.counts_ring = counts_ring
+        self.connection = connection
+        self.collector = collector
+        self.mice = mice
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+        self.events_written = 0
+        self.counts_written = 0
+        self.last_flush = monotonic()
+        self.dirty = False
+        self.closed = False
+
+    # Files of the control process's settings, returns the mice recovered from the journal.
+    def open(self, settings):
+        if self.collector is None:
+            stream = None
+            if settings["event_stream_address"] is not None:
+                from EventStream import EventStream
+                stream = EventStream(settings["event_stream_address"], settings["cage_id"],
+                                     settings["data_full_path"][:-len(".txt")] + ".spool")
+            self.collector = DataCollector(settings["data_full_path"], echo=settings["print_events"],
+                                           binary_file_path=settings["binary_full_path"], stream=stream)
+            self.flush_interval = settings["data_flush_interval"]
+        if self.mice is None:
+            self.mice = MouseRegistry(settings["stats_full_path"])
+            if settings["journal_full_path"] is not None:
+                journal = MouseJournal(settings["journal_full_path"], settings["journal_snapshot_interval"],
+                                       settings["journal_fsync"])
+                resumed = self.mice.restore(journal)
+                if resumed:
+                    print ("Resumed " + str(resumed) + " mice from " + settings["journal_full_path"])
+        state = {}
+        for mouse in self.mice:
+            state[mouse.tag] = (mouse.entries, mouse.entrance_rewards, mouse.headfixes, mouse.headfixed_rewards)
+        return state
+
+    # Writes whatever is in the rings, returns the number of records.
+    def drain(self):
+        n_records = 0
+        while True:
+            records = self.event_ring.get_batch()
+            if not records:
+                break
+            events = []
+            for record in records:
+                tag, time_event, code, argument, saved = EVENT_RECORD.unpack(record)
+                events.append((tag if tag else SESSION_TAG, time_event, datetime.fromtimestamp(saved),
+                               decode_event(code, argument)))
+            self.collector.write_events(events)
+            self.events_written += len(events)
+            self.dirty = True
+            n_records += len(records)
+        changed = False
+        while True:
+            records = self.counts_ring.get_batch()
+            if not records:
+                break
+            for record in records:
+                tag, entries, entrance_rewards, headfixes, headfixed_rewards = COUNTS_RECORD.unpack(record)
+                mouse = self.mice.get(tag)
+                if mouse is None:
+                    mouse = self.mice.add(tag)
+                mouse.entries = entries
+                mouse.entrance_rewards = entrance_rewards
+                mouse.headfixes = headfixes
+                mouse.headfixed_rewards = headfixed_rewards
+                self.mice.mark_changed(mouse)
+            self.counts_written += len(records)
+            n_records += len(records)
+            changed = True
+        if changed and self.mice.stats_file_path is not None:
+            self.mice.save_stats()
+        if self.dirty and monotonic() - self.last_flush >= self.flush_interval:
+            self.flush(False)
+        return n_records
+
+    def flush(self, fsync):
+        self.collector.flush_events(fsync)
+        if self.collector.stream is not None:
+            self.collector.stream.flush()
+        self.last_flush = monotonic()
+        self.dirty = False
+
+    def handle(self, command, argument):
+        if command == "open":
+            self.connection.send(self.open(argument))
+        elif command == "flush":
+            self.flush(argument)
+            self.connection.send(True)
+        elif command == "close":
+            self.close()
+            self.connection.send(True)
+
+    """
+    Works until the control process closes it, or until process (the control
+    process, if given) is gone, in which case what it left in the rings is
+    still written.
+    """
+    def run(self, process=None):
+        while not self.closed:
+            message = None
+            try:
+                if self.connection.poll(self.poll_interval):
+                    message = self.connection.recv()
+            except EOFError:
+                message = ("close", None)
+            # everything put in the rings before the message was sent is written first
+            if self.collector is not None:
+                self.drain()
+            if message is not None:
+                try:
+                    self.handle(*message)
+                except (BrokenPipeError, EOFError):
+                    self.close()
+            elif process is not None and not process.is_alive():
+                self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.collector is not None:
+            self.drain()
+            self.flush(True)
+            self.collector.close()
+        if self.mice is not None:
+            self.mice.close()
+
+
+"""
+Pins the calling process to core, if not None, and gives it SCHED_FIFO
+priority (1-99), if not None. Either needs the rights to, without them
+the process carries on as it is.
+"""
+def set_realtime(core=None, priority=None):
+    if core is not None:
+        try:
+            os.sched_setaffinity(0, [core])
+        except (AttributeError, OSError) as e:
+            print ("Could not pin the control process to core " + str(core) + ": " + str(e))
+    if priority is not None:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        except (AttributeError, OSError) as e:
+            print ("Could not give the control process real-time priority " + str(priority) + ": " + str(e))
+
+
+# Body of the control process.
+def control_process(events, counts, connection, config, simulated):
+    set_realtime(config.get("realtime_core"), config.get("realtime_priority"))
+    gpio = serial_port = camera = None
+    if simulated:
+        from GPIOBackend import SimulatedGPIO
+        from RFIDFramer import SimulatedSerial
+        from VideoRingBuffer import SimulatedCamera
+        gpio = SimulatedGPIO()
+        serial_port = SimulatedSerial()
+        camera = SimulatedCamera()
+    task = RealtimeTask(events, counts, connection, gpio, config, serial_port, camera)
+    # everything made so far lives for the whole session, the collector never has to go over it again
+    gc.freeze()
+    try:
+        task.start()
+    except KeyboardInterrupt:
+        task.quit()
+        task.gpio.cleanup()
+
+
+"""
+Runs the task of config (as for HeadFix.Task) in real-time mode: the
+control process is started and this one becomes its IOWorker until it
+ends. The cage ID is asked here, the control process has no console input.
+"""
+def run_realtime(config, simulated=False, event_capacity=4096, counts_capacity=1024):
+    config = dict(config)
+    if config.get("cage_id") is None:
+        config["cage_id"] = input("Type the cage ID: ")
+    config["confirm_paths"] = False
+    event_ring = SPSCRing(EVENT_RECORD.size, event_capacity)
+    counts_ring = SPSCRing(COUNTS_RECORD.size, counts_capacity)
+    worker_end, control_end = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=control_process, name="HeadFixControl",
+                                      args=(event_ring.name, counts_ring.name, control_end, config, simulated))
+    process.start()
+    worker = IOWorker(event_ring, counts_ring, worker_end)
+    try:
+        while True:
+            try:
+                worker.run(process)
+                break
+            except KeyboardInterrupt:
+                # the control process gets it too, and closes the worker once it has quit
+                continue
+        process.join()
+    finally:
+        worker.close()
+        event_ring.close()
+        counts_ring.close()
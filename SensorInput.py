@@ -0,0 +1,123 @@
+__author__ = 'Federico'
+
+import threading
+from time import monotonic
+
+
+class EdgeInput:
+    """
+    Edge-triggered input for the chamber sensors (head bar contact and tag in range).
+    Instead of polling GPIO.input every cpu_rest_time, the GPIO backend calls
+    on_edge when a pin changes. The time is taken right there, the level is
+    debounced, and anybody blocked in wait_for is woken up immediately.
+    """
+    def __init__(self, gpio, pins, debounce_time=0.005, clock=monotonic):
+        # GPIO backend (RPi.GPIO or SimulatedGPIO)
+        self.gpio = gpio
+        # pins being watched
+        self.pins = list(pins)
+        # an edge closer than this to the previous accepted one on the same pin is bounce
+        self.debounce_time = debounce_time
+        # function returning the current time in seconds
+        self.clock = clock
+
+        self.condition = threading.Condition()
+        # debounced level of each pin
+        self.levels = {}
+        # time of the last accepted edge of each pin
+        self.edge_times = {}
+        # time of the last raw edge of each pin, used when re-syncing after bounce
+        self.raw_edge_times = {}
+        # pins with a pending re-check after a bounce
+        self.resync_timers = {}
+        # number of accepted edges so far
+        self.edge_count = 0
+        # functions called as listener(pin, level, edge_time) on every accepted edge
+        self.listeners = []
+
+        # Start as if the pins settled one debounce time ago, so the very first edge is not taken as bounce.
+        settled = self.clock() - self.debounce_time
+        for pin in self.pins:
+            self.levels[pin] = self.gpio.input(pin)
+            self.edge_times[pin] = settled
+            self.raw_edge_times[pin] = settled
+            self.gpio.add_event_detect(pin, self.gpio.BOTH, callback=self.on_edge)
+
+    # Called by the GPIO backend from its own thread on every raw edge.
+    def on_edge(self, pin):
+        timestamp = self.clock()
+        level = self.gpio.input(pin)
+        with self.condition:
+            self.raw_edge_times[pin] = timestamp
+            if timestamp - self.edge_times[pin] < self.debounce_time:
+                # Still bouncing, look at the pin again once it has settled.
+                self.schedule_resync(pin)
+                return
+            self.accept_edge(pin, level, timestamp)
+
+    def accept_edge(self, pin, level, timestamp):
+        if level == self.levels[pin]:
+            return
+        self.levels[pin] = level
+        self.edge_times[pin] = timestamp
+        self.edge_count += 1
+        self.condition.notify_all()
+        # Called with the lock held, listeners must only hand the edge over.
+        for listener in self.listeners:
+            listener(pin, level, timestamp)
+
+    def add_listener(self, listener):
+        with self.condition:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self.condition:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def schedule_resync(self, pin):
+        if pin in self.resync_timers:
+            return
+        timer = threading.Timer(self.debounce_time, self.resync, [pin])
+        timer.daemon = True
+        self.resync_timers[pin] = timer
+        timer.start()
+
+    def resync(self, pin):
+        level = self.gpio.input(pin)
+        with self.condition:
+            self.resync_timers.pop(pin, None)
+            self.accept_edge(pin, level, self.raw_edge_times[pin])
+
+    def level(self, pin):
+        with self.condition:
+            return self.levels[pin]
+
+    """
+    Blocks until one of the (pin, level) pairs in conditions is true, checked in order.
+    Returns (pin, edge_time) of the pair that matched, where edge_time is when that pin
+    reached the level, or (None, None) if timeout seconds went by first.
+    """
+    def wait_for(self, conditions, timeout=None):
+        if timeout is not None:
+            deadline = self.clock() + timeout
+        with self.condition:
+            while True:
+                for pin, level in conditions:
+                    if self.levels[pin] == level:
+                        return pin, self.edge_times[pin]
+                if timeout is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        return None, None
+                    self.condition.wait(remaining)
+
+    def close(self):
+        for pin in self.pins:
+            self.gpio.remove_event_detect(pin)
+        with self.condition:
+            for timer in self.resync_timers.values():
+                timer.cancel()
+            self.resync_timers.clear()
@@ -0,0 +1,498 @@
+__author__ = 'Federico'
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+from time import perf_counter, time
+
+from EventLog import encode_tag, parse_text_line
+from GPIOBackend import SimulatedGPIO
+from HeadFix import Task, load_config
+from Modules import TagReader
+from RFIDFramer import SimulatedSerial, make_frame
+from SensorInput import EdgeInput
+from StimulusScheduler import WaveformPlayer
+from VirtualTime import ScheduledClock, VirtualTimeEventLoop
+
+"""
+Discrete-event simulation of a cage session on a virtual clock.
+
+The unchanged Task runs against virtual-time versions of its devices: the
+sensors, the RFID reader, the waveform player and the trial engine's event
+loop all wait by running the scheduled mouse behaviour (Visits) up to the
+time they wait for instead of sleeping, so hours of a session take seconds.
+The behaviour is made up by generate_visits or replayed from a DataCollector
+log by visits_from_log. expected_session works out what the task should do
+with it, and Simulation.check compares that to the data and quickStats
+files it actually wrote.
+"""
+
+# Settings every simulated task gets, on top of the config given.
+SIMULATION_CONFIG = {
+    "cage_id": "SIM",
+    "confirm_paths": False,
+    "print_events": False,
+    "metrics_interval": None,
+    "pretrigger_video_seconds": None,
+}
+
+# Shortest time between two scripted edges, so none of them is taken as bounce.
+MIN_GAP = 0.01
+
+
+class SimulationFinished(Exception):
+    """Raised in the task when it waits for something that will never happen again."""
+    pass
+
+
+class VirtualEdgeInput(EdgeInput):
+    """EdgeInput whose waits run the clock's scheduled events instead of blocking."""
+    def schedule_resync(self, pin):
+        if pin in self.resync_timers:
+            return
+        self.resync_timers[pin] = None
+        self.clock.schedule(self.clock() + self.debounce_time, lambda: self.resync(pin))
+
+    def wait_for(self, conditions, timeout=None):
+        matched = []
+
+        def any_condition():
+            for pin, level in conditions:
+                if self.levels[pin] == level:
+                    matched.append((pin, self.edge_times[pin]))
+                    return True
+            return False
+
+        deadline = None if timeout is None else self.clock() + timeout
+        if self.clock.wait_until(any_condition, deadline):
+            return matched[-1]
+        if timeout is None:
+            raise SimulationFinished("Nothing left to happen on the sensors")
+        return None, None
+
+    def close(self):
+        for pin in self.pins:
+            self.gpio.remove_event_detect(pin)
+        self.resync_timers.clear()
+
+
+class VirtualWaveformPlayer(WaveformPlayer):
+    def wait_until(self, deadline):
+        self.clock.advance_to(deadline)
+
+
+class VirtualTagReader(TagReader):
+    """
+    TagReader without the listener thread: wait_for_tag reads the simulated
+    serial line (with no timeout) every time the clock moves.
+    """
+    def start_listener(self, callback=None):
+        self.callback = callback
+
+    def wait_for_tag(self, timeout=None):
+        found = []
+
+        def tag_read():
+            for tag, read_time in self.read_available():
+                found.append((tag, read_time))
+                if self.callback is not None:
+                    self.callback(tag, read_time)
+            return bool(found)
+
+        deadline = None if timeout is None else self.clock() + timeout
+        if self.clock.wait_until(tag_read, deadline):
+            return found[-1]
+        if timeout is None:
+            raise SimulationFinished("No more mice coming")
+        return None, None
+
+
+class VirtualCamera:
+    """Stands in for BrainCamera, only keeps [start, stop, video name] of every recording."""
+    video_extension = ".raw"
+    exposure_settled = True
+    motion = None
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.recordings = []
+
+    def start_recording(self, video_name_path, on_motion=None):
+        self.recordings.append([self.clock(), None, video_name_path])
+
+    def stop_recording(self):
+        self.recordings[-1][1] = self.clock()
+
+    def close(self):
+        pass
+
+
+class SimulatedTask(Task):
+    """
+    The Task with virtual-time devices, all on clock (a ScheduledClock on the epoch).
+    gpio is a SimulatedGPIO and serial_line the SimulatedSerial of the RFID reader,
+    for the simulation to drive.
+    """
+    def __init__(self, clock, config=None):
+        self.virtual_clock = clock
+        self.serial_line = SimulatedSerial(timeout=0)
+        settings = dict(SIMULATION_CONFIG)
+        if config is not None:
+            settings.update(config)
+        Task.__init__(self, SimulatedGPIO(clock), settings, self.serial_line)
+
+    def setup(self, serial_port=None, camera=None):
+        self.clock = self.virtual_clock
+        self.wall_clock = self.virtual_clock
+        Task.setup(self, serial_port, camera)
+
+    def make_reader(self, serial_port=None):
+        return VirtualTagReader(self.serial_port, self.tag_dedupe_window, serial_port, self.wall_clock)
+
+    def make_camera(self, camera=None):
+        return VirtualCamera(self.clock)
+
+    def make_sensors(self):
+        return VirtualEdgeInput(self.gpio, [self.contact_pin, self.range_pin], self.sensor_debounce_time, self.clock)
+
+    def make_player(self):
+        return VirtualWaveformPlayer(self.gpio, self.clock)
+
+    def make_event_loop(self):
+        return VirtualTimeEventLoop(self.clock)
+
+
+class Visit:
+    """
+    One mouse in the chamber: tag in range (and read) at entry, out of range at
+    exit, and head bar contact over each (on, off) in contacts. Times are epochs.
+    """
+    def __init__(self, tag, entry, exit_time=None, contacts=None):
+        self.tag = tag
+        self.entry = entry
+        self.exit = exit_time
+        self.contacts = [] if contacts is None else list(contacts)
+
+
+"""
+Mouse behaviour for duration seconds from start_time, with n_mice mice:
+some only look in and leave, some take the head fix once or more, some
+pull out in the middle of it. The timings are drawn around the task's
+settings so that no two things the task could tell apart happen at the
+same time, which keeps expected_session exact.
+"""
+def generate_visits(task, start_time, duration, n_mice=10, mean_interval=60.0, seed=0):
+    rng = random.Random(seed)
+    tags = [rng.randrange(1, 1 << 40) for i in range(n_mice)]
+    delay = task.entrance_reward_delay_time
+    headfix_length = task.number_of_headfix_rewards * task.inter_reward_interval
+    visits = []
+    t = start_time
+    last_read = {}
+    while True:
+        tag = rng.choice(tags)
+        t += rng.expovariate(1.0 / mean_interval)
+        # the reader drops the same tag again within the dedupe window
+        t = max(t, last_read.get(tag, t) + task.tag_dedupe_window + 0.1)
+        if t > start_time + duration:
+            return visits
+        visit = Visit(tag, t)
+        last_read[tag] = t
+        if rng.random() < 0.2:
+            # looks in and leaves before the entrance reward
+            visit.exit = t + rng.uniform(0.05, delay - 0.05)
+        else:
+            if rng.random() < 0.3:
+                on = t + rng.uniform(0.05, delay - 0.05)
+            else:
+                on = t + delay + task.reward_time + rng.uniform(0.05, 30.0)
+            while True:
+                if rng.random() < 0.15:
+                    # pulls out during the head fix
+                    out = on + rng.uniform(0.05, headfix_length - 0.05)
+                    visit.contacts.append((on, out))
+                    visit.exit = out
+                    break
+                off = on + headfix_length + rng.uniform(0.05, task.skedaddle_time - 0.05)
+                visit.contacts.append((on, off))
+                if rng.random() < 0.3:
+                    on = on + headfix_length + task.skedaddle_time + rng.uniform(0.05, 20.0)
+                    continue
+                visit.exit = off + rng.uniform(0.05, 20.0)
+                break
+        visits.append(visit)
+        t = visit.exit
+
+
+"""
+Visits replaying the mice of a DataCollector text log (like test.txt): every
+entry to its exit, with head bar contact from each check+ to the complete
+or abort after it. A visit cut short by the session ending (SeshStart,
+SeshEnd or another entry) ends there. Times are moved forward where needed
+so every edge is at least MIN_GAP after the one before, and so the same tag
+is not read twice within dedupe_window.
+"""
+def visits_from_log(log_path, dedupe_window=1.0):
+    visits = []
+    visit = None
+    with open(log_path) as log_file:
+        for line in log_file:
+            parsed = parse_text_line(line)
+            if parsed is None:
+                continue
+            tag, epoch, event = parsed
+            if event == 'entry':
+                if visit is not None:
+                    visits.append(end_visit(visit, epoch))
+                visit = Visit(encode_tag(tag), epoch)
+            elif visit is None:
+                continue
+            elif event == 'check+':
+                visit.contacts.append([epoch, None])
+            elif event in ('complete', 'abort'):
+                if visit.contacts and visit.contacts[-1][1] is None:
+                    visit.contacts[-1][1] = epoch
+            elif event in ('exit', 'SeshStart', 'SeshEnd'):
+                visits.append(end_visit(visit, epoch))
+                visit = None
+    if visit is not None:
+        last = max([visit.entry] + [t for contact in visit.contacts for t in contact if t is not None])
+        visits.append(end_visit(visit, last))
+    return spread_visits([v for v in visits if 0 < v.tag < (1 << 40)], dedupe_window)
+
+
+def end_visit(visit, exit_time):
+    visit.exit = exit_time
+    visit.contacts = [(on, exit_time if off is None else off) for on, off in visit.contacts]
+    return visit
+
+
+def spread_visits(visits, dedupe_window):
+    t = None
+    last_read = {}
+    for visit in visits:
+        entry = visit.entry
+        if t is not None:
+            entry = max(entry, t + MIN_GAP)
+        if visit.tag in last_read:
+            entry = max(entry, last_read[visit.tag] + dedupe_window + MIN_GAP)
+        visit.entry = t = last_read[visit.tag] = entry
+        contacts = []
+        for on, off in visit.contacts:
+            on = max(on, t + MIN_GAP)
+            off = max(off, on + MIN_GAP)
+            contacts.append((on, off))
+            t = off
+        visit.contacts = contacts
+        visit.exit = t = max(visit.exit, t + MIN_GAP)
+    return visits
+
+
+"""
+What task should do with visits: the list of (tag, event, time) it should
+save (the session start and end left out) and the quickStats counts of
+every mouse, tag -> (entries, ent_rew, hfixes, hf_rew), following
+run_trial, headfix_loop and headfix_timeline step by step.
+"""
+def expected_session(task, visits):
+    delay = task.entrance_reward_delay_time
+    reward_time = task.reward_time
+    n_rewards = task.number_of_headfix_rewards
+    interval = task.inter_reward_interval
+    events = []
+    stats = {}
+    for visit in visits:
+        tag = visit.tag
+        mouse = stats.setdefault(tag, [0, 0, 0, 0])
+        mouse[0] += 1
+        events.append((tag, 'entry', visit.entry))
+        ons = [on for on, off in visit.contacts]
+
+        def contact(t):
+            return any(on <= t < off for on, off in visit.contacts)
+
+        # entrance reward delay, cut short by contact or by the mouse leaving
+        first_on = min([on for on in ons if on > visit.entry] + [float('inf')])
+        if visit.exit <= min(first_on, visit.entry + delay):
+            events.append((tag, 'exit', visit.exit))
+            continue
+        if first_on <= visit.entry + delay:
+            t = first_on
+        else:
+            t = visit.entry + delay
+            if not contact(t) and mouse[1] < task.maximum_entrance_rewards:
+                mouse[1] += 1
+                t += reward_time
+
+        while True:
+            if contact(t):
+                fix = t
+            else:
+                fix = min([on for on in ons if on > t] + [float('inf')])
+                if visit.exit < fix:
+                    events.append((tag, 'exit', max(t, visit.exit)))
+                    break
+            mouse[2] += 1
+            events.append((tag, 'check+', fix))
+            end = fix + n_rewards * interval
+            aborted = visit.exit < end
+            if aborted:
+                end = visit.exit
+            timed = []
+            for i in range(n_rewards):
+                if fix + i * interval < end:
+                    timed.append((fix + i * interval, 'reward' + str(i)))
+                    if fix + i * interval + reward_time <= end:
+                        mouse[3] += 1
+                if fix + i * interval + interval / 2 < end:
+                    timed.append((fix + i * interval + interval / 2, 'stimulus-' + str(i)))
+            for event_time, event in sorted(timed):
+                events.append((tag, event, event_time))
+            if aborted:
+                events.append((tag, 'abort', end))
+            events.append((tag, 'complete', end))
+            # skedaddle time, or until the mouse leaves
+            t = min(max(visit.exit, end), end + task.skedaddle_time)
+    return events, dict((tag, tuple(counts)) for tag, counts in stats.items())
+
+
+def read_session_events(data_path):
+    events = []
+    with open(data_path) as data_file:
+        for line in data_file:
+            parsed = parse_text_line(line)
+            if parsed is None or parsed[2] in ('SeshStart', 'SeshEnd'):
+                continue
+            tag, epoch, event = parsed
+            events.append((encode_tag(tag), event, epoch))
+    return events
+
+
+def read_quick_stats(stats_path):
+    stats = {}
+    with open(stats_path) as stats_file:
+        next(stats_file)
+        for line in stats_file:
+            fields = line.split()
+            if len(fields) == 5:
+                stats[encode_tag(fields[0])] = tuple(int(field) for field in fields[1:])
+    return stats
+
+
+class Simulation:
+    """
+    A SimulatedTask and the mouse behaviour it is run against. The clock
+    starts at start_time (an epoch, now by default), the data and stats files
+    go under data_root_path (a new temporary folder by default).
+    add_visits schedules the behaviour, run plays it all and check lists
+    what the task did differently from expected_session.
+    """
+    def __init__(self, config=None, data_root_path=None, start_time=None):
+        if start_time is None:
+            start_time = time()
+        if data_root_path is None:
+            data_root_path = tempfile.mkdtemp(prefix="headfix_sim_")
+        settings = {"data_root_path": os.path.join(data_root_path, "")}
+        if config is not None:
+            settings.update(config)
+        self.start_time = start_time
+        self.clock = ScheduledClock(start_time)
+        self.task = SimulatedTask(self.clock, settings)
+        self.visits = []
+        self.real_seconds = 0.0
+
+    def add_visits(self, visits):
+        for visit in visits:
+            if visit.entry < self.clock():
+                raise ValueError("Visit at " + str(visit.entry) + " is before the simulation time")
+            frame = make_frame("%010X" % visit.tag)
+            self.schedule_input(visit.entry, self.task.range_pin, 1)
+            self.clock.schedule(visit.entry, lambda frame=frame: self.task.serial_line.send(frame))
+            for on, off in visit.contacts:
+                self.schedule_input(on, self.task.contact_pin, 1)
+                self.schedule_input(min(off, visit.exit), self.task.contact_pin, 0)
+            self.schedule_input(visit.exit, self.task.range_pin, 0)
+            self.visits.append(visit)
+
+    def schedule_input(self, t, pin, level):
+        gpio = self.task.gpio
+        self.clock.schedule(t, lambda: gpio.set_input(pin, level))
+
+    # Runs the task until nothing is left to happen, then quits it. quiet hides what it prints.
+    def run(self, quiet=True):
+        real_start = perf_counter()
+        output = io.StringIO() if quiet else sys.stdout
+        with contextlib.redirect_stdout(output):
+            try:
+                self.task.start()
+            except SimulationFinished:
+                pass
+            self.task.quit()
+        self.real_seconds = perf_counter() - real_start
+
+    def virtual_seconds(self):
+        return self.clock() - self.start_time
+
+    # Differences between what the task saved and what it should have, empty if none.
+    def check(self, tolerance=1e-6):
+        problems = []
+        expected_events, expected_stats = expected_session(self.task, self.visits)
+        events = read_session_events(self.task.data_full_path)
+        for i, (expected, saved) in enumerate(zip(expected_events, events)):
+            if expected[:2] != saved[:2] or abs(expected[2] - saved[2]) > tolerance:
+                problems.append("Event " + str(i) + ": expected " + str(expected) + ", saved " + str(saved))
+                break
+        if len(events) != len(expected_events):
+            problems.append("Expected " + str(len(expected_events)) + " events, saved " + str(len(events)))
+        stats = read_quick_stats(self.task.stats_full_path)
+        for tag in sorted(set(stats) | set(expected_stats)):
+            if stats.get(tag) != expected_stats.get(tag):
+                problems.append("quickStats of " + str(tag) + ": expected " + str(expected_stats.get(tag)) +
+                                ", saved " + str(stats.get(tag)))
+        head_fixes = sum(counts[2] for counts in expected_stats.values())
+        if len(self.task.camera.recordings) != head_fixes:
+            problems.append("Expected " + str(head_fixes) + " recordings, made " +
+                            str(len(self.task.camera.recordings)))
+        return problems
+
+
+# Usage: python Simulator.py [--log test.txt] [--hours 8] [--mice 10] [--seed 0] [--config rig.json]
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs the head fixing task on simulated mice in virtual time")
+    parser.add_argument("--log", help="replay the mice of this data file instead of made up ones")
+    parser.add_argument("--hours", type=float, default=8.0, help="hours of made up mice")
+    parser.add_argument("--mice", type=int, default=10, help="number of made up mice")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--config", help="JSON file of Task settings")
+    parser.add_argument("--data-path", help="folder for the data files, a temporary one if not given")
+    args = parser.parse_args(argv)
+
+    config = None
+    if args.config is not None:
+        config = load_config(args.config)
+    if args.log is not None:
+        visits = visits_from_log(args.log)
+        if not visits:
+            print ("No mice in " + args.log)
+            return 1
+        simulation = Simulation(config, args.data_path, visits[0].entry - 1.0)
+    else:
+        simulation = Simulation(config, args.data_path)
+        visits = generate_visits(simulation.task, simulation.clock(), args.hours * 3600, args.mice, seed=args.seed)
+    simulation.add_visits(visits)
+    simulation.run()
+    print (str(len(visits)) + " visits, %.2f h in %.2f s" % (simulation.virtual_seconds() / 3600, simulation.real_seconds))
+    print ("Data file: " + simulation.task.data_full_path)
+    problems = simulation.check()
+    for problem in problems:
+        print (problem)
+    print ("OK" if not problems else str(len(problems)) + " problems")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
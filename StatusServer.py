@@ -0,0 +1,400 @@
+__author__ = 'Federico'
+
+import http.client
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import shared_memory
+from time import sleep, monotonic, time
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from EventLog import decode_event, encode_event, encode_tag, record_dtype
+from FrameBus import attach
+
+"""
+The state of a running cage over local HTTP, instead of tailing
+headFix_*.txt and rereading quickStats_*.txt.
+
+The task publishes its recent events and the counts of its mice on a
+StatusBoard, a small shared-memory segment: the DataCollector adds every
+event to a ring of the last event_capacity ones, the MouseRegistry updates
+the row of a mouse whenever it records a change. The StatusServer runs in
+a process of its own and answers from the board, on a TCP address or a
+Unix socket, and never touches the disk:
+
+    GET /status                  cage, mouse inside, the counts of every mouse and the last events
+                                 (events=N of them, 20 by default)
+    GET /mice                    the counts of every mouse
+    GET /events?after=N&wait=30  the events after sequence number N, waiting up to wait seconds
+                                 for one if there are none yet (long poll)
+
+Answers are JSON. Events are {"seq", "tag", "time", "event"}, seq counting
+from 0 since the task started; a client that follows /events with the last
+seq it got sees every event unless it falls more than the ring behind,
+then "missed" says how many it lost.
+
+Publishing an event or a mouse is a few stores into the shared arrays, so
+the control loop never waits for a client, and with the server in another
+process answering them takes no time (nor GIL) from the task's threads.
+Clients waiting for events are not woken by the task: the server looks at
+the board every poll_interval seconds.
+
+Board layout:
+    header       64 bytes: magic "HFSTAT01", uint32 event capacity, uint32 mouse capacity,
+                 int64 sequence number of the next event, int64 number of mice, float64 start time
+    event seqs   int64[event capacity]   sequence number of the event in each slot, -1 while it is written
+    events       EventLog records (tag, epoch, event, arg) [event capacity]
+    mouse seqs   int64[mouse capacity]   odd while the row is written
+    mice         (uint64 tag, uint32 entries, entrance_rewards, headfixes, headfixed_rewards) [mouse capacity]
+"""
+
+MAGIC = b"HFSTAT01"
+HEADER = struct.Struct("<8sIIqqd")
+
+
+def mouse_dtype():
+    return np.dtype([('tag', '<u8'), ('entries', '<u4'), ('entrance_rewards', '<u4'), ('headfixes', '<u4'),
+                     ('headfixed_rewards', '<u4')])
+
+
+def layout(event_capacity, mouse_capacity):
+    event_seqs = 64
+    events = event_seqs + 8 * event_capacity
+    mouse_seqs = events + record_dtype().itemsize * event_capacity
+    mice = mouse_seqs + 8 * mouse_capacity
+    return event_seqs, events, mouse_seqs, mice, mice + mouse_dtype().itemsize * mouse_capacity
+
+
+class StatusBoard:
+    """
+    The last event_capacity events and the counts of up to mouse_capacity
+    mice, in shared memory. Made with create it creates the segment (name,
+    or one picked by the system, see self.name) for the task to publish on,
+    otherwise it attaches to the segment called name to read it.
+    """
+    def __init__(self, event_capacity=1000, mouse_capacity=1024, name=None, create=True):
+        self.owner = create
+        if create:
+            memory = shared_memory.SharedMemory(name=name, create=True,
+                                                size=layout(event_capacity, mouse_capacity)[-1])
+            memory.buf[:HEADER.size] = HEADER.pack(MAGIC, event_capacity, mouse_capacity, 0, 0, time())
+        else:
+            memory = attach(name)
+            magic, event_capacity, mouse_capacity = HEADER.unpack_from(memory.buf)[:3]
+            if magic != MAGIC:
+                memory.close()
+                raise ValueError(name + " is not a status board")
+        self.memory = memory
+        self.name = memory.name
+        self.event_capacity = event_capacity
+        self.mouse_capacity = mouse_capacity
+        self.start_time = HEADER.unpack_from(memory.buf)[5]
+        event_seqs, events, mouse_seqs, mice, size = layout(event_capacity, mouse_capacity)
+        buf = memory.buf
+        self.next_seq = np.ndarray((1,), dtype=np.int64, buffer=buf, offset=16)
+        self.n_mice = np.ndarray((1,), dtype=np.int64, buffer=buf, offset=24)
+        self.event_seqs = np.ndarray((event_capacity,), dtype=np.int64, buffer=buf, offset=event_seqs)
+        self.events = np.ndarray((event_capacity,), dtype=record_dtype(), buffer=buf, offset=events)
+        self.mouse_seqs = np.ndarray((mouse_capacity,), dtype=np.int64, buffer=buf, offset=mouse_seqs)
+        self.mice = np.ndarray((mouse_capacity,), dtype=mouse_dtype(), buffer=buf, offset=mice)
+        if create:
+            self.event_seqs[:] = -1
+            self.mouse_seqs[:] = 0
+        # publisher side: tag -> row of the mice, and mice left out for want of rows
+        self.rows = {}
+        self.mice_left_out = 0
+        # the task's threads take turns publishing
+        self.lock = threading.Lock()
+
+    # Publishes an event, as DataCollector saves it.
+    def add(self, tag, time_event, event):
+        code, argument = encode_event(event)
+        with self.lock:
+            seq = int(self.next_seq[0])
+            slot = seq % self.event_capacity
+            self.event_seqs[slot] = -1
+            self.events[slot] = (encode_tag(tag), time_event, code, argument)
+            self.event_seqs[slot] = seq
+            self.next_seq[0] = seq + 1
+
+    # Publishes the counts of mouse, a Modules.Mouse.
+    def update_mouse(self, mouse):
+        tag = encode_tag(mouse.tag)
+        with self.lock:
+            row = self.rows.get(tag)
+            if row is None:
+                row = len(self.rows)
+                if row >= self.mouse_capacity:
+                    self.mice_left_out += 1
+                    return
+                self.rows[tag] = row
+            self.mouse_seqs[row] += 1
+            self.mice[row] = (tag, mouse.entries, mouse.entrance_rewards, mouse.headfixes, mouse.headfixed_rewards)
+            self.mouse_seqs[row] += 1
+            self.n_mice[0] = len(self.rows)
+
+    """
+    The events with seq above after still on the board, oldest first, as
+    dicts, and how many of those were already overwritten (missed).
+    """
+    def since(self, after=-1):
+        next_seq = int(self.next_seq[0])
+        first = max(after + 1, next_seq - self.event_capacity)
+        events = []
+        for seq in range(first, next_seq):
+            slot = seq % self.event_capacity
+            if self.event_seqs[slot] != seq:
+                continue
+            tag, epoch, code, argument = self.events[slot].tolist()
+            # overwritten while being read
+            if self.event_seqs[slot] != seq:
+                continue
+            events.append({"seq": seq, "tag": tag, "time": epoch, "event": decode_event(code, argument)})
+        missed = max(0, next_seq - (after + 1)) - len(events)
+        return events, missed
+
+    # The counts of every mouse, as dicts.
+    def mouse_counts(self):
+        counts = []
+        for row in range(int(self.n_mice[0])):
+            values = None
+            for attempt in range(100):
+                seq = int(self.mouse_seqs[row])
+                values = self.mice[row].tolist()
+                # a row being written has an odd seq, and a changed one if it was written meanwhile
+                if seq % 2 == 0 and self.mouse_seqs[row] == seq:
+                    break
+                values = None
+                sleep(0)
+            if values is None:
+                continue
+            tag, entries, entrance_rewards, headfixes, headfixed_rewards = values
+            counts.append({"tag": tag, "entries": entries, "entrance_rewards": entrance_rewards,
+                           "headfixes": headfixes, "headfixed_rewards": headfixed_rewards})
+        return counts
+
+    # The views have to go before the segment can be closed, the creator also removes it.
+    def close(self):
+        if self.memory is None:
+            return
+        self.next_seq = self.n_mice = self.event_seqs = self.events = self.mouse_seqs = self.mice = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+        self.memory = None
+
+
+# The tag of the mouse inside, from the last entry or exit in events, None if it left.
+def mouse_inside(events):
+    for event in reversed(events):
+        if event["event"] == "entry":
+            return event["tag"]
+        if event["event"] == "exit":
+            return None
+    return None
+
+
+class StatusServer:
+    """
+    Serves board (a StatusBoard) on address: (host, port), port 0 picking a
+    free one (see self.address), or the path of a Unix socket. cage_id goes
+    in /status. /events waits at most max_wait seconds, however long it is
+    asked to. Meant for the process of serve_status, see StatusProcess.
+    """
+    def __init__(self, address, board, cage_id=None, poll_interval=0.05, max_wait=60.0):
+        self.board = board
+        self.cage_id = cage_id
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.requests = 0
+        self.running = True
+
+        status = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.remove(address)
+            self.server = socketserver.ThreadingUnixStreamServer(address, Handler)
+            self.address = address
+        else:
+            ThreadingHTTPServer.allow_reuse_address = True
+            self.server = ThreadingHTTPServer(address, Handler)
+            self.address = self.server.server_address[:2]
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="StatusServer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def handle(self, request):
+        self.requests += 1
+        url = urlparse(request.path)
+        query = parse_qs(url.query)
+        try:
+            if url.path == "/status":
+                body = self.status(int(query.get("events", ["20"])[0]))
+            elif url.path == "/mice":
+                body = {"mice": self.board.mouse_counts()}
+            elif url.path == "/events":
+                after = int(query.get("after", ["-1"])[0])
+                wait = min(float(query.get("wait", ["0"])[0]), self.max_wait)
+                body = self.wait_for_events(after, wait)
+            else:
+                self.reply(request, 404, {"error": "no such path: " + url.path})
+                return
+        except ValueError as e:
+            self.reply(request, 400, {"error": str(e)})
+            return
+        self.reply(request, 200, body)
+
+    def reply(self, request, code, body):
+        data = json.dumps(body).encode("utf-8")
+        request.send_response(code)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def status(self, n_events):
+        events, missed = self.board.since()
+        return {"cage_id": self.cage_id, "time": time(), "uptime": time() - self.board.start_time,
+                "mouse_inside": mouse_inside(events), "mice": self.board.mouse_counts(),
+                "events": events[max(0, len(events) - n_events):], "next_seq": int(self.board.next_seq[0])}
+
+    # Events after seq after, waiting up to wait seconds for the first one.
+    def wait_for_events(self, after, wait):
+        deadline = monotonic() + wait
+        while self.board.next_seq[0] <= after + 1 and self.running and monotonic() < deadline:
+            sleep(self.poll_interval)
+        events, missed = self.board.since(after)
+        return {"events": events, "missed": missed, "next_seq": int(self.board.next_seq[0])}
+
+    def close(self):
+        self.running = False
+        self.server.shutdown()
+        self.server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+# Body of the status server process: serves the board called board_name until it is terminated.
+def serve_status(address, board_name, cage_id, connection):
+    board = StatusBoard(name=board_name, create=False)
+    server = StatusServer(address, board, cage_id)
+    connection.send(server.address)
+    server.thread.join()
+
+
+class StatusProcess:
+    """
+    A StatusBoard for the task to publish on (self.board) and the process
+    serving it on address. The process is spawned, not forked, as the task
+    already has its devices' threads running by then.
+    """
+    def __init__(self, address, cage_id=None, event_capacity=1000, mouse_capacity=1024):
+        self.board = StatusBoard(event_capacity, mouse_capacity)
+        self.address = address
+        self.connection, child_end = multiprocessing.Pipe()
+        context = multiprocessing.get_context("spawn")
+        self.process = context.Process(target=serve_status, name="StatusServer",
+                                       args=(address, self.board.name, cage_id, child_end))
+        self.process.daemon = True
+        self.process.start()
+
+    # Waits for the server to be listening, returns its address (the port picked, for port 0).
+    def wait_ready(self, timeout=10.0):
+        if self.connection.poll(timeout):
+            self.address = self.connection.recv()
+        return self.address
+
+    def close(self):
+        self.process.terminate()
+        self.process.join()
+        self.board.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=10.0):
+        http.client.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+# GET path from the status server at address, the JSON answer as Python objects.
+def get_status(address, path="/status", timeout=70.0):
+    if isinstance(address, str):
+        connection = UnixHTTPConnection(address, timeout)
+    else:
+        connection = http.client.HTTPConnection(address[0], address[1], timeout=timeout)
+    try:
+        connection.request("GET", path)
+        response = connection.getresponse()
+        data = response.read().decode("utf-8")
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise IOError("Status server answered " + str(response.status) + ": " + data)
+    return json.loads(data)
+
+
+# "127.0.0.1:8080" -> ("127.0.0.1", 8080), a Unix socket path stays as it is
+def parse_address(text):
+    host, colon, port = text.rpartition(":")
+    if colon and port.isdigit() and "/" not in text:
+        return host, int(port)
+    return text
+
+
+# Usage: python StatusServer.py 127.0.0.1:8080 [--follow]
+# Prints the counts of every mouse, with --follow then every new event, like tail -f.
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Look at a running cage")
+    parser.add_argument("address", help="status_address of the task, host:port or a Unix socket path")
+    parser.add_argument("--follow", action="store_true", help="print the events as they come")
+    args = parser.parse_args(argv)
+    address = parse_address(args.address)
+    status = get_status(address)
+    print ("Mouse_ID\tentries\tent_rew\thfixes\thf_rew")
+    for mouse in status["mice"]:
+        print (str(mouse["tag"]) + "\t" + str(mouse["entries"]) + "\t" + str(mouse["entrance_rewards"]) + "\t" +
+               str(mouse["headfixes"]) + "\t" + str(mouse["headfixed_rewards"]))
+    if not args.follow:
+        return
+    after = -1
+    for event in status["events"]:
+        print (str(event["tag"]) + "\t" + str(event["time"]) + "\t" + event["event"])
+        after = event["seq"]
+    try:
+        while True:
+            answer = get_status(address, "/events?after=" + str(after) + "&wait=30")
+            if answer["missed"]:
+                print ("(" + str(answer["missed"]) + " events missed)")
+            for event in answer["events"]:
+                print (str(event["tag"]) + "\t" + str(event["time"]) + "\t" + event["event"])
+                after = event["seq"]
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+__author__ = 'Federico'
+
+import asyncio
+import threading
+from collections import deque
+from time import sleep, monotonic
+
+
+class Waveform:
+    """
+    A stimulus worked out in advance as a list of (time, pin, level) edges,
+    time in seconds from the start of the stimulus, sorted by time.
+    """
+    def __init__(self, edges=()):
+        self.edges = sorted(edges, key=lambda edge: edge[0])
+
+    def duration(self):
+        if not self.edges:
+            return 0.0
+        return self.edges[-1][0]
+
+    def shifted(self, delay):
+        return Waveform([(t + delay, pin, level) for (t, pin, level) in self.edges])
+
+    def __add__(self, other):
+        return Waveform(self.edges + other.edges)
+
+    def __len__(self):
+        return len(self.edges)
+
+
+# One pulse of duration seconds on pin.
+def single_pulse(pin, duration, start=0.0):
+    return Waveform([(start, pin, 1), (start + duration, pin, 0)])
+
+
+# length seconds of on_time pulses at frequency Hz on pin.
+def pulse_train(pin, on_time, frequency, length, start=0.0):
+    period = 1.0 / frequency
+    n_pulses = int(round(frequency * length))
+    edges = []
+    for i in range(n_pulses):
+        edges.append((start + i * period, pin, 1))
+        edges.append((start + i * period + on_time, pin, 0))
+    return Waveform(edges)
+
+
+# Pulse trains one after the other on each pin of pins, gap seconds apart.
+def pulse_train_sequence(pins, on_time, frequency, length, gap, start=0.0):
+    waveform = Waveform()
+    for i, pin in enumerate(pins):
+        waveform = waveform + pulse_train(pin, on_time, frequency, length, start + i * (length + gap))
+    return waveform
+
+
+class WaveformPlayer:
+    """
+    Plays waveforms against absolute deadlines on the monotonic clock.
+    Every edge is due at start_time + its time, so a late edge does not push the
+    following ones back and nothing adds up across flashes or trials.
+    Waits sleep until spin_time before the deadline and spin for the rest.
+    The actual time of every edge is kept in edge_log as
+    (deadline, actual time, pin, level).
+    """
+    hardware_timed = False
+
+    def __init__(self, gpio, clock=monotonic, spin_time=0.0005, log_size=10000):
+        self.gpio = gpio
+        self.clock = clock
+        self.spin_time = spin_time
+        self.edge_log = deque(maxlen=log_size)
+
+    def wait_until(self, deadline):
+        remaining = deadline - self.clock()
+        if remaining > self.spin_time:
+            sleep(remaining - self.spin_time)
+        while self.clock() < deadline:
+            pass
+
+    # Plays the waveform starting at start_time (now if None), returns when its last edge is out.
+    def play(self, waveform, start_time=None):
+        if start_time is None:
+            start_time = self.clock()
+        for t, pin, level in waveform.edges:
+            deadline = start_time + t
+            self.wait_until(deadline)
+            self.gpio.output(pin, level)
+            self.edge_log.append((deadline, self.clock(), pin, level))
+        return start_time + waveform.duration()
+
+    """
+    Same as play, for the trial engine: waits with asyncio.sleep so other
+    actions keep running in between edges. The clock has to be the event
+    loop's clock. If cancelled, every pin of the waveform is turned off.
+    """
+    async def play_async(self, waveform, start_time=None):
+        if start_time is None:
+            start_time = self.clock()
+        try:
+            for t, pin, level in waveform.edges:
+                deadline = start_time + t
+                remaining = deadline - self.clock()
+                if remaining > 0:
+                    await asyncio.sleep(remaining)
+                self.gpio.output(pin, level)
+                self.edge_log.append((deadline, self.clock(), pin, level))
+        except asyncio.CancelledError:
+            self.all_off(waveform)
+            raise
+        return start_time + waveform.duration()
+
+    def all_off(self, waveform):
+        for pin in set([pin for (t, pin, level) in waveform.edges]):
+            self.gpio.output(pin, 0)
+
+
+class PigpioWaveformPlayer(WaveformPlayer):
+    """
+    Hands the waveform to the pigpio daemon, which plays it with DMA timing
+    (microsecond resolution, no Python in the loop). Edges are logged at the
+    time they were scheduled for, as the hardware does not report them back.
+
+    The daemon transmits one wave at a time for the whole host: sending a
+    second one replaces the first, and wave_tx_stop stops whichever is
+    playing. So only one waveform at a time is hardware timed; one that
+    starts while another is still on the daemon (overlapping actions of the
+    trial engine, or play from another thread) is played by the software
+    deadline player instead, and counted in software_fallbacks. Its edges go
+    to the edge log with their actual times, as usual.
+    """
+    hardware_timed = True
+
+    def __init__(self, gpio, pi, clock=monotonic, spin_time=0.0005, log_size=10000, pulse=None):
+        WaveformPlayer.__init__(self, gpio, clock, spin_time, log_size)
+        self.pi = pi
+        if pulse is None:
+            import pigpio
+            pulse = pigpio.pulse
+        self.pulse = pulse
+        # edges -> pigpio wave id, so each stimulus is only built once
+        self.wave_ids = {}
+        # held while a wave of this player is on the daemon
+        self.daemon_lock = threading.Lock()
+        self.software_fallbacks = 0
+
+    def build_wave(self, waveform):
+        pulses = []
+        edges = waveform.edges
+        for i, (t, pin, level) in enumerate(edges):
+            if i + 1 < len(edges):
+                delay = int(round((edges[i + 1][0] - t) * 1e6))
+            else:
+                delay = 0
+            if level:
+                pulses.append(self.pulse(1 << pin, 0, delay))
+            else:
+                pulses.append(self.pulse(0, 1 << pin, delay))
+        self.pi.wave_add_generic(pulses)
+        return self.pi.wave_create()
+
+    def wave_id(self, waveform):
+        key = tuple(waveform.edges)
+        if key not in self.wave_ids:
+            self.wave_ids[key] = self.build_wave(waveform)
+        return self.wave_ids[key]
+
+    def play(self, waveform, start_time=None):
+        if not waveform.edges:
+            return start_time
+        if start_time is None:
+            start_time = self.clock()
+        wave_id = self.wave_id(waveform)
+        self.wait_until(start_time + waveform.edges[0][0])
+        if not self.daemon_lock.acquire(False):
+            self.software_fallbacks += 1
+            return WaveformPlayer.play(self, waveform, start_time)
+        try:
+            self.pi.wave_send_once(wave_id)
+            for t, pin, level in waveform.edges:
+                self.edge_log.append((start_time + t, start_time + t, pin, level))
+            end_time = start_time + waveform.duration()
+            self.wait_until(end_time)
+            while self.pi.wave_tx_busy():
+                sleep(0.0001)
+        finally:
+            self.daemon_lock.release()
+        return end_time
+
+    async def play_async(self, waveform, start_time=None):
+        if not waveform.edges:
+            return start_time
+        if start_time is None:
+            start_time = self.clock()
+        wave_id = self.wave_id(waveform)
+        remaining = start_time + waveform.edges[0][0] - self.clock()
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+        # the lock is only ever taken without waiting, so this never blocks the event loop
+        if not self.daemon_lock.acquire(False):
+            self.software_fallbacks += 1
+            return await WaveformPlayer.play_async(self, waveform, start_time)
+        try:
+            self.pi.wave_send_once(wave_id)
+            for t, pin, level in waveform.edges:
+                self.edge_log.append((start_time + t, start_time + t, pin, level))
+            end_time = start_time + waveform.duration()
+            await asyncio.sleep(max(0.0, end_time - self.clock()))
+            while self.pi.wave_tx_busy():
+                await asyncio.sleep(0.0001)
+        except asyncio.CancelledError:
+            # the wave on the daemon is this one, stopping it touches no other action
+            self.pi.wave_tx_stop()
+            self.all_off(waveform)
+            raise
+        finally:
+            self.daemon_lock.release()
+        return end_time
+
+
+"""
+Returns the hardware-timed player when the pigpio daemon is running,
+the software deadline player otherwise.
+"""
+def get_waveform_player(gpio, clock=monotonic, hardware=True):
+    if hardware:
+        try:
+            import pigpio
+            pi = pigpio.pi()
+            if pi.connected:
+                return PigpioWaveformPlayer(gpio, pi, clock)
+        except ImportError:
+            pass
+    return WaveformPlayer(gpio, clock)
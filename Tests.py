@@ -1,6 +1,15 @@
 __author__ = 'Federico'
 
 from Modules import *
+from GPIOBackend import SimulatedGPIO
+from SensorInput import EdgeInput
+import EventLog
+import RFIDFramer
+import StimulusScheduler
+from TrialEngine import TrialEngine
+from VirtualTime import VirtualClock, VirtualTimeEventLoop
+import numpy as np
+from time import monotonic as time_monotonic
 
 
 def test_TagReader():
@@ -10,7 +19,7 @@ def test_TagReader():
         if (buffer_size == 16):
             # Read reader if and only if the buffer size is equal to 16.
             # Reason is that the data of the tag is exactly 16 bytes.
-            print reader.readTag()
+            print (reader.readTag())
         else:
             sleep(0.01)
 
@@ -20,8 +29,8 @@ def test_Mouse():
     mouse = Mouse(12345678)
 
     mouse.entrance_rewards += 1
-    print "Entrance_rewards should be = 1."
-    print "Entrance rewards is actually: " + str(mouse.entrance_rewards)
+    print ("Entrance_rewards should be = 1.")
+    print ("Entrance rewards is actually: " + str(mouse.entrance_rewards))
 
 
 def test_BrainCamera():
@@ -30,7 +39,7 @@ def test_BrainCamera():
     sleep(4)
     camera.stop_recording()
 
-    print "Check the video and make sure it's 4 seconds long."
+    print ("Check the video and make sure it's 4 seconds long.")
 
 
 def test_DataCollector():
@@ -45,7 +54,1197 @@ def test_DataCollector():
     dataCollector.save_mouse_exit(tag)
     dataCollector.save_end_session()
 
+def test_EdgeInput():
+    gpio = SimulatedGPIO()
+    contact_pin = 6
+    range_pin = 22
+    gpio.setup(contact_pin, gpio.IN)
+    gpio.setup(range_pin, gpio.IN)
+    sensors = EdgeInput(gpio, [contact_pin, range_pin], debounce_time=0.005)
+
+    # Nothing happens, the wait has to time out.
+    pin, edge_time = sensors.wait_for([(contact_pin, 1)], 0.05)
+    print ("Timed out wait should give None: " + str(pin))
+
+    # A bouncing contact counts once, stamped at its first edge.
+    t_touch = time_monotonic()
+    gpio.bounce_input(contact_pin, 1)
+    pin, edge_time = sensors.wait_for([(contact_pin, 1), (range_pin, 0)], 1.0)
+    print ("Contact pin should be " + str(contact_pin) + ", it is: " + str(pin))
+    print ("Edge count should be 1, it is: " + str(sensors.edge_count))
+    print ("Edge was stamped " + str((edge_time - t_touch) * 1e6) + " us after the touch")
+
+    # A glitch shorter than the debounce time settles back to low.
+    gpio.set_input(range_pin, 1)
+    gpio.set_input(range_pin, 0)
+    sleep(0.02)
+    print ("Range pin should be 0 after the glitch, it is: " + str(sensors.level(range_pin)))
+    sensors.close()
+
+
+def test_BackgroundDataCollector():
+    tag = "0123456789"
+    dataCollector = DataCollector("test_background.txt", background=True, echo=False)
+    dataCollector.save_start_session()
+    dataCollector.save_mouse_entry(tag)
+    for i in range(1000):
+        dataCollector.save_mouse_Reward_given(tag, i)
+    dataCollector.save_mouse_exit(tag)
+    # save_end_session flushes, everything has to be in the file already.
+    dataCollector.save_end_session()
+    with open("test_background.txt") as data_file:
+        lines = data_file.readlines()
+    print ("Lines should be 1004, they are: " + str(len(lines)))
+    print ("Last event should be SeshEnd, it is: " + lines[-1].split('\t')[-1].strip())
+    dataCollector.close()
+    os.remove("test_background.txt")
+
+    # Writes failing for a while are tried again, no event is lost.
+    written = []
+    failures = [OSError("disk gone"), OSError("disk gone")]
+    def write_batch(events):
+        if failures:
+            raise failures.pop()
+        written.extend(events)
+    writer = BackgroundWriter(write_batch, lambda fsync: None, retry_interval=0.05)
+    for i in range(100):
+        writer.put(i)
+    sleep(0.3)
+    writer.flush()
+    print ("After 2 failed writes all 100 events should be written in order: " + str(written == list(range(100))) +
+           ", write errors: " + str(writer.write_errors))
+    failures.extend([OSError("disk gone for good")] * 10)
+    writer.retry_interval = 10.0
+    writer.put(100)
+    try:
+        writer.close()
+        print ("Closing with events still unwritten should raise, it did not")
+    except OSError as error:
+        print ("Closing with events still unwritten should raise, it raised: " + repr(error))
+
+
+def test_EventLog():
+    # test.txt has both column orders in it.
+    with open("test.txt") as text_file:
+        lines = text_file.readlines()
+    n_records = EventLog.convert_text_log("test.txt", "test.bin")
+    records = EventLog.read_events("test.bin")
+    print ("Records should be " + str(len(lines)) + ", they are: " + str(n_records) + " and " + str(len(records)))
+    rewards = records[EventLog.select(records, event='reward')]
+    n_rewards = len([line for line in lines if "\treward" in line])
+    print ("Rewards should be " + str(n_rewards) + ", they are: " + str(len(rewards)))
+    print ("Last reward should be reward4, it is: " + EventLog.decode_event(rewards['event'][-1], rewards['arg'][-1]))
+    # Tags are stored as numbers, so 0123456789 and 123456789 are the same mouse.
+    entries = EventLog.select(records, tag="0123456789", event='entry')
+    n_entries = len([line for line in lines if line.lstrip("0").startswith("123456789\t") and "\tentry" in line])
+    print ("Entries of 0123456789 should be " + str(n_entries) + ", they are: " + str(entries.sum()))
+    del records
+
+    # A bad epoch in the middle and a line torn by a crash at the end are skipped, the rest converted.
+    with open("test_damaged.txt", "w") as text_file:
+        text_file.writelines(lines[:3])
+        text_file.write("0123456789\t17923x7581.3\tentry\t2015-01-01 00:00:00\n")
+        text_file.writelines(lines[3:])
+        text_file.write("0123456789\t1792327")
+    n_records = EventLog.convert_text_log("test_damaged.txt", "test.bin")
+    print ("Records of the damaged log should still be " + str(len(lines)) + ", they are: " + str(n_records))
+    os.remove("test_damaged.txt")
+    os.remove("test.bin")
+
+
+def test_TagFramer():
+    framer = RFIDFramer.TagFramer(dedupe_window=1.0)
+    good = RFIDFramer.make_frame("0A1B2C3D4E")
+    other = RFIDFramer.make_frame("00000000FF")
+    bad_checksum = good[:11] + b"00" + good[13:]
+    # A dropped byte, a frame with a bad checksum, junk and then two good frames split in odd places.
+    stream = good[:7] + good[8:] + bad_checksum + b"\x02junk" + other + good
+    tags = []
+    for i in range(0, len(stream), 5):
+        tags += framer.feed(stream[i:i + 5], 0.0)
+    print ("Tags should be [255, 43405557070], they are: " + str([tag for tag, read_time in tags]))
+    print ("Checksum errors should be 1, they are: " + str(framer.checksum_errors))
+    # Same tag again inside the window is a duplicate, after the window it counts.
+    print ("Duplicate should give [], it gives: " + str(framer.feed(good, 0.5)))
+    print ("After the window should give 1 tag, it gives: " + str(len(framer.feed(good, 2.0))))
+
+
+def test_TagReaderListener():
+    serial_port = RFIDFramer.SimulatedSerial()
+    reader = TagReader(port, serial_port=serial_port)
+    reader.start_listener()
+    serial_port.send(RFIDFramer.add_noise(b"\x02\x03" + RFIDFramer.make_frame("0A1B2C3D4E")))
+    tag, read_time = reader.wait_for_tag(1.0)
+    print ("Tag should be 43405557070, it is: " + str(tag))
+    # With no mouse the listener only wakes up every read timeout, and stopping does not wait for it.
+    reads = serial_port.reads
+    sleep(1.0)
+    print ("Idle reads in 1 s should be 3 at most, they are: " + str(serial_port.reads - reads))
+    t_stop = time_monotonic()
+    reader.close()
+    print ("Closing should not wait for the read timeout, it took: " + str(time_monotonic() - t_stop) + " s")
+
+    # The port fails twice (reader unplugged), the listener reopens it and keeps reading.
+    class FailingSerial(RFIDFramer.SimulatedSerial):
+        failures = 2
+
+        def read(self, size=1):
+            if self.failures:
+                self.failures -= 1
+                raise OSError("device reports readiness to read but returned no data")
+            return RFIDFramer.SimulatedSerial.read(self, size)
+
+    serial_port = FailingSerial()
+    reader = TagReader(port, serial_port=serial_port, retry_interval=0.01)
+    reader.start_listener()
+    serial_port.send(RFIDFramer.make_frame("0A1B2C3D4E"))
+    tag, read_time = reader.wait_for_tag(1.0)
+    print ("After 2 errors the tag should still be 43405557070, it is: " + str(tag) + ", errors: " + str(reader.errors))
+    reader.close()
+
+
+def test_MouseRegistry():
+    mice = MouseRegistry("test_quickStats.txt")
+    for tag in (111, 222, 333):
+        mice.add(tag)
+    mouse = mice.get(222)
+    mouse.entries += 1
+    mice.mark_changed(mouse)
+    mice.save_stats()
+    print ("Registry should have 3 mice, it has: " + str(len(mice)))
+    print ("Unknown tag should give None, it gives: " + str(mice.get(444)))
+    mice.close()
+    with open("test_quickStats.txt") as stats_file:
+        lines = stats_file.readlines()
+    print ("Stats file should have 4 lines, it has: " + str(len(lines)))
+    print ("Mouse 222 line should be '222\t1\t0\t0\t0', it is: " + repr(lines[2].strip()))
+    os.remove("test_quickStats.txt")
+
+    # A failed write leaves the writer running and the stats queued, the next change writes them.
+    mice = MouseRegistry("/nonexistent_dir/test_quickStats.txt")
+    mice.add(111)
+    mice.save_stats()
+    sleep(0.2)
+    print ("After a failed write the writer should be alive, it is: " + str(mice.writer.is_alive()) +
+           ", write errors should be 1, they are: " + str(mice.write_errors))
+    mice.stats_file_path = "test_quickStats.txt"
+    mice.add(222)
+    mice.save_stats()
+    sleep(0.2)
+    print ("The stats file should now be written: " + str(os.path.exists("test_quickStats.txt")) +
+           ", error should be None, it is: " + str(mice.error))
+    mice.close()
+    with open("test_quickStats.txt") as stats_file:
+        print ("Stats file should have 3 lines, it has: " + str(len(stats_file.readlines())))
+    os.remove("test_quickStats.txt")
+    mice = MouseRegistry("/nonexistent_dir/test_quickStats.txt")
+    mice.add(111)
+    try:
+        mice.close()
+        print ("Closing with the stats still unwritten should raise, it did not")
+    except OSError as error:
+        print ("Closing with the stats still unwritten should raise, it raised: " + repr(error))
+
+
+def test_WaveformPlayer():
+    gpio = SimulatedGPIO()
+    led_pin = 20
+    gpio.setup(led_pin, gpio.OUT)
+    player = StimulusScheduler.WaveformPlayer(gpio)
+    train = StimulusScheduler.pulse_train(led_pin, 0.005, 100, 0.2)
+    print ("Train should have 40 edges, it has: " + str(len(train)))
+    start_time = player.clock() + 0.01
+    player.play(train, start_time)
+    lateness = [actual - deadline for (deadline, actual, pin, level) in player.edge_log]
+    print ("Edges played should be 40, they are: " + str(len(gpio.outputs_for(led_pin))))
+    print ("Worst lateness " + str(max(lateness) * 1e6) + " us, should be around a few hundred us on an idle Pi")
+    print ("Last edge was due at " + str(start_time + train.duration()) + ", it went out at " + str(player.edge_log[-1][1]))
+
+
+def test_TrialEngine():
+    clock = VirtualClock()
+    loop = VirtualTimeEventLoop(clock)
+    gpio = SimulatedGPIO(clock)
+    reward_pin, led_pin, range_pin = 27, 20, 22
+    for pin in (reward_pin, led_pin):
+        gpio.setup(pin, gpio.OUT)
+    gpio.setup(range_pin, gpio.IN)
+    gpio.set_input(range_pin, 1)
+    sensors = EdgeInput(gpio, [range_pin], clock=clock)
+    player = StimulusScheduler.WaveformPlayer(gpio, clock)
+    reward = StimulusScheduler.single_pulse(reward_pin, 0.4)
+    flashes = StimulusScheduler.pulse_train(led_pin, 0.01, 10, 1.0)
+
+    async def reward_action(n):
+        await player.play_async(reward)
+
+    async def light_action(argument):
+        await player.play_async(flashes)
+
+    engine = TrialEngine({'reward': reward_action, 'light': light_action},
+                         sensors, {(range_pin, 0): 'abort'}, loop)
+    # Light overlaps the reward, the mouse pulls out in the middle of the second light.
+    timeline = [(0.0, 'reward', 0), (0.2, 'light', None), (10.0, 'reward', 1), (10.2, 'light', None), (30.0, 'end', None)]
+    loop.call_at(10.7, gpio.set_input, range_pin, 0)
+    t_real = time()
+    reason = engine.run_timeline(timeline)
+    print ("Trial should be aborted, reason: " + str(reason))
+    print ("Virtual time should be 10.7, it is: " + str(clock.now) + " (" + str(time() - t_real) + " s real)")
+    print ("Reward valve edges should be 4, they are: " + str(len(gpio.outputs_for(reward_pin))))
+    print ("Light should end off, it is: " + str(gpio.input(led_pin)))
+    engine.close()
+    sensors.close()
+
+
+class FakePi:
+    """
+    Stands in for a pigpio.pi: one wave on the "daemon" at a time, busy
+    until its pulses are over on clock. Keeps the (time, wave id) sent.
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.waves = []
+        self.sent = []
+        self.stops = 0
+        self.busy_until = 0.0
+
+    def wave_add_generic(self, pulses):
+        self.pulses = pulses
+
+    def wave_create(self):
+        self.waves.append(self.pulses)
+        return len(self.waves) - 1
+
+    def wave_send_once(self, wave_id):
+        self.sent.append((self.clock(), wave_id))
+        self.busy_until = self.clock() + sum([delay for (on, off, delay) in self.waves[wave_id]]) * 1e-6
+
+    def wave_tx_busy(self):
+        return self.clock() < self.busy_until
+
+    def wave_tx_stop(self):
+        self.stops += 1
+        self.busy_until = 0.0
+
+
+def test_PigpioTrialEngine():
+    clock = VirtualClock()
+    loop = VirtualTimeEventLoop(clock)
+    gpio = SimulatedGPIO(clock)
+    reward_pin, led_pin = 27, 20
+    for pin in (reward_pin, led_pin):
+        gpio.setup(pin, gpio.OUT)
+    pi = FakePi(clock)
+    player = StimulusScheduler.PigpioWaveformPlayer(gpio, pi, clock, pulse=lambda on, off, delay: (on, off, delay))
+    reward = StimulusScheduler.single_pulse(reward_pin, 0.4)
+    flashes = StimulusScheduler.pulse_train(led_pin, 0.01, 10, 1.0)
+
+    async def reward_action(n):
+        await player.play_async(reward)
+
+    async def light_action(argument):
+        await player.play_async(flashes)
+
+    engine = TrialEngine({'reward': reward_action, 'light': light_action}, None, None, loop)
+    # The light starts while the reward wave is still on the daemon, the second light once it is free.
+    timeline = [(0.0, 'reward', 0), (0.2, 'light', None), (2.0, 'light', None), (2.1, 'reward', 1)]
+    reason = engine.run_timeline(timeline)
+    print ("Trial should run to the end, reason: " + str(reason))
+    print ("Waves sent should be at 0.0 and 2.0, they are at: " + str([t for (t, wave_id) in pi.sent]))
+    print ("Software fallbacks should be 2, they are: " + str(player.software_fallbacks))
+    print ("Software light edges should be 20, they are: " + str(len(gpio.outputs_for(led_pin))))
+    print ("Software reward edges should be 2, they are: " + str(len(gpio.outputs_for(reward_pin))))
+    print ("Edge log should have 2 + 20 + 20 + 2 edges, it has: " + str(len(player.edge_log)))
+
+    # Cancelling the software-timed action must leave the wave on the daemon alone.
+    timeline = [(0.0, 'light', None), (0.1, 'reward', 0), (0.2, 'end', None)]
+    loop.call_at(clock() + 0.15, engine.cancel, 'reward')
+    engine.run_timeline(timeline)
+    print ("Daemon stops should be 0, they are: " + str(pi.stops))
+    print ("Reward valve should end off, it is: " + str(gpio.input(reward_pin)))
+    engine.close()
+
+
+def test_VideoCompression():
+    import VideoCompression
+    source = VideoCompression.SyntheticFrameSource(noise=2.0)
+    frames = [source.next_frame() for i in range(40)]
+    # Lossless on the green channel, small chunks so the recording spans several files.
+    options = VideoCompression.CompressionOptions(channel=1, frames_per_chunk=16)
+    compressor = VideoCompression.VideoCompressor((256, 256), 30, options, queue_size=100)
+    compressor.start("test_video")
+    for frame in frames:
+        compressor.write(frame)
+    compressor.stop()
+    compressor.close()
+    paths = VideoCompression.chunk_paths("test_video")
+    print ("Chunks should be 3, they are: " + str(len(paths)))
+    decoded = [frame for path in paths for frame in VideoCompression.CompressedVideoReader(path)]
+    original = [np.frombuffer(frame, dtype=np.uint8).reshape(256, 256, 3)[:, :, 1:2] for frame in frames]
+    same = all([(a == b).all() for a, b in zip(decoded, original)])
+    print ("Decoded frames should be 40 and identical, they are: " + str(len(decoded)) + " " + str(same))
+    compressed = sum([os.path.getsize(path) for path in paths])
+    print ("Compression ratio against .raw: " + str(len(frames) * len(frames[0]) / float(compressed)))
+    for path in paths:
+        os.remove(path)
+
+    # A capture still writing its tail when the next starts: each keeps its own frames.
+    compressor = VideoCompression.VideoCompressor((256, 256), 30, options, queue_size=100)
+    first = compressor.start("test_video_a")
+    for frame in frames[:20]:
+        compressor.add_frame(frame, 0.0, first)
+    second = compressor.start("test_video_b")
+    for i in range(20, 40):
+        compressor.add_frame(frames[i], 0.0, second)
+        if i < 25:
+            compressor.add_frame(frames[i], 0.0, first)
+    compressor.stop(first)
+    compressor.stop(second)
+    compressor.close()
+    for name, expected in (("test_video_a", original[:25]), ("test_video_b", original[20:])):
+        paths = VideoCompression.chunk_paths(name)
+        decoded = [frame for path in paths for frame in VideoCompression.CompressedVideoReader(path)]
+        same = len(decoded) == len(expected) and all([(a == b).all() for a, b in zip(decoded, expected)])
+        print ("Overlapping capture " + name + " should have its " + str(len(expected)) + " frames: " +
+               str(len(decoded)) + " " + str(same))
+        for path in paths:
+            os.remove(path)
+
+    # A chunk left open by a crash, cut in the middle of its 11th frame, still gives the first 10.
+    options = VideoCompression.CompressionOptions()
+    encoder = VideoCompression.FrameEncoder((256, 256), options)
+    chunk = VideoCompression.ChunkWriter("test_video.000.hfz", (256, 256, 3), options, 30)
+    for i, frame in enumerate(frames[:11]):
+        chunk.write(encoder.encode(frame, i == 0)[0], float(i))
+    chunk.file.flush()
+    os.truncate("test_video.000.hfz", chunk.offsets[10] + 100)
+    reader = VideoCompression.CompressedVideoReader("test_video.000.hfz")
+    recovered = reader.read_all()
+    same = all([(recovered[i] == np.frombuffer(frames[i], dtype=np.uint8).reshape(256, 256, 3)).all()
+                for i in range(len(recovered))])
+    print ("An unclosed chunk should give its 10 whole frames, all 3 channels: " + str(reader.complete) + " " +
+           str(len(recovered)) + " " + str(recovered.shape[-1]) + " " + str(same))
+    chunk.file.close()
+    os.remove("test_video.000.hfz")
+
+
+def test_PretriggerVideo():
+    import VideoRingBuffer
+    frame_bytes = 256 * 256 * 3
+    counter = [0]
+
+    # Every frame is filled with its own number, so we can tell which ones were saved.
+    def numbered_frame():
+        counter[0] += 1
+        return bytes([counter[0] % 256]) * frame_bytes
+
+    camera = VideoRingBuffer.SimulatedCamera(startup_time=0.0, frame_source=numbered_frame)
+    output = VideoRingBuffer.PretriggerOutput((256, 256), 30, buffer_seconds=1.0)
+    camera.start_recording(output)
+    sleep(1.5)
+    trigger_frame = output.ring.next_seq
+    output.begin_capture(VideoRingBuffer.RawFileSink("test_pretrigger.raw"), "test_pretrigger_timestamps.txt")
+    sleep(0.5)
+    output.end_capture()
+    camera.stop_recording()
+    output.close()
+
+    frames = np.fromfile("test_pretrigger.raw", dtype=np.uint8).reshape(-1, frame_bytes)
+    with open("test_pretrigger_timestamps.txt") as timestamps_file:
+        timestamps = [float(line.split("\t")[1]) for line in timestamps_file]
+    print ("Frames before the trigger should be about 30, they are: " + str(trigger_frame - (frames[0][0] - 1)))
+    print ("Frames and timestamps should match: " + str(len(frames)) + " " + str(len(timestamps)))
+    print ("Frames should be consecutive: " + str(all(np.diff(frames[:, 0].astype(int)) % 256 == 1)))
+    os.remove("test_pretrigger.raw")
+    os.remove("test_pretrigger_timestamps.txt")
+
+
+def test_RawVideo():
+    import shutil
+    import RawVideo
+    video_dir = "test_videos"
+    if os.path.exists(video_dir):
+        shutil.rmtree(video_dir)
+    os.makedirs(video_dir)
+    # Two head fixes of mouse 123, frames filled with their own number.
+    # The second one has a timestamps file starting 1 s before the head fix.
+    frames = np.repeat(np.arange(60, dtype=np.uint8), 256 * 256 * 3)
+    frames.tofile(os.path.join(video_dir, "M123_1000.5.raw"))
+    frames.tofile(os.path.join(video_dir, "M123_2000.5.raw"))
+    with open(os.path.join(video_dir, "M123_2000.5_timestamps.txt"), "w") as timestamps_file:
+        for i in range(60):
+            timestamps_file.write(str(i) + "\t" + repr(1999.5 + i / 30.0) + "\n")
+    with open("test_session.txt", "w") as log_file:
+        log_file.write("123\t1000.5\tcheck+\t2015-01-01 00:00:00\n")
+        log_file.write("123\t1001.01\treward0\t2015-01-01 00:00:00\n")
+        log_file.write("456\t1001.01\treward0\t2015-01-01 00:00:00\n")
+        log_file.write("123\t2000.51\tlight-L\t2015-01-01 00:00:00\n")
+        log_file.write("123\t3000.0\treward1\t2015-01-01 00:00:00\n")
+
+    index = RawVideo.SessionIndex("test_session.txt", video_dir)
+    print ("Events with a frame should be [1 3], they are: " + str(index.indexed()))
+    print ("Frame of reward0 should be 15, it is: " + str(index.frame(1)[0, 0, 0]))
+    print ("Frame of light-L should be 30, it is: " + str(index.frame(3)[0, 0, 0]))
+    print ("Frames around light-L should be 28 to 32: " + str(index.frames_around(3, 2, 2)[:, 0, 0, 0]))
+    print ("Frames should be memory-mapped: " + str(isinstance(index.videos[0].frames, np.memmap)))
+    cache_time = os.path.getmtime(index.cache_path)
+    again = RawVideo.SessionIndex("test_session.txt", video_dir)
+    print ("Index should come from the cache: " + str(os.path.getmtime(again.cache_path) == cache_time and
+                                                      (again.frame_of_event == index.frame_of_event).all()))
+    print ("A cached index should open no video: " + str(again.videos.videos))
+
+    # A new event in the log: rebuilt from the frame times in the cache, no video read.
+    with open("test_session.txt", "a") as log_file:
+        log_file.write("123\t1001.5\treward2\t2015-01-01 00:00:00\n")
+    again = RawVideo.SessionIndex("test_session.txt", video_dir)
+    print ("Events with a frame should be [1 3 5], they are: " + str(again.indexed()) +
+           ", videos opened should be [None, None]: " + str(again.videos.videos))
+    # New timestamps for the second video: only that one is read again.
+    with open(os.path.join(video_dir, "M123_2000.5_timestamps.txt"), "w") as timestamps_file:
+        for i in range(60):
+            timestamps_file.write(str(i) + "\t" + repr(1999.0 + i / 30.0) + "\n")
+    again = RawVideo.SessionIndex("test_session.txt", video_dir)
+    print ("Frame of light-L should now be 45, it is: " + str(again.frame(3)[0, 0, 0]) +
+           ", the first video should not be opened: " + str(again.videos.videos[0]))
+    shutil.rmtree(video_dir)
+    os.remove("test_session.txt")
+
+
+def test_FrameAveraging():
+    import shutil
+    import FrameAveraging
+    video_dir = "test_videos"
+    if os.path.exists(video_dir):
+        shutil.rmtree(video_dir)
+    os.makedirs(video_dir)
+    # Two head fixes of mouse 123, 120 frames each, a stimulus at frames 40 and 80 and
+    # a light at frame 20. A patch of the green channel gets 20% brighter 5 to 15 frames
+    # after each stimulus, the light does nothing.
+    rng = np.random.RandomState(0)
+    log_lines = []
+    for start in (1000.0, 2000.0):
+        frames = np.full((120, 256, 256, 3), 100, dtype=np.uint8)
+        frames += rng.randint(0, 3, size=frames.shape).astype(np.uint8)
+        for n, event_frame in enumerate((40, 80)):
+            frames[event_frame + 5:event_frame + 16, 64:128, 64:128, 1] = 120
+            log_lines.append("123\t" + repr(start + event_frame / 30.0 + 0.001) + "\tstimulus-" + str(n) +
+                             "\t2015-01-01 00:00:00\n")
+        log_lines.append("123\t" + repr(start + 20 / 30.0 + 0.001) + "\tlight-L\t2015-01-01 00:00:00\n")
+        frames.tofile(os.path.join(video_dir, "M123_" + repr(start) + ".raw"))
+    with open("test_session.txt", "w") as log_file:
+        log_file.write("".join(log_lines))
+
+    options = FrameAveraging.AveragingOptions(before=10, after=20, binning=2, max_chunk_bytes=1 << 20)
+    averages = FrameAveraging.FrameAverages("test_session.txt", video_dir, options, processes=2)
+    print ("Both videos should be read: " + str(averages.update()))
+    print ("Averages should be for (123, light-L) and (123, stimulus): " + str(averages.keys()))
+    print ("Each should have 2 and 4 events: " + str(averages.n_events(123, 'light-L')) + " " +
+           str(averages.n_events(123, 'stimulus')))
+    response = averages.response_map(123, 'stimulus', 5, 16)
+    print ("Stimulus response should be about 0.2 in the patch and 0 elsewhere: " +
+           "%.3f" % response[32:64, 32:64].mean() + " " + "%.3f" % response[:32].mean())
+    print ("Before the stimulus and after the light dF/F should be about 0: " +
+           "%.3f" % abs(averages.average(123, 'stimulus')[:10]).max() + " " +
+           "%.3f" % abs(averages.response_map(123, 'light-L')).max())
+    again = FrameAveraging.FrameAverages("test_session.txt", video_dir, options)
+    print ("A rerun should read no video: " + str(again.update()) + " " +
+           str(np.array_equal(again.average(123, 'stimulus'), averages.average(123, 'stimulus'))))
+    with open("test_session.txt", "a") as log_file:
+        log_file.write("123\t" + repr(2000.0 + 100 / 30.0 + 0.001) + "\tstimulus-2\t2015-01-01 00:00:00\n")
+    again = FrameAveraging.FrameAverages("test_session.txt", video_dir, options)
+    print ("A new event should only read its video again: " + str(again.update()) + ", events skipped " +
+           "(window past the end) " + str(again.events_skipped))
+    wider = FrameAveraging.AveragingOptions(before=20, after=20, binning=4)
+    again = FrameAveraging.FrameAverages("test_session.txt", video_dir, wider)
+    print ("New windows should read both again: " + str(again.update()) + " " +
+           str(again.average(123, 'stimulus').shape))
+    shutil.rmtree(video_dir)
+    os.remove("test_session.txt")
+
+
+def test_Analysis():
+    import shutil
+    import Analysis
+    root = "test_media"
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    paths = []
+    for day in ("0101", "0102"):
+        for cage in ("C1", "C2"):
+            os.makedirs(os.path.join(root, day, cage, "TextFiles"))
+            path = os.path.join(root, day, cage, "TextFiles", "headFix_" + cage + "_" + day + ".txt")
+            with open(path, "w") as log_file:
+                log_file.write("0000000000\t100.0\t2015-01-01 00:00:00\tSeshStart\n")
+                # old column order in one file
+                if cage == "C1":
+                    log_file.write("123\t101.0\t2015-01-01 00:00:01\tentry\n")
+                    log_file.write("123\t102.0\t2015-01-01 00:00:02\tcheck+\n")
+                    log_file.write("123\t103.0\t2015-01-01 00:00:03\treward0\n")
+                else:
+                    log_file.write("123\t101.0\tentry\t2015-01-01 00:00:01\n")
+                    log_file.write("123\t102.0\tcheck+\t2015-01-01 00:00:02\n")
+                    log_file.write("123\t103.0\treward0\t2015-01-01 00:00:03\n")
+            paths.append(path)
+
+    analysis = Analysis.LogAnalysis(root, processes=2)
+    print ("Files parsed should be 4, they are: " + str(analysis.update()))
+    rows = analysis.summaries()
+    print ("Rows should be 4 with 1 entry, 1 head fix and 1 reward each: " + str(len(rows)) + " " +
+           str(all([(row['entries'], row['headfixes'], row['rewards']) == (1, 1, 1) for row in rows])))
+
+    # A new entry plus a line still being written.
+    with open(paths[0], "a") as log_file:
+        log_file.write("123\t104.0\t2015-01-01 00:00:04\tentry\n")
+        log_file.write("123\t105.0\t2015-01-01")
+    analysis = Analysis.LogAnalysis(root)
+    print ("Files parsed should be 1, they are: " + str(analysis.update()))
+    print ("Entries should be 2, they are: " + str(analysis.summaries()[0]['entries']))
+    with open(paths[0], "a") as log_file:
+        log_file.write(" 00:00:05\tentry\n")
+    analysis.update()
+    print ("Entries should be 3, they are: " + str(analysis.summaries()[0]['entries']))
+    print ("Nothing new, files parsed should be 0, they are: " + str(analysis.update()))
+    shutil.rmtree(root)
+
+
+def test_EventStream():
+    import EventStream
+    address = "test_aggregator.sock"
+    for path in ("test_aggregate.bin", "test_aggregate.bin.rigs", "test_rig0.spool", address):
+        if os.path.exists(path):
+            os.remove(path)
+    # The first rig starts before the aggregator, its events go to the spool.
+    early = EventStream.EventStream(address, "rig0", "test_rig0.spool", retry_interval=0.1)
+    early.write([("123", 1000.0 + i, None, "entry") for i in range(50)])
+    early.flush()
+    print ("Events spooled should be 50, they are: " + str(early.events_spooled))
+
+    aggregator = EventStream.EventAggregator(address, "test_aggregate.bin", flush_interval=0.05)
+    while early.spooled:
+        sleep(0.01)
+    rigs = [early] + [EventStream.EventStream(address, "rig" + str(r), "test_rig" + str(r) + ".spool")
+                      for r in range(1, 3)]
+    for i in range(50, 200):
+        for r, rig in enumerate(rigs):
+            rig.write([(str(100 * r + 1), 1000.0 + i + r / 10.0, None, "reward" + str(i % 3))])
+    sleep(0.3)
+    for rig in rigs:
+        rig.flush()
+        rig.close()
+    aggregator.close()
+
+    store = EventStream.read_store("test_aggregate.bin")
+    print ("Events stored should be 500, they are: " + str(len(store)))
+    print ("Stored events should be in time order: " + str(bool((np.diff(store['epoch']) >= 0).all())))
+    per_rig = zip(EventStream.rig_names("test_aggregate.bin"), np.bincount(store['rig']))
+    print ("Events per rig should be rig0 200, rig1 150, rig2 150: " +
+           ", ".join([name + " " + str(n) for name, n in sorted(per_rig)]))
+    print ("Spool should be gone: " + str(not os.path.exists("test_rig0.spool")))
+    for path in ("test_aggregate.bin", "test_aggregate.bin.rigs"):
+        os.remove(path)
+
+
+def test_TaskStartup():
+    import shutil
+    import HeadFix
+    from RFIDFramer import SimulatedSerial
+    from VideoRingBuffer import SimulatedCamera
+    config = {"cage_id": "C1", "data_root_path": "test_media/", "confirm_paths": False,
+              "pretrigger_video_seconds": None, "reward_time": 0.2}
+    start_time = time_monotonic()
+    task = HeadFix.Task(SimulatedGPIO(), config, SimulatedSerial(), SimulatedCamera(settle_time=0.3))
+    print ("Startup should take well under 2 s, it took: " + str(time_monotonic() - start_time))
+    print ("Camera exposure should have settled: " + str(task.camera.exposure_settled))
+    print ("Data file should be under test_media/MMDD/C1/TextFiles: " + task.data_full_path)
+    print ("Reward pulse should be 0.2 s: " + str(task.reward_waveform.duration()))
+    task.quit()
+    try:
+        task.apply_config({"rewardtime": 0.1})
+        print ("A misspelled setting should raise an error, it did not")
+    except ValueError as e:
+        print ("A misspelled setting should raise an error: " + str(e))
+
+    # quit() closes the camera itself: captures, compressor process and frame bus included.
+    import VideoCompression
+    config = {"cage_id": "C1", "data_root_path": "test_media/", "confirm_paths": False, "metrics_interval": None,
+              "pretrigger_video_seconds": 0.5, "frame_bus_name": "test_quit_bus",
+              "video_compression": VideoCompression.CompressionOptions()}
+    task = HeadFix.Task(SimulatedGPIO(), config, SimulatedSerial(), SimulatedCamera(startup_time=0.0, settle_time=0.0))
+    task.camera.start_recording(task.video_path + "M1_1.0")
+    sleep(0.2)
+    task.camera.stop_recording()
+    compressor = task.camera.compressor
+    task.quit()
+    print ("After quit the compressor should be stopped and the frame bus gone: " +
+           str(not compressor.process.is_alive()) + " " + str(not os.path.exists("/dev/shm/test_quit_bus")))
+    shutil.rmtree("test_media")
+
+
+def test_Refix():
+    import shutil
+    import threading
+    import HeadFix
+    from VideoRingBuffer import SimulatedCamera
+    config = {"cage_id": "C1", "data_root_path": "test_media/", "confirm_paths": False, "metrics_interval": None,
+              "pretrigger_video_seconds": None, "reward_time": 0.05, "number_of_headfix_rewards": 1,
+              "inter_reward_interval": 0.2, "piezo_duration": 0.05, "entrance_reward_delay_time": 0.1,
+              "skedaddle_time": 0.2}
+    gpio = SimulatedGPIO()
+    serial_port = RFIDFramer.SimulatedSerial()
+    task = HeadFix.Task(gpio, config, serial_port, SimulatedCamera(startup_time=0.0, settle_time=0.0))
+    thread = threading.Thread(target=task.start)
+    thread.daemon = True
+    thread.start()
+
+    def wait_for_headfixes(n):
+        deadline = time_monotonic() + 5.0
+        while task.headfixes.value < n and time_monotonic() < deadline:
+            sleep(0.01)
+
+    # Fixed on a contact edge, fixed again straight away as the contact is kept through the
+    # release, then again on a new contact edge, all in the same entry.
+    gpio.set_input(task.range_pin, 1)
+    serial_port.send(RFIDFramer.make_frame("%010X" % 1001))
+    sleep(0.05)
+    gpio.set_input(task.contact_pin, 1)
+    wait_for_headfixes(2)
+    gpio.set_input(task.contact_pin, 0)
+    sleep(0.4)
+    gpio.set_input(task.contact_pin, 1)
+    wait_for_headfixes(3)
+    gpio.set_input(task.contact_pin, 0)
+    sleep(0.4)
+    gpio.set_input(task.range_pin, 0)
+    sleep(0.3)
+    task.quit()
+    print ("Head fixes should be 3, they are: " + str(task.headfixes.value))
+    print ("Contact to pistons should only count the 2 new contact edges: " + str(task.contact_to_piston.count()))
+    print ("Contact to pistons should stay well under the 0.2 s of a head fix: " + str(task.contact_to_piston.max))
+    shutil.rmtree("test_media")
+
+
+def test_Metrics():
+    import Metrics
+    metrics = Metrics.Metrics()
+    latency = metrics.histogram("test_latency_seconds", "A test latency")
+    for value in (0.0002, 0.0002, 0.003, 0.5, 20.0):
+        latency.observe(value)
+    metrics.counter("test_total", "A test counter").inc(3)
+    print ("Count should be 5 and max 20.0: " + str(latency.count()) + " " + str(latency.max))
+    print ("Median should be 0.0032 (bucket bound): " + str(latency.quantile(0.5)))
+    text = metrics.exposition()
+    print ("Exposition should have the counter and +Inf bucket: " +
+           str("headfix_test_total 3" in text and 'headfix_test_latency_seconds_bucket{le="+Inf"} 5' in text))
+
+    exporter = Metrics.MetricsExporter(metrics, "test_metrics.prom", interval=0.05)
+    sleep(0.2)
+    exporter.close()
+    with open("test_metrics.prom") as metrics_file:
+        print ("Metrics file should match the exposition: " + str(metrics_file.read() == metrics.exposition()))
+    os.remove("test_metrics.prom")
+
+    n = 100000
+    start = time_monotonic()
+    for i in range(n):
+        latency.observe(0.001)
+    per_observation = (time_monotonic() - start) / n
+    print ("Recording a value should take less than " + str(Metrics.OVERHEAD_BUDGET * 1e6) + " us, it takes " +
+           str(per_observation * 1e6))
+
+    gpio = SimulatedGPIO()
+    player = StimulusScheduler.WaveformPlayer(gpio)
+    player.play(StimulusScheduler.single_pulse(27, 0.02))
+    print ("Pulse width should be about 0.02: " + str(Metrics.pulse_width(player.edge_log, 27)))
+
+
+def test_Simulator():
+    import shutil
+    import Simulator
+    simulation = Simulator.Simulation(data_root_path="test_media/generated", start_time=1436126000.0)
+    visits = Simulator.generate_visits(simulation.task, simulation.clock(), 4 * 3600, n_mice=5, seed=1)
+    simulation.add_visits(visits)
+    simulation.run()
+    print ("4 h of " + str(len(visits)) + " visits should run in seconds, took: " + str(simulation.real_seconds))
+    print ("Data and quickStats files should match the expected, problems: " + str(simulation.check()))
+
+    replay = Simulator.Simulation(data_root_path="test_media/replay", start_time=1436124000.0)
+    replay.add_visits(Simulator.visits_from_log("test.txt"))
+    replay.run()
+    print ("Replaying the " + str(len(replay.visits)) + " visits in test.txt should give no problems: " +
+           str(replay.check()))
+    shutil.rmtree("test_media")
+
+
+# n_updates changes to 8 mice, as Mouse objects with the counts after each change.
+def journal_updates(n_updates, seed):
+    import random
+    rng = random.Random(seed)
+    mice = dict((tag, Mouse(tag)) for tag in (111, 222, 333, 444, 555, 666, 777, 888))
+    updates = []
+    for i in range(n_updates):
+        mouse = rng.choice(list(mice.values()))
+        field = rng.choice(Mouse.__slots__[1:])
+        setattr(mouse, field, getattr(mouse, field) + 1)
+        copy = Mouse(mouse.tag)
+        for name in Mouse.__slots__[1:]:
+            setattr(copy, name, getattr(mouse, name))
+        updates.append(copy)
+    return updates
+
+
+# State of the journal after each prefix of updates, prefix k at position k.
+def journal_states(updates):
+    states = [{}]
+    for mouse in updates:
+        state = dict(states[-1])
+        state[mouse.tag] = (mouse.entries, mouse.entrance_rewards, mouse.headfixes, mouse.headfixed_rewards)
+        states.append(state)
+    return states
+
+
+def journal_writer(path, n_updates, seed):
+    import Journal
+    journal = Journal.MouseJournal(path, snapshot_interval=50)
+    for mouse in journal_updates(n_updates, seed):
+        journal.write(mouse)
+    journal.close()
+
+
+def test_Journal():
+    import multiprocessing
+    import random
+    import signal
+    import Journal
+    path = "test_journal.bin"
+    rng = random.Random(0)
+    n_updates = 20000
+
+    # Killed at arbitrary points, snapshots and compactions included.
+    updates = journal_updates(n_updates, 1)
+    states = journal_states(updates)
+    consistent = 0
+    for run in range(5):
+        for p in (path, path + ".snapshot"):
+            if os.path.exists(p):
+                os.remove(p)
+        writer = multiprocessing.Process(target=journal_writer, args=(path, n_updates, 1))
+        writer.start()
+        sleep(rng.uniform(0.02, 0.2))
+        os.kill(writer.pid, signal.SIGKILL)
+        writer.join()
+        journal = Journal.MouseJournal(path)
+        if journal.state in states:
+            consistent += 1
+            # carries on where it stopped
+            done = states.index(journal.state)
+            for mouse in updates[done:done + 100]:
+                journal.write(mouse)
+            journal.close()
+            if Journal.MouseJournal(path).state != states[min(done + 100, n_updates)]:
+                consistent -= 1
+    print ("Every killed journal should recover a state it went through and go on from it: " +
+           str(consistent) + " of 5")
+
+    # Torn and damaged records.
+    updates = journal_updates(500, 2)
+    states = journal_states(updates)
+    os.remove(path)
+    os.remove(path + ".snapshot")
+    journal = Journal.MouseJournal(path, snapshot_interval=10000)
+    for mouse in updates:
+        journal.write(mouse)
+    os.close(journal.fd)
+    with open(path, "rb") as journal_file:
+        data = journal_file.read()
+    torn_ok = 0
+    for cut in range(10):
+        length = rng.randrange(Journal.HEADER.size, len(data))
+        with open(path, "wb") as journal_file:
+            journal_file.write(data[:length])
+        journal = Journal.MouseJournal(path)
+        os.close(journal.fd)
+        n_records = (length - Journal.HEADER.size) // Journal.RECORD.size
+        if journal.state == states[n_records] and os.path.getsize(path) == Journal.HEADER.size + n_records * Journal.RECORD.size:
+            torn_ok += 1
+    print ("A journal cut anywhere should recover every whole record and drop the rest: " + str(torn_ok) + " of 10")
+
+    damaged = bytearray(data)
+    record = 123
+    damaged[Journal.HEADER.size + record * Journal.RECORD.size + 9] ^= 0x10
+    with open(path, "wb") as journal_file:
+        journal_file.write(damaged)
+    journal = Journal.MouseJournal(path)
+    os.close(journal.fd)
+    expected = journal_states(updates[:record] + updates[record + 1:])[-1]
+    print ("A damaged record should be skipped (1), the rest kept: " + str(journal.bad_records) + " " +
+           str(journal.state == expected))
+
+    # Crash after writing the snapshot but before emptying the journal.
+    with open(path, "wb") as journal_file:
+        journal_file.write(data)
+    journal = Journal.MouseJournal(path)
+    journal.write_snapshot()
+    os.close(journal.fd)
+    journal = Journal.MouseJournal(path)
+    print ("Snapshot and the old journal together should give the same state: " + str(journal.state == states[-1]))
+
+    # The registry picks it up where it was.
+    mice = MouseRegistry(None, journal)
+    mouse = mice.get(updates[-1].tag)
+    print ("Registry should have the 8 mice with their counts: " + str(len(mice)) + " " +
+           str(mouse.entries == updates[-1].entries and mouse.headfixed_rewards == updates[-1].headfixed_rewards))
+    mouse.entrance_rewards += 1
+    mice.mark_changed(mouse)
+    mice.close()
+    journal = Journal.MouseJournal(path)
+    os.close(journal.fd)
+    print ("The change should be in the journal: " +
+           str(journal.state[mouse.tag][1] == mouse.entrance_rewards))
+    for p in (path, path + ".snapshot"):
+        os.remove(p)
+
+
+def test_Chambers():
+    import shutil
+    import threading
+    import Chambers
+    import EventStream
+    from VideoRingBuffer import SimulatedCamera
+    n_chambers = 3
+    gpio = SimulatedGPIO()
+    serial_ports = [RFIDFramer.SimulatedSerial() for i in range(n_chambers)]
+    cameras = [SimulatedCamera(startup_time=0.0, settle_time=0.0) for i in range(n_chambers)]
+    configs = [dict(Chambers.simulated_pins(i), cage_id="C" + str(i)) for i in range(n_chambers)]
+    shared = {"pretrigger_video_seconds": None, "metrics_interval": None, "reward_time": 0.05,
+              "number_of_headfix_rewards": 2, "inter_reward_interval": 0.2, "piezo_duration": 0.05,
+              "entrance_reward_delay_time": 0.1, "skedaddle_time": 0.3}
+    try:
+        Chambers.ChamberController([configs[0], configs[0]], shared, "test_media", gpio, serial_ports, cameras)
+        print ("Two chambers on the same pins should raise an error, they did not")
+    except ValueError as e:
+        print ("Two chambers on the same pins should raise an error: " + str(e))
+    controller = Chambers.ChamberController(configs, shared, "test_media", gpio, serial_ports, cameras)
+    controller.start()
+
+    # Three mice go round the three chambers, one visit each at a time.
+    def visits(i):
+        task = controller.chambers[i]
+        for visit in range(3):
+            gpio.set_input(task.range_pin, 1)
+            serial_ports[i].send(RFIDFramer.make_frame("%010X" % (1001 + (i + visit) % 3)))
+            sleep(0.05)
+            gpio.set_input(task.contact_pin, 1)
+            sleep(0.5)
+            gpio.set_input(task.contact_pin, 0)
+            sleep(0.15)
+            gpio.set_input(task.range_pin, 0)
+            sleep(0.3)
+    threads = [threading.Thread(target=visits, args=(i,)) for i in range(n_chambers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sleep(0.2)
+    controller.quit()
+
+    store_path = controller.event_log.store.file_path
+    merged = EventStream.read_store(store_path)
+    n_events = sum(len(open(task.data_full_path).readlines()) for task in controller.chambers)
+    print ("Merged log should have every chamber's events (" + str(n_events) + "): " + str(len(merged)))
+    print ("Merged log should be in time order: " + str(bool((np.diff(merged['epoch']) >= 0).all())))
+    print ("Merged log chambers should be C0, C1, C2: " + str(EventStream.rig_names(store_path)))
+    with open(controller.mice.stats_file_path) as stats_file:
+        lines = stats_file.readlines()
+    print ("Each mouse should have 3 entries and 3 head fixes in the shared registry: " +
+           str([line.split()[1:4:2] for line in lines[1:]]))
+    print ("Contact to pistons should be well under 1 ms in every chamber: " +
+           str([task.contact_to_piston.max for task in controller.chambers]))
+    del merged
+    shutil.rmtree("test_media")
+
+
+def test_MotionEnergy():
+    import glob
+    import shutil
+    import threading
+    import HeadFix
+    import MotionEnergy
+    from VideoCompression import SyntheticFrameSource
+    from VideoRingBuffer import SimulatedCamera
+    analyzer = MotionEnergy.MotionAnalyzer((256, 256))
+    source = SyntheticFrameSource(noise=2.0)
+    still = [analyzer.analyze(source.next_frame())[0] for i in range(30)]
+    source.jitter = 8
+    moving = [analyzer.analyze(source.next_frame())[0] for i in range(30)]
+    print ("Still frames should be under 4, moving ones mostly above: " + "%.2f" % max(still[1:]) + " " +
+           "%.2f" % np.median(moving))
+
+    # A mouse that starts struggling 1 s into a 3 s head fix is released about 0.5 s later.
+    source.jitter = 0
+    config = {"cage_id": "C1", "data_root_path": "test_media/", "confirm_paths": False, "metrics_interval": None,
+              "pretrigger_video_seconds": 0.5, "motion_threshold": 4.0, "motion_release_time": 0.5,
+              "motion_flag_fraction": 0.2, "reward_time": 0.05, "number_of_headfix_rewards": 3,
+              "inter_reward_interval": 1.0, "piezo_duration": 0.05, "entrance_reward_delay_time": 0.1,
+              "skedaddle_time": 0.5}
+    gpio = SimulatedGPIO()
+    serial_port = RFIDFramer.SimulatedSerial()
+    camera = SimulatedCamera(startup_time=0.0, frame_source=source.next_frame, settle_time=0.0)
+    task = HeadFix.Task(gpio, config, serial_port, camera)
+    sleep(0.6)
+    thread = threading.Thread(target=task.start)
+    thread.daemon = True
+    thread.start()
+    gpio.set_input(task.range_pin, 1)
+    serial_port.send(RFIDFramer.make_frame("%010X" % 1001))
+    sleep(0.05)
+    gpio.set_input(task.contact_pin, 1)
+    sleep(1.0)
+    source.jitter = 8
+    sleep(0.7)
+    gpio.set_input(task.contact_pin, 0)
+    sleep(0.2)
+    gpio.set_input(task.range_pin, 0)
+    sleep(0.3)
+    task.quit()
+
+    events = [line.split()[-1] for line in open(task.data_full_path)]
+    headfix_seconds = task.headfix_time.max
+    print ("Head fix should be aborted and flagged for motion: " + str("abort" in events) + " " +
+           str("moving" in events))
+    print ("Head fix should have lasted about 1.5 s, not 3: " + "%.2f" % headfix_seconds)
+    video_path = glob.glob(os.path.join(task.video_path, "M*.raw"))[0]
+    trace = MotionEnergy.read_motion_trace(MotionEnergy.motion_path_for(video_path))
+    timestamps = np.loadtxt(video_path[:-len(".raw")] + "_timestamps.txt", ndmin=2)
+    print ("Trace and timestamps should have the same frames: " + str(len(trace)) + " " + str(len(timestamps)) +
+           " " + str(bool((trace['frame'] == timestamps[:, 0]).all() and (trace['epoch'] == timestamps[:, 1]).all())))
+    print ("Motion analysis should take well under 33 ms a frame: " +
+           "%.2f" % (task.metrics.histograms["motion_analysis_seconds"].max * 1e3) + " ms")
+    task.camera.motion.close()
+    shutil.rmtree("test_media")
+
+
+# Reads a frame bus up to frame last_seq, every frame taking delay, and sends (read, dropped, wrong) to results.
+def frame_bus_consumer(name, consumer_id, delay, last_seq, results):
+    import FrameBus
+    reader = FrameBus.FrameBusReader(name, consumer_id)
+    wrong = 0
+    seq = -1
+    while seq < last_seq:
+        entry = reader.next_frame(2.0)
+        if entry is None:
+            break
+        seq, timestamp, frame = entry
+        # every frame is filled with its own number
+        good = frame[0] == seq % 256 and frame[-1] == seq % 256 and timestamp == seq
+        sleep(delay)
+        if reader.still_valid(seq) and not good:
+            wrong += 1
+        entry = frame = None
+    results.put((consumer_id, reader.frames_read, reader.frames_dropped, wrong))
+    reader.close()
+
+
+def test_FrameBus():
+    import multiprocessing
+    import FrameBus
+    frame_bytes = 256 * 256 * 3
+    bus = FrameBus.FrameBus(frame_bytes, capacity=30)
+    results = multiprocessing.Queue()
+    # a consumer keeping up and one taking 100 ms a frame
+    consumers = [multiprocessing.Process(target=frame_bus_consumer, args=(bus.name, 0, 0.0, 299, results)),
+                 multiprocessing.Process(target=frame_bus_consumer, args=(bus.name, 1, 0.1, 299, results))]
+    for consumer in consumers:
+        consumer.start()
+    sleep(0.5)
+    publish_times = []
+    slow = set()
+    for seq in range(300):
+        frame = bytes([seq % 256]) * frame_bytes
+        start = time_monotonic()
+        bus.publish(frame, float(seq))
+        publish_times.append(time_monotonic() - start)
+        slow.update(bus.slow_consumers())
+        sleep(0.005)
+    reports = sorted(results.get() for consumer in consumers)
+    for consumer in consumers:
+        consumer.join()
+    bus.close()
+    print ("The consumer keeping up should read every frame, with none dropped or wrong: " + str(reports[0][1:]))
+    print ("The slow consumer should read some frames, drop the rest, none wrong: " + str(reports[1][1:]))
+    print ("Only the slow consumer should be seen as slow: " + str(sorted(slow)))
+    publish_times.sort()
+    print ("Publishing should never wait for the consumers, median and longest: " +
+           "%.3f" % (publish_times[150] * 1e3) + " " + "%.3f" % (publish_times[-1] * 1e3) + " ms")
+
+
+def realtime_producer(name, n_records):
+    import struct
+    import RealtimeProcess
+    ring = RealtimeProcess.SPSCRing(name=name)
+    for i in range(n_records):
+        RealtimeProcess.put_waiting(ring, struct.pack("<Q", i))
+    ring.close()
+
+
+# A control process that only sees one mouse in, and quits.
+def realtime_control(events, counts, connection, config, tag):
+    import RealtimeProcess
+    from RFIDFramer import SimulatedSerial
+    from VideoRingBuffer import SimulatedCamera
+    task = RealtimeProcess.RealtimeTask(events, counts, connection, SimulatedGPIO(), config, SimulatedSerial(),
+                                        SimulatedCamera(settle_time=0.1))
+    task.collector.save_start_session()
+    task.setup_mouse(tag)
+    task.currentMouse.entries += 1
+    task.collector.save_mouse_entry(tag)
+    task.collector.save_mouse_Reward_given(tag, 0)
+    task.collector.save_mouse_exit(tag)
+    task.save_current_stats()
+    task.quit()
+
+
+def test_RealtimeProcess():
+    import multiprocessing
+    import shutil
+    import struct
+    import RealtimeProcess
+    ring = RealtimeProcess.SPSCRing(8, 8)
+    puts = [ring.put(struct.pack("<Q", i)) for i in range(9)]
+    first = ring.get_batch(5)
+    for i in range(9, 14):
+        ring.put(struct.pack("<Q", i))
+    rest = ring.get_batch()
+    taken = [struct.unpack("<Q", record)[0] for record in first + rest]
+    print ("A full ring should refuse the 9th record: " + str(puts[-1]) + ", " + str(ring.full_count))
+    print ("Records should come out in order across the wrap: " + str(taken == list(range(8)) + list(range(9, 14))))
+    ring.close()
+
+    # another process putting much faster than the ring is drained
+    ring = RealtimeProcess.SPSCRing(8, 64)
+    producer = multiprocessing.Process(target=realtime_producer, args=(ring.name, 20000))
+    producer.start()
+    taken = []
+    while len(taken) < 20000:
+        taken.extend(struct.unpack("<Q", record)[0] for record in ring.get_batch(50))
+    producer.join()
+    print ("Every record from the other process should come once, in order: " + str(taken == list(range(20000))))
+    ring.close()
+
+    config = {"cage_id": "RT", "data_root_path": "test_media/", "confirm_paths": False,
+              "pretrigger_video_seconds": None, "metrics_interval": None}
+    for visit in range(2):
+        event_ring = RealtimeProcess.SPSCRing(RealtimeProcess.EVENT_RECORD.size, 64)
+        counts_ring = RealtimeProcess.SPSCRing(RealtimeProcess.COUNTS_RECORD.size, 64)
+        worker_end, control_end = multiprocessing.Pipe()
+        control = multiprocessing.Process(target=realtime_control,
+                                          args=(event_ring.name, counts_ring.name, control_end, config, 1234))
+        control.start()
+        worker = RealtimeProcess.IOWorker(event_ring, counts_ring, worker_end)
+        worker.run(control)
+        control.join()
+        event_ring.close()
+        counts_ring.close()
+    text_path = os.path.dirname(worker.collector.data_file_path)
+    with open(worker.collector.data_file_path) as data_file:
+        lines = data_file.read().splitlines()
+    print ("The data file should have both runs' events, written by the worker: " +
+           " ".join(line.split("\t")[-1] for line in lines))
+    print ("The session events should keep their tag: " + lines[0].split("\t")[0])
+    with open(worker.mice.stats_file_path) as stats_file:
+        print ("The second run should carry on from the journal, 2 entries: " + stats_file.read().splitlines()[1])
+    print ("Every file should be in " + text_path + ": " + " ".join(sorted(os.listdir(text_path))))
+    shutil.rmtree("test_media")
+
+
+def test_StatusServer():
+    import StatusServer
+    board = StatusServer.StatusBoard(event_capacity=4, mouse_capacity=2)
+    for i in range(6):
+        board.add(1234, 1000.0 + i, "reward" + str(i))
+    events, missed = board.since(0)
+    print ("The board should keep the last 4 events and miss 1 after seq 0: " +
+           str([event["seq"] for event in events]) + " " + str(missed) + " " + events[-1]["event"])
+    for tag in (1, 2, 3):
+        board.update_mouse(Mouse(tag))
+    print ("Only 2 mice should fit, 1 left out: " + str(len(board.mouse_counts())) + " " + str(board.mice_left_out))
+    board.close()
+
+    # served from this process
+    board = StatusServer.StatusBoard()
+    mice = MouseRegistry()
+    mice.add(4321)
+    mice.set_status(board)
+    collector = DataCollector("test_status.txt", background=True, echo=False, status=board)
+    collector.save_start_session()
+    mouse = mice.add(1234)
+    mouse.entries += 1
+    mice.mark_changed(mouse)
+    collector.save_mouse_entry(1234)
+    server = StatusServer.StatusServer(("127.0.0.1", 0), board, "C1")
+    status = StatusServer.get_status(server.address)
+    print ("The status should have the cage, the mouse inside, both mice and both events: " + status["cage_id"] + " " +
+           str(status["mouse_inside"]) + " " + str([(m["tag"], m["entries"]) for m in status["mice"]]) + " " +
+           " ".join(event["event"] for event in status["events"]))
+    # a follower waiting for what comes after the entry
+    after = status["events"][-1]["seq"]
+    timer = threading.Timer(0.3, collector.save_mouse_exit, (1234,))
+    timer.start()
+    start = time_monotonic()
+    answer = StatusServer.get_status(server.address, "/events?after=" + str(after) + "&wait=5")
+    print ("The long poll should come back with the exit in about 0.3 s: " +
+           str([event["event"] for event in answer["events"]]) + " " + "%.2f" % (time_monotonic() - start))
+    start = time_monotonic()
+    answer = StatusServer.get_status(server.address, "/events?after=" + str(answer["next_seq"] - 1) + "&wait=0.2")
+    print ("With nothing new it should come back empty after 0.2 s: " + str(answer["events"]) + " " +
+           "%.2f" % (time_monotonic() - start))
+    try:
+        StatusServer.get_status(server.address, "/nothing")
+        print ("An unknown path should be an error, it was not")
+    except IOError as e:
+        print ("An unknown path should be an error: " + str(e))
+    server.close()
+    collector.close()
+    board.close()
+    os.remove("test_status.txt")
+
+    # served by a process of its own, on a Unix socket
+    status_process = StatusServer.StatusProcess("test_status.sock", "C2")
+    status_process.board.add(1234, 1000.0, "entry")
+    status_process.board.update_mouse(mouse)
+    address = status_process.wait_ready()
+    status = StatusServer.get_status(address)
+    print ("The status process should see the board: " + status["cage_id"] + " " + str(status["mouse_inside"]) +
+           " " + str(StatusServer.get_status(address, "/mice")["mice"]))
+    status_process.close()
+    print ("The Unix socket should be gone: " + str(not os.path.exists("test_status.sock")))
+
+
 #test_TagReader()
 #test_Mouse()
 #test_BrainCamera()
+#test_EdgeInput()
+#test_BackgroundDataCollector()
+#test_EventLog()
+#test_TagFramer()
+#test_TagReaderListener()
+#test_MouseRegistry()
+#test_WaveformPlayer()
+#test_TrialEngine()
+#test_PigpioTrialEngine()
+#test_VideoCompression()
+#test_PretriggerVideo()
+#test_RawVideo()
+#test_Analysis()
+#test_EventStream()
+#test_TaskStartup()
+#test_Refix()
+#test_Metrics()
+#test_Simulator()
+#test_Journal()
+#test_Chambers()
+#test_MotionEnergy()
+#test_FrameBus()
+#test_FrameAveraging()
+#test_RealtimeProcess()
+#test_StatusServer()
 test_DataCollector()
\ No newline at end of file
@@ -0,0 +1,141 @@
+__author__ = 'Federico'
+
+import asyncio
+
+
+class TrialEngine:
+    """
+    Runs a trial timeline on an asyncio event loop while the sensors are watched.
+
+    A timeline is a list of (time, action, argument), time in seconds from the
+    start of the trial. actions maps each action name to a coroutine function
+    taking the argument, i.e. 'reward', 'light', 'stimulus', 'camera_start',
+    'camera_stop', 'led'. Every action starts at its own time, so actions can
+    overlap. The built-in action 'end' does nothing, it just makes the trial
+    last until its time.
+
+    sensor_policies maps (pin, level) to what happens when that pin reaches
+    that level during the trial:
+        'abort'  - cancel everything still running or pending, run_timeline returns the reason
+        'ignore' - nothing
+        callable - called as policy(engine, pin, level, edge_time) to adapt the trial,
+                   it can call engine.abort(reason) or engine.cancel(action)
+    """
+    def __init__(self, actions, sensors=None, sensor_policies=None, loop=None):
+        self.actions = actions
+        self.sensors = sensors
+        if sensor_policies is None:
+            sensor_policies = {}
+        self.sensor_policies = sensor_policies
+        if loop is None:
+            loop = asyncio.new_event_loop()
+        self.loop = loop
+
+        # (time, action, argument, what happened) for the last trial
+        self.log = []
+        # (action, task) for the trial being run
+        self.tasks = []
+        self.aborted = None
+        self.running = False
+
+        if self.sensors is not None:
+            self.sensors.add_listener(self.on_sensor_edge)
+
+    # Called by EdgeInput from the GPIO thread.
+    def on_sensor_edge(self, pin, level, edge_time):
+        if self.running:
+            self.loop.call_soon_threadsafe(self.handle_sensor, pin, level, edge_time)
+
+    def handle_sensor(self, pin, level, edge_time):
+        if not self.running:
+            return
+        policy = self.sensor_policies.get((pin, level), 'ignore')
+        if policy == 'ignore':
+            return
+        self.log.append((self.loop.time(), 'sensor', (pin, level), policy if isinstance(policy, str) else 'adapt'))
+        if policy == 'abort':
+            self.abort("pin " + str(pin) + " went " + str(level))
+        else:
+            policy(self, pin, level, edge_time)
+
+    def abort(self, reason):
+        if self.aborted is not None and not self.aborted.done():
+            self.aborted.set_result(reason)
+
+    # abort from another thread, i.e. a MotionEnergy.MotionMonitor listener. Does nothing between trials.
+    def abort_threadsafe(self, reason):
+        aborted = self.aborted
+        if self.running and aborted is not None:
+            self.loop.call_soon_threadsafe(self.abort_trial, aborted, reason)
+
+    # Aborts the trial whose future is aborted, if it is still the one running.
+    def abort_trial(self, aborted, reason):
+        if aborted is self.aborted:
+            self.abort(reason)
+
+    # Cancels every running or pending action with this name.
+    def cancel(self, action):
+        for name, task in self.tasks:
+            if name == action:
+                task.cancel()
+
+    """
+    Runs timeline to the end, or until a sensor policy aborts it.
+    Returns None if the trial ran to the end, the abort reason otherwise.
+    """
+    def run_timeline(self, timeline):
+        return self.loop.run_until_complete(self.run(timeline))
+
+    async def run(self, timeline):
+        self.log = []
+        self.tasks = []
+        self.aborted = self.loop.create_future()
+        self.running = True
+        start_time = self.loop.time()
+        try:
+            for t, action, argument in sorted(timeline, key=lambda entry: entry[0]):
+                task = asyncio.ensure_future(self.run_action(start_time + t, action, argument))
+                self.tasks.append((action, task))
+            # The sensors may already be where a policy says to stop.
+            if self.sensors is not None:
+                for (pin, level) in self.sensor_policies:
+                    if self.sensors.level(pin) == level:
+                        self.handle_sensor(pin, level, self.loop.time())
+
+            pending = set([task for action, task in self.tasks])
+            while pending and not self.aborted.done():
+                done, pending = await asyncio.wait(pending | set([self.aborted]),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                pending.discard(self.aborted)
+                for task in done:
+                    if task is not self.aborted and not task.cancelled() and task.exception() is not None:
+                        self.abort("error: " + repr(task.exception()))
+
+            if self.aborted.done():
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    await asyncio.wait(pending)
+                return self.aborted.result()
+            return None
+        finally:
+            self.running = False
+
+    async def run_action(self, deadline, action, argument):
+        delay = deadline - self.loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.log.append((self.loop.time(), action, argument, 'start'))
+        if action == 'end':
+            return
+        try:
+            await self.actions[action](argument)
+        except asyncio.CancelledError:
+            self.log.append((self.loop.time(), action, argument, 'cancelled'))
+            raise
+        self.log.append((self.loop.time(), action, argument, 'done'))
+
+    def close(self):
+        if self.sensors is not None:
+            self.sensors.remove_listener(self.on_sensor_edge)
+        self.loop.close()
@@ -0,0 +1,372 @@
+__author__ = 'Federico'
+
+import multiprocessing
+import os
+import queue
+import struct
+import zlib
+from time import time
+
+import numpy as np
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+"""
+Compressed video chunks written while the camera records.
+
+Each chunk file (<name>.<chunk number>.hfz) holds at most frames_per_chunk frames:
+    header  48 bytes, see HEADER
+    frames  uint32 size + compressed bytes, one after the other
+    index   float64 timestamp and uint64 file offset of every frame
+The first frame of a chunk is stored whole, the following ones as the
+difference to the previous frame (modulo 256, so it is still lossless),
+which compresses much better as most of the image does not change.
+
+The header is written when the chunk is opened, with no frames and no
+index; closing the chunk fills both in. A chunk left open by a crash
+still reads: CompressedVideoReader finds its frames by walking them from
+the header on, up to the last whole one, but their timestamps are lost
+(NaN), the _timestamps.txt file of a pretrigger capture still has them.
+"""
+
+MAGIC = b"HFVIDEO1"
+# magic, n_frames, height, width, channels, binning, quantize_bits, delta, codec, frame rate, index offset
+HEADER = struct.Struct("<8sIHHHHBBBxfQ12x")
+FRAME_SIZE = struct.Struct("<I")
+CODEC_ZLIB = 0
+CODEC_LZ4 = 1
+
+
+class CompressionOptions:
+    """
+    channel        - keep only this colour channel (0 red, 1 green, 2 blue), None keeps all (lossless)
+    binning        - average binning x binning pixels into one, 1 keeps the full resolution
+    quantize_bits  - drop this many low bits of every pixel (near-lossless), 0 is lossless
+    delta          - store frames as differences to the previous frame
+    codec          - "zlib" or "lz4" (if installed)
+    level          - compression level, low is fast
+    """
+    def __init__(self, channel=None, binning=1, quantize_bits=0, delta=True, codec="zlib", level=1,
+                 frames_per_chunk=900):
+        self.channel = channel
+        self.binning = binning
+        self.quantize_bits = quantize_bits
+        self.delta = delta
+        if codec == "lz4" and lz4 is None:
+            codec = "zlib"
+        self.codec = codec
+        self.level = level
+        self.frames_per_chunk = frames_per_chunk
+
+
+class FrameEncoder:
+    """
+    Turns raw RGB frames into the stored representation and compresses them.
+    Runs in the compressor process.
+    """
+    def __init__(self, resolution, options):
+        self.width, self.height = resolution
+        self.options = options
+        self.previous = None
+
+    def prepare(self, frame_bytes):
+        options = self.options
+        frame = np.frombuffer(frame_bytes, dtype=np.uint8).reshape(self.height, self.width, 3)
+        if options.channel is not None:
+            frame = frame[:, :, options.channel:options.channel + 1]
+        if options.binning > 1:
+            b = options.binning
+            h, w, c = frame.shape
+            frame = frame[:h - h % b, :w - w % b].reshape(h // b, b, w // b, b, c)
+            frame = frame.mean(axis=(1, 3), dtype=np.float32).astype(np.uint8)
+        if options.quantize_bits:
+            frame = frame >> options.quantize_bits
+        return np.ascontiguousarray(frame)
+
+    def encode(self, frame_bytes, keyframe):
+        frame = self.prepare(frame_bytes)
+        if self.options.delta and not keyframe and self.previous is not None:
+            data = (frame - self.previous).tobytes()
+        else:
+            data = frame.tobytes()
+        self.previous = frame
+        if self.options.codec == "lz4":
+            return lz4.frame.compress(data), frame.shape
+        return zlib.compress(data, self.options.level), frame.shape
+
+
+class ChunkWriter:
+    # One .hfz chunk file being written, readable from the start (see above).
+    def __init__(self, file_path, shape, options, frame_rate):
+        self.file = open(file_path, "wb")
+        self.shape = shape
+        self.options = options
+        self.frame_rate = frame_rate
+        self.timestamps = []
+        self.offsets = []
+        self.write_header(0, 0)
+        self.file.flush()
+
+    def write_header(self, n_frames, index_offset):
+        codec = CODEC_LZ4 if self.options.codec == "lz4" else CODEC_ZLIB
+        height, width, channels = self.shape
+        self.file.write(HEADER.pack(MAGIC, n_frames, height, width, channels,
+                                    self.options.binning, self.options.quantize_bits,
+                                    int(self.options.delta), codec, self.frame_rate, index_offset))
+
+    def write(self, data, timestamp):
+        self.timestamps.append(timestamp)
+        self.offsets.append(self.file.tell())
+        self.file.write(FRAME_SIZE.pack(len(data)))
+        self.file.write(data)
+
+    def close(self):
+        index_offset = self.file.tell()
+        self.file.write(np.array(self.timestamps, dtype="<f8").tobytes())
+        self.file.write(np.array(self.offsets, dtype="<u8").tobytes())
+        self.file.seek(0)
+        self.write_header(len(self.timestamps), index_offset)
+        self.file.close()
+
+
+class CompressedStream:
+    # One recording in the compressor process, chunks are name.000.hfz, name.001.hfz...
+    def __init__(self, name, resolution, frame_rate, options):
+        self.name = name
+        self.frame_rate = frame_rate
+        self.options = options
+        self.encoder = FrameEncoder(resolution, options)
+        self.chunk = None
+        self.n_chunk = 0
+
+    def write(self, frame_bytes, timestamp):
+        keyframe = self.chunk is None
+        data, shape = self.encoder.encode(frame_bytes, keyframe)
+        if self.chunk is None:
+            self.chunk = ChunkWriter(self.name + ".%03d.hfz" % self.n_chunk, shape, self.options, self.frame_rate)
+            self.n_chunk += 1
+        self.chunk.write(data, timestamp)
+        if len(self.chunk.timestamps) >= self.options.frames_per_chunk:
+            self.chunk.close()
+            self.chunk = None
+
+    def close(self):
+        if self.chunk is not None:
+            self.chunk.close()
+            self.chunk = None
+
+
+"""
+Body of the compressor process. Every recording is a stream of its own,
+so the tail of one can still be coming in after the next has started.
+Messages on frame_queue:
+    ("start", stream, name, resolution, frame_rate)  new recording
+    ("frame", stream, frame bytes, timestamp)
+    ("stop", stream)                                  closes its last chunk
+    None                                              ends the process
+"""
+def compressor_process(frame_queue, options):
+    streams = {}
+    while True:
+        message = frame_queue.get()
+        if message is None:
+            break
+        if message[0] == "start":
+            stream, name, resolution, frame_rate = message[1:]
+            streams[stream] = CompressedStream(name, resolution, frame_rate, options)
+        elif message[0] == "frame":
+            stream = streams.get(message[1])
+            if stream is not None:
+                stream.write(message[2], message[3])
+        elif message[0] == "stop":
+            stream = streams.pop(message[1], None)
+            if stream is not None:
+                stream.close()
+    for stream in streams.values():
+        stream.close()
+
+
+class VideoCompressor:
+    """
+    Output for picamera that compresses on the fly.
+    write() is called by picamera with the raw frames, it only puts them in a
+    bounded queue (frames are dropped, and counted, if the compressor falls
+    behind) and a separate process does the compression on its own core.
+    start() returns the id of the new recording; add_frame and stop take it
+    to keep several recordings apart, i.e. the captures of a
+    VideoRingBuffer.PretriggerOutput, and go to the last one started without.
+    """
+    def __init__(self, resolution, frame_rate, options=None, queue_size=60):
+        if options is None:
+            options = CompressionOptions()
+        self.resolution = resolution
+        self.frame_rate = frame_rate
+        self.options = options
+        self.frame_bytes = resolution[0] * resolution[1] * 3
+
+        self.queue = multiprocessing.Queue(queue_size)
+        self.process = multiprocessing.Process(target=compressor_process, args=(self.queue, options),
+                                               name="VideoCompressor")
+        self.process.daemon = True
+        self.process.start()
+
+        self.buffer = b""
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.n_streams = 0
+        self.stream = None
+
+    def start(self, name):
+        self.buffer = b""
+        self.n_streams += 1
+        self.stream = self.n_streams
+        self.queue.put(("start", self.stream, name, self.resolution, self.frame_rate))
+        return self.stream
+
+    # picamera writes each frame in one or more calls.
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.frame_bytes:
+            self.add_frame(self.buffer[:self.frame_bytes], time())
+            self.buffer = self.buffer[self.frame_bytes:]
+        return len(data)
+
+    def add_frame(self, frame, timestamp, stream=None):
+        if stream is None:
+            stream = self.stream
+        try:
+            self.queue.put_nowait(("frame", stream, frame, timestamp))
+            self.frames_written += 1
+        except queue.Full:
+            self.frames_dropped += 1
+
+    def flush(self):
+        pass
+
+    def stop(self, stream=None):
+        if stream is None:
+            stream = self.stream
+        self.queue.put(("stop", stream))
+
+    def close(self):
+        self.queue.put(None)
+        self.process.join()
+
+
+class CompressedVideoReader:
+    """
+    Reads one .hfz chunk back into (n_frames, height, width, channels) uint8 frames.
+    Pixel values are the stored ones, shifted back up if they were quantized.
+    complete is False for a chunk that was never closed, whose frames were
+    recovered by walking the file (timestamps NaN).
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with open(file_path, "rb") as f:
+            (magic, self.n_frames, self.height, self.width, self.channels, self.binning,
+             self.quantize_bits, self.delta, self.codec, self.frame_rate,
+             index_offset) = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError("Not a compressed video chunk: " + file_path)
+            self.complete = index_offset != 0
+            if self.complete:
+                f.seek(index_offset)
+                self.timestamps = np.frombuffer(f.read(8 * self.n_frames), dtype="<f8")
+                self.offsets = np.frombuffer(f.read(8 * self.n_frames), dtype="<u8")
+            else:
+                self.offsets = self.recover_offsets(f)
+                self.n_frames = len(self.offsets)
+                self.timestamps = np.full(self.n_frames, np.nan)
+
+    """
+    Offsets of the whole frames of a chunk with no index. Every frame has to
+    decompress to a whole frame, so a torn last frame, or an index cut short
+    while the chunk was being closed, is left out.
+    """
+    def recover_offsets(self, f):
+        frame_bytes = self.height * self.width * self.channels
+        file_size = os.fstat(f.fileno()).st_size
+        offsets = []
+        offset = HEADER.size
+        while offset + FRAME_SIZE.size <= file_size:
+            f.seek(offset)
+            size = FRAME_SIZE.unpack(f.read(FRAME_SIZE.size))[0]
+            if offset + FRAME_SIZE.size + size > file_size:
+                break
+            try:
+                if len(self.decompress(f.read(size))) != frame_bytes:
+                    break
+            except (zlib.error, RuntimeError):
+                break
+            offsets.append(offset)
+            offset += FRAME_SIZE.size + size
+        return np.array(offsets, dtype=np.uint64)
+
+    def decompress(self, data):
+        if self.codec == CODEC_LZ4:
+            return lz4.frame.decompress(data)
+        return zlib.decompress(data)
+
+    def __len__(self):
+        return self.n_frames
+
+    def __iter__(self):
+        shape = (self.height, self.width, self.channels)
+        previous = None
+        with open(self.file_path, "rb") as f:
+            for offset in self.offsets:
+                f.seek(int(offset))
+                size = FRAME_SIZE.unpack(f.read(FRAME_SIZE.size))[0]
+                data = self.decompress(f.read(size))
+                frame = np.frombuffer(data, dtype=np.uint8).reshape(shape)
+                if self.delta and previous is not None:
+                    frame = frame + previous
+                previous = frame
+                yield frame << self.quantize_bits if self.quantize_bits else frame
+
+    def read_all(self):
+        frames = np.empty((self.n_frames, self.height, self.width, self.channels), dtype=np.uint8)
+        for i, frame in enumerate(self):
+            frames[i] = frame
+        return frames
+
+
+# Chunk files of a recording, in order.
+def chunk_paths(name):
+    directory, base = os.path.split(name)
+    directory = directory or "."
+    paths = [os.path.join(directory, f) for f in os.listdir(directory)
+             if f.startswith(base + ".") and f.endswith(".hfz")]
+    return sorted(paths)
+
+
+class SyntheticFrameSource:
+    """
+    Frames that look roughly like the brain camera's: a fixed vessel-like
+    pattern, a slow global fluctuation and per-pixel sensor noise.
+    While jitter is set, the pattern moves by up to jitter pixels each way
+    every frame, like the image of a mouse struggling under the head bar.
+    """
+    def __init__(self, resolution=(256, 256), noise=2.0, seed=0, jitter=0):
+        self.width, self.height = resolution
+        self.noise = noise
+        self.jitter = jitter
+        self.rng = np.random.RandomState(seed)
+        y, x = np.mgrid[0:self.height, 0:self.width].astype(np.float32)
+        base = 120 + 40 * np.sin(x / 17.0) * np.cos(y / 23.0) + 30 * np.exp(-((x - 128) ** 2 + (y - 128) ** 2) / 4000.0)
+        self.base = np.stack([base * 0.6, base, base * 0.4], axis=2)
+        self.n = 0
+
+    def next_frame(self):
+        self.n += 1
+        base = self.base
+        if self.jitter:
+            shift = tuple(self.rng.randint(-self.jitter, self.jitter + 1, size=2))
+            base = np.roll(base, shift, axis=(0, 1))
+        frame = base * (1.0 + 0.02 * np.sin(self.n / 15.0))
+        if self.noise:
+            frame = frame + self.rng.normal(0, self.noise, frame.shape)
+        return np.clip(frame, 0, 255).astype(np.uint8).tobytes()
@@ -0,0 +1,301 @@
+__author__ = 'Federico'
+
+import threading
+from time import sleep, time
+
+import numpy as np
+
+
+class FrameRingBuffer:
+    """
+    The last capacity frames, in preallocated memory. Every frame gets a
+    sequence number, frame seq lives in slot seq % capacity until it is
+    overwritten capacity frames later.
+    """
+    def __init__(self, frame_bytes, capacity):
+        self.frame_bytes = frame_bytes
+        self.capacity = capacity
+        self.frames = np.zeros((capacity, frame_bytes), dtype=np.uint8)
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        # sequence number the next frame will get
+        self.next_seq = 0
+        self.condition = threading.Condition()
+
+    def add(self, data, timestamp):
+        slot = self.next_seq % self.capacity
+        self.frames[slot] = np.frombuffer(data, dtype=np.uint8)
+        self.timestamps[slot] = timestamp
+        with self.condition:
+            self.next_seq += 1
+            self.condition.notify_all()
+
+    # Oldest frame that is safe to read: the slot after it may be being overwritten right now.
+    def oldest_seq(self):
+        return max(0, self.next_seq - self.capacity + 1)
+
+    # Copy of frame seq as (bytes, timestamp), None if it was already overwritten.
+    def get(self, seq):
+        slot = seq % self.capacity
+        frame = self.frames[slot].tobytes()
+        timestamp = self.timestamps[slot]
+        # The producer may have reused the slot while we were copying.
+        if seq < self.oldest_seq():
+            return None
+        return frame, timestamp
+
+    # Waits until frame seq exists or timeout seconds go by, returns whether it does.
+    def wait_for(self, seq, timeout):
+        with self.condition:
+            if seq >= self.next_seq:
+                self.condition.wait(timeout)
+            return seq < self.next_seq
+
+
+class RawFileSink:
+    # Writes frames one after the other in a .raw file, like picamera does.
+    def __init__(self, file_path):
+        self.file = open(file_path, "wb")
+
+    def write_frame(self, frame, timestamp):
+        self.file.write(frame)
+
+    def close(self):
+        self.file.close()
+
+
+class CompressorSink:
+    # Hands frames to a VideoCompression.VideoCompressor, as a stream of their own:
+    # the last frames of one capture may still be coming in after the next has started.
+    def __init__(self, compressor, name):
+        self.compressor = compressor
+        self.stream = self.compressor.start(name)
+
+    def write_frame(self, frame, timestamp):
+        self.compressor.add_frame(frame, timestamp, self.stream)
+
+    def close(self):
+        self.compressor.stop(self.stream)
+
+
+class CaptureWriter:
+    """
+    Copies frames from the ring buffer to a sink in its own thread, from
+    start_seq on, until stop() is called, and writes the timestamp of every
+    frame to a sidecar text file (frame number, tab, epoch time).
+    """
+    def __init__(self, ring, start_seq, sink, timestamps_path):
+        self.ring = ring
+        self.sink = sink
+        self.seq = start_seq
+        self.stop_seq = None
+        self.timestamps_file = open(timestamps_path, "w")
+        self.frames_written = 0
+        self.frames_lost = 0
+        self.thread = threading.Thread(target=self.run, name="CaptureWriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while self.stop_seq is None or self.seq < self.stop_seq:
+            if not self.ring.wait_for(self.seq, 0.1):
+                continue
+            # stop() may have come while waiting for a frame past the end
+            if self.stop_seq is not None and self.seq >= self.stop_seq:
+                break
+            if self.seq < self.ring.oldest_seq():
+                # Fell more than a whole buffer behind, skip to the oldest frame still there.
+                self.frames_lost += self.ring.oldest_seq() - self.seq
+                self.seq = self.ring.oldest_seq()
+                continue
+            entry = self.ring.get(self.seq)
+            if entry is None:
+                continue
+            frame, timestamp = entry
+            self.sink.write_frame(frame, timestamp)
+            self.timestamps_file.write(str(self.frames_written) + "\t" + repr(float(timestamp)) + "\n")
+            self.frames_written += 1
+            self.seq += 1
+        self.sink.close()
+        self.timestamps_file.close()
+
+    # Frames up to (not including) stop_seq are still written, then the files are closed.
+    def stop(self, stop_seq):
+        self.stop_seq = stop_seq
+
+    def join(self):
+        self.thread.join()
+
+
+class PretriggerOutput:
+    """
+    picamera output for continuous recording into a FrameRingBuffer.
+    The camera is started once and never stopped between head fixes.
+    begin_capture returns straight away: a CaptureWriter starts pre_seconds back
+    in the buffer and follows the live frames until end_capture.
+    Both return the sequence number of the first frame of the capture and of
+    the one after its last, i.e. for a MotionEnergy.MotionMonitor trace.
+    bus, a FrameBus.FrameBus, also gets every frame for other processes.
+    """
+    def __init__(self, resolution, frame_rate, buffer_seconds, clock=time, bus=None):
+        self.frame_bytes = resolution[0] * resolution[1] * 3
+        self.frame_rate = frame_rate
+        # room for buffer_seconds of frames, plus as much again so a capture
+        # can fall behind without losing frames
+        capacity = max(2, int(2 * buffer_seconds * frame_rate))
+        self.ring = FrameRingBuffer(self.frame_bytes, capacity)
+        self.buffer_seconds = buffer_seconds
+        self.clock = clock
+        self.bus = bus
+        self.partial = b""
+        self.capture = None
+        self.finished_captures = []
+
+    # picamera writes each frame in one or more calls.
+    def write(self, data):
+        if self.partial or len(data) != self.frame_bytes:
+            self.partial += data
+            while len(self.partial) >= self.frame_bytes:
+                self.add_frame(self.partial[:self.frame_bytes])
+                self.partial = self.partial[self.frame_bytes:]
+        else:
+            self.add_frame(data)
+        return len(data)
+
+    def add_frame(self, frame):
+        timestamp = self.clock()
+        self.ring.add(frame, timestamp)
+        if self.bus is not None:
+            self.bus.publish(frame, timestamp)
+
+    def flush(self):
+        pass
+
+    def begin_capture(self, sink, timestamps_path, pre_seconds=None):
+        if pre_seconds is None:
+            pre_seconds = self.buffer_seconds
+        start_seq = max(self.ring.oldest_seq(), self.ring.next_seq - int(round(pre_seconds * self.frame_rate)))
+        self.capture = CaptureWriter(self.ring, start_seq, sink, timestamps_path)
+        return start_seq
+
+    def end_capture(self):
+        if self.capture is None:
+            return None
+        stop_seq = self.ring.next_seq
+        self.capture.stop(stop_seq)
+        self.finished_captures = [capture for capture in self.finished_captures if capture.thread.is_alive()]
+        self.finished_captures.append(self.capture)
+        self.capture = None
+        return stop_seq
+
+    # Waits for every capture to be on disk.
+    def close(self):
+        self.end_capture()
+        for capture in self.finished_captures:
+            capture.join()
+        self.finished_captures = []
+
+
+# M<tag>_<epoch>.raw -> M<tag>_<epoch>_timestamps.txt (the epoch has a dot, only .raw is taken off)
+def timestamps_path_for(video_name_path):
+    if video_name_path.endswith(".raw"):
+        video_name_path = video_name_path[:-len(".raw")]
+    return video_name_path + "_timestamps.txt"
+
+
+class SimulatedCamera:
+    """
+    Stand-in for picamera.PiCamera with synthetic frames.
+    start_recording takes startup_time before the first frame comes out, like
+    the real encoder pipeline, then writes a frame every 1/framerate seconds
+    to the output (a file name or an object with write()).
+    The auto exposure readings (exposure_speed, awb_gains, analog_gain) move
+    for settle_time seconds after the camera is created, then stay put.
+    """
+    def __init__(self, resolution=(256, 256), framerate=30, startup_time=0.3, frame_source=None, settle_time=0.5):
+        self.resolution = resolution
+        self.framerate = framerate
+        self.startup_time = startup_time
+        self.settle_time = settle_time
+        self.created = time()
+        self.fixed_awb_gains = None
+        self.shutter_speed = 0
+        self.exposure_mode = 'auto'
+        self.awb_mode = 'auto'
+        if frame_source is None:
+            frame = bytes(resolution[0] * resolution[1] * 3)
+            frame_source = lambda: frame
+        self.frame_source = frame_source
+        self.recording = False
+        self.thread = None
+        # time() of the first frame written by the last start_recording
+        self.first_frame_time = None
+
+    # 0 to 1 as the auto exposure settles
+    def settled_fraction(self):
+        if self.settle_time <= 0:
+            return 1.0
+        return min(1.0, (time() - self.created) / self.settle_time)
+
+    @property
+    def exposure_speed(self):
+        if self.exposure_mode == 'off' and self.shutter_speed:
+            return self.shutter_speed
+        return int(20000 * self.settled_fraction())
+
+    @property
+    def awb_gains(self):
+        if self.fixed_awb_gains is not None:
+            return self.fixed_awb_gains
+        fraction = self.settled_fraction()
+        return (1.0 + 0.5 * fraction, 1.0 + 0.8 * fraction)
+
+    @awb_gains.setter
+    def awb_gains(self, gains):
+        self.fixed_awb_gains = gains
+
+    @property
+    def analog_gain(self):
+        return 1.0 + 3.0 * self.settled_fraction()
+
+    def start_recording(self, output, format="rgb"):
+        if self.recording:
+            raise RuntimeError("The camera is already recording")
+        self.recording = True
+        self.first_frame_time = None
+        self.thread = threading.Thread(target=self.run, args=(output,), name="SimulatedCamera")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, output):
+        close = False
+        if isinstance(output, str):
+            output = open(output, "wb")
+            close = True
+        sleep(self.startup_time)
+        period = 1.0 / self.framerate
+        next_frame = time()
+        while self.recording:
+            output.write(self.frame_source())
+            if self.first_frame_time is None:
+                self.first_frame_time = time()
+            next_frame += period
+            delay = next_frame - time()
+            if delay > 0:
+                sleep(delay)
+        if close:
+            output.close()
+
+    def stop_recording(self):
+        self.recording = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def start_preview(self):
+        pass
+
+    def stop_preview(self):
+        pass
+
+    def close(self):
+        self.stop_recording()
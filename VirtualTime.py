@@ -0,0 +1,136 @@
+__author__ = 'Federico'
+
+import asyncio
+import heapq
+import selectors
+import threading
+
+
+class VirtualClock:
+    """
+    Clock that only moves when told to. Calling it returns the current time,
+    so it can be given anywhere a clock function (like monotonic) is expected.
+    """
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        if seconds > 0:
+            self.now += seconds
+
+    def advance_to(self, t):
+        if t > self.now:
+            self.now = t
+
+
+class ScheduledClock(VirtualClock):
+    """
+    VirtualClock with a queue of things to do at given virtual times, for
+    discrete-event simulation: schedule(t, callback) runs callback() when the
+    clock gets to t. advance stops right after the first callbacks due, so
+    whoever is waiting (an event loop, wait_until) gets to see what they did.
+    """
+    def __init__(self, start=0.0):
+        VirtualClock.__init__(self, start)
+        # (time, sequence, callback), the sequence keeps callbacks at the same time in order
+        self.queue = []
+        self.sequence = 0
+        self.lock = threading.RLock()
+
+    def schedule(self, t, callback):
+        with self.lock:
+            heapq.heappush(self.queue, (t, self.sequence, callback))
+            self.sequence += 1
+
+    # Time of the next scheduled callback, None if there are none left.
+    def next_time(self):
+        with self.lock:
+            return self.queue[0][0] if self.queue else None
+
+    def pending(self):
+        return len(self.queue)
+
+    def run_due(self):
+        while True:
+            with self.lock:
+                if not self.queue or self.queue[0][0] > self.now:
+                    return
+                t, sequence, callback = heapq.heappop(self.queue)
+            callback()
+
+    # Moves up to seconds ahead, stopping early at the next scheduled callbacks.
+    def advance(self, seconds):
+        target = self.now + max(seconds, 0)
+        next_time = self.next_time()
+        if next_time is not None and next_time <= target:
+            self.now = max(self.now, next_time)
+            self.run_due()
+        else:
+            self.now = target
+
+    def advance_to(self, t):
+        while True:
+            next_time = self.next_time()
+            if next_time is None or next_time > t:
+                break
+            self.now = max(self.now, next_time)
+            self.run_due()
+        if t > self.now:
+            self.now = t
+
+    """
+    Runs the scheduled callbacks one time step after another until predicate()
+    is true, returns True, or until deadline (virtual time, None for no limit),
+    returns predicate(). With no deadline and nothing left to run, predicate
+    can never change and False is returned.
+    """
+    def wait_until(self, predicate, deadline=None):
+        while not predicate():
+            next_time = self.next_time()
+            if next_time is None or (deadline is not None and next_time > deadline):
+                if deadline is None:
+                    return False
+                self.advance_to(deadline)
+                return predicate()
+            self.advance_to(next_time)
+        return True
+
+
+class VirtualTimeSelector(selectors.SelectSelector):
+    """
+    Instead of blocking until the next timer, jumps the virtual clock to it.
+    Real file descriptors (i.e. the loop's wake-up pipe) are still checked.
+    """
+    def __init__(self, clock):
+        selectors.SelectSelector.__init__(self)
+        self.clock = clock
+
+    def select(self, timeout=None):
+        events = selectors.SelectSelector.select(self, 0)
+        if events or timeout == 0:
+            return events
+        if timeout is None:
+            return selectors.SelectSelector.select(self, None)
+        self.clock.advance(timeout)
+        return []
+
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+    """
+    asyncio event loop running on a VirtualClock: asyncio.sleep and call_at
+    take no real time, so hours of trials run in milliseconds.
+    """
+    def __init__(self, clock=None):
+        if clock is None:
+            clock = VirtualClock()
+        self.clock = clock
+        asyncio.SelectorEventLoop.__init__(self, VirtualTimeSelector(clock))
+        # Timers due within this of the clock are run. The default (1 ns) is below
+        # the spacing of floats around an epoch time, where a timer due now would never run.
+        self._clock_resolution = 1e-6
+
+    def time(self):
+        return self.clock.now